@@ -63,7 +63,6 @@ identities.overlap = 150;
 identities.speed_limit = 30;
 identities.indifference_time = 150;
 identities.threshold = 8;
-identities.extract_images = true;
 
 % CNN model
 net = [];
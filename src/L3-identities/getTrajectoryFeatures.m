@@ -2,73 +2,48 @@ function trajectories = getTrajectoryFeatures(opts, trajectories)
 
 % Gather bounding boxes for this trajectory
 detections = [];
-csvfile = sprintf('%s/%s/L3-identities/temp_images_%s/L2images.csv',opts.experiment_root, opts.experiment_name, opts.sequence_names{opts.sequence});
-
-
-if opts.identities.extract_images
-    temp_dir = sprintf('%s/%s/L3-identities/temp_images_%s',opts.experiment_root, opts.experiment_name, opts.sequence_names{opts.sequence});
-    status = rmdir(temp_dir,'s');
-    mkdir(temp_dir);
-    fid = fopen(csvfile,'w');
-end
 
 for i = 1:length(trajectories)
     
-    
-    % For every trajectory, extract one image every k frames
+    % For every trajectory, use one image every k frames
     inds = round(linspace(1,size(trajectories(i).trajectories(1).data,1),10));
     
-    if opts.identities.extract_images
-        fprintf('Extracting imgages for trajectory %d/%d\n', i, length(trajectories));
-        mkdir(sprintf('%s/%s/L3-identities/temp_images_%s/%05d/',opts.experiment_root, opts.experiment_name, opts.sequence_names{opts.sequence},   i));
-    end
-    
     for k=1:length(inds)
         bb       = trajectories(i).trajectories(1).data(inds(k),3:6);
         frame    = trajectories(i).trajectories(1).data(inds(k),1);
         camera   = trajectories(i).trajectories(1).camera;
-        if opts.identities.extract_images
-            img      = opts.reader.getFrame(camera, frame);
-            snapshot = get_bb(img,bb);
-            snapshot = imresize(snapshot,[opts.net.input_height, opts.net.input_width]);
-            % trajectories(i).trajectories(1).snapshot{k} = snapshot;
-            filename = sprintf('%s/%s/L3-identities/temp_images_%s/%05d/img_%d_%d.jpg',opts.experiment_root, opts.experiment_name, opts.sequence_names{opts.sequence} , i,i,k);
-            imwrite(snapshot, filename);
-            fprintf(fid,'%05d,%s\n',k,filename);
-        end
         detections = [detections; camera, frame, bb, i, k];
     end
 end
-if opts.identities.extract_images
-    fclose(fid);
-end
 
 % Compute features
-% features = embed_detections(opts, detections);
+% The snapshots are cropped straight out of the videos and embedded, and the
+% embeddings averaged per trajectory (column 7, zero-based 6), all in python.
 net = opts.net;
 cur_dir = pwd;
+featuresfile = fullfile(cur_dir, sprintf('%s/%s/L3-identities/L2features_%s.h5',opts.experiment_root, opts.experiment_name, opts.sequence_names{opts.sequence}));
+detectionsfile = fullfile(cur_dir, sprintf('%s/%s/L3-identities/L2detections_%s.mat',opts.experiment_root, opts.experiment_name, opts.sequence_names{opts.sequence}));
+save(detectionsfile, 'detections');
 cd src/triplet-reid
-featuresfile = sprintf('%s/%s/L3-identities/L2features_%s.h5',opts.experiment_root, opts.experiment_name, opts.sequence_names{opts.sequence});
 
-command = strcat(opts.python3, ' embed.py' , ...
+command = strcat(opts.python3, ' embed_detections.py' , ...
     sprintf(' --experiment_root %s', net.experiment_root), ...
-    sprintf(' --image_root %s', fullfile(cur_dir)), ...
-    sprintf(' --filename L2features_%s.h5', opts.sequence_names{opts.sequence}), ...
-    sprintf(' --dataset ../../%s', csvfile));
+    sprintf(' --dataset_path %s', opts.dataset_path), ...
+    sprintf(' --detections_path %s', detectionsfile), ...
+    sprintf(' --filename %s', featuresfile), ...
+    ' --trajectory_column 6');
 fprintf(command);
 system(command);
 cd(cur_dir);
-movefile(sprintf('src/triplet-reid/%s/L2features_%s.h5',opts.net.experiment_root, opts.sequence_names{opts.sequence}),featuresfile);
+delete(detectionsfile);
 
-features = h5read(featuresfile, '/emb');
+features = h5read(featuresfile, '/trajectory_emb');
 features = features';
+ids = h5read(featuresfile, '/trajectory_ids');
 
 % Assign features to trajectories
-ids = unique(detections(:,7));
+% Trajectory feature is the average of all features (if more than one image)
 for i = 1:length(ids)
-    id = ids(i);
-    trajectory_features = features(detections(:,7)==id,:);
-    % Trajectory feature is the average of all features (if more than one image)
-    trajectories(id).trajectories(1).feature = mean(trajectory_features,1);
+    trajectories(ids(i)).trajectories(1).feature = features(i,:);
 end
 
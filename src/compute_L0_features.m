@@ -16,10 +16,9 @@ for iCam = 1:opts.num_cam
         detections(k,:) = [iCam, poses(k,2), newbb];
     end
     
-    % Compute feature embeddings
-    features = embed_detections(opts,detections);
-    
-    % Save features
-    h5write(sprintf('%s/%s/L0-features/features%d.h5',opts.experiment_root,opts.experiment_name,iCam),'/emb', features);
+    % Compute feature embeddings, stored indexed by frame
+    % Absolute, since embed_detections runs python from src/triplet-reid
+    features_file = fullfile(pwd, sprintf('%s/%s/L0-features/features%d.h5',opts.experiment_root,opts.experiment_name,iCam));
+    embed_detections(opts, detections, features_file);
 end
 
@@ -12,16 +12,15 @@ for iCam = 1:8
     % Load OpenPose detections for current camera
     load(fullfile(opts.dataset_path, 'detections','OpenPose', sprintf('camera%d.mat',iCam)));
     
-    % Load features for all detections
-    features   = h5read(sprintf('%s/%s/L0-features/features%d.h5',opts.experiment_root,opts.experiment_name,iCam),'/emb');
-    features   = double(features');
-    all_dets   = detections;
-    appearance = cell(size(all_dets,1),1);
-    frames     = cell(size(all_dets,1),1);
-    for k = 1:length(frames)
-        appearance{k} = features(k,:);
-        frames{k} = detections(k,2);
-    end
+    % Load the frame index of the features, the features themselves are
+    % read window by window
+    features_file   = sprintf('%s/%s/L0-features/features%d.h5',opts.experiment_root,opts.experiment_name,iCam);
+    frame_offsets   = double(h5read(features_file, '/frame_offsets'));
+    first_frame     = double(h5readatt(features_file, '/frame_offsets', 'first_frame'));
+    detection_index = double(h5read(features_file, '/detection_index')) + 1;
+    emb_info        = h5info(features_file, '/emb');
+    feature_dim     = emb_info.Dataspace.Size(1);
+    all_dets        = detections;
     
     % Compute tracklets for every 1-second interval
     tracklets = struct([]);
@@ -43,8 +42,17 @@ for iCam = 1:8
         detections_in_window(:,7:end) = [];
         detections_in_window(:,[1 2]) = detections_in_window(:,[2 1]);
         filteredDetections = detections_in_window;
+        
+        % Read the features of the frames in the current window
+        lo = frame_offsets(min(max(window_start_frame - first_frame, 0), length(frame_offsets) - 1) + 1);
+        hi = frame_offsets(min(max(window_end_frame + 1 - first_frame, 0), length(frame_offsets) - 1) + 1);
+        window_features = zeros(0, feature_dim);
+        if hi > lo
+            window_features = double(h5read(features_file, '/emb', [1 lo+1], [feature_dim hi-lo])');
+        end
+        [~, loc] = ismember(window_inds(valid), detection_index(lo+1:hi));
         filteredFeatures = [];
-        filteredFeatures.appearance = appearance(window_inds(valid));
+        filteredFeatures.appearance = num2cell(window_features(loc,:), 2);
         
         % Compute tracklets in current window
         % Then add them to the list of all tracklets
@@ -60,6 +68,6 @@ for iCam = 1:8
         'tracklets');
     
     % Clean up
-    clear all_dets appearance detections features frames
+    clear all_dets detections frame_offsets detection_index
     
 end
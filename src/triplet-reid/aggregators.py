@@ -1,13 +1,12 @@
-import numpy as np
+import tensorflow as tf
 
 
 def mean(embs):
-    return np.mean(embs, axis=0)
+    return tf.reduce_mean(embs, axis=0)
 
 
 def normalized_mean(embs):
-    embs = mean(embs)
-    return embs / np.linalg.norm(embs, axis=1, keepdims=True)
+    return tf.nn.l2_normalize(mean(embs), -1)
 
 
 AGGREGATORS = {
@@ -0,0 +1,87 @@
+""" Batched test-time augmentation, done in the graph.
+
+A batch of B images is expanded into all A augmented variants at once, as a
+single (A*B, H, W, 3) batch ordered augmentation-major. The network then runs
+once on it, and its (A*B, D) embeddings are folded back into (A, B, D) and
+reduced to (B, D) by an aggregator, still in the graph. That way, the output
+always lines up with the input batch, whatever the batch size.
+"""
+
+import tensorflow as tf
+
+from aggregators import AGGREGATORS
+
+
+CROPS = ['_center', '_top_left', '_top_right', '_bottom_left', '_bottom_right']
+
+
+def five_crops(images, crop_size):
+    """ Returns the central and four corner crops of `crop_size` from the
+    (B, H, W, 3) images, as a list of five (B, h, w, 3) batches. """
+    image_size = tf.shape(images)[1:3]
+    crop_margin = tf.subtract(image_size, crop_size)
+    assert_size = tf.assert_non_negative(
+        crop_margin, message='Crop size must be smaller or equal to the image size.')
+    with tf.control_dependencies([assert_size]):
+        top_left = tf.floor_div(crop_margin, 2)
+        bottom_right = tf.add(top_left, crop_size)
+    h, w = crop_size
+    center       = images[:, top_left[0]:bottom_right[0], top_left[1]:bottom_right[1]]
+    top_left     = images[:, :h, :w]
+    top_right    = images[:, :h, crop_margin[1]:]
+    bottom_left  = images[:, crop_margin[0]:, :w]
+    bottom_right = images[:, crop_margin[0]:, crop_margin[1]:]
+    return [center, top_left, top_right, bottom_left, bottom_right]
+
+
+def num_augmentations(flip_augment, crop_augment):
+    """ The number of variants `augment` expands each image into. """
+    return (2 if flip_augment else 1) * (5 if crop_augment == 'five' else 1)
+
+
+def augment(images, flip_augment, crop_augment, crop_size):
+    """ Expands a batch of images into all of its augmented variants.
+
+    Args:
+        images (4D tensor): The (B, H, W, 3) input images, at the pre-crop size
+            when cropping.
+        flip_augment (bool): Whether to add horizontally flipped variants.
+        crop_augment (string or None): One of `center`, `avgpool`, `five` or
+            None, as for `embed.py`.
+        crop_size (tuple): The (height, width) of the crops.
+
+    Returns:
+        The (A*B, h, w, 3) augmented images and a list of the A `modifiers`,
+        names of the augmentations in the order they appear in the batch.
+    """
+    variants, modifiers = [images], ['original']
+    if flip_augment:
+        variants = [images, tf.reverse(images, [2])]
+        modifiers = [o + m for m in ['', '_flip'] for o in modifiers]
+
+    if crop_augment == 'center':
+        variants = [five_crops(v, crop_size)[0] for v in variants]
+        modifiers = [o + '_center' for o in modifiers]
+    elif crop_augment == 'five':
+        variants = [c for v in variants for c in five_crops(v, crop_size)]
+        modifiers = [o + m for o in modifiers for m in CROPS]
+    elif crop_augment == 'avgpool':
+        modifiers = [o + '_avgpool' for o in modifiers]
+    else:
+        modifiers = [o + '_resize' for o in modifiers]
+
+    return tf.concat(variants, axis=0), modifiers
+
+
+def aggregate(embs, num_augmentations, aggregator):
+    """ Folds the (A*B, D) embeddings of `augment`ed images back.
+
+    Returns:
+        The (B, D) aggregated embeddings and the (A, B, D) ones of the
+        individual variants. Without augmentation, `aggregator` may be None
+        and the embeddings are passed through.
+    """
+    embs_aug = tf.reshape(embs, [num_augmentations, -1, tf.shape(embs)[-1]])
+    if num_augmentations == 1:
+        return embs, embs_aug
+    return AGGREGATORS[aggregator](embs_aug), embs_aug
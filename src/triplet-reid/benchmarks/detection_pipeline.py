@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+""" Benchmarks reading, cutting out and embedding detections from videos.
+
+Runs on the synthetic videos and detections of `synthetic_duke.py`, so it
+doesn't need the DukeMTMC download. They are generated into a temporary
+folder first, unless `--dataset_path` points to existing ones.
+
+For each access pattern, the same sample of detections is read through
+`DukeVideoReader` in that order, timing the decoding of frames, the cropping
+and resizing of the snapshots and the writing of (random) embeddings into an
+HDF5 file separately. The decoded frames are checked for being the requested
+ones by their stamped frame number. Then the network is timed on its own, and
+finally `detections_generator`, `detections_generator_from_openpose` and
+`embed_detections.py` as a whole.
+
+All results are written to a JSON file along with the settings and versions,
+such that runs can be compared over time.
+Run from the repository root, e.g. `python benchmarks/detection_pipeline.py`.
+"""
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from itertools import islice
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import h5py
+import numpy as np
+import scipy.io as sio
+import tensorflow as tf
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import common
+from duke_utils import (DukeVideoReader, detections_generator,
+                        detections_generator_from_openpose, get_bb)
+from heads import HEAD_CHOICES
+import inference
+from nets import NET_CHOICES
+import profiling
+import synthetic_duke
+
+
+# The orders in which the detections are read:
+# - `sequential`: by camera and frame, as `embed_detections.py` does.
+# - `shuffled`: in random order, seeking all over the videos.
+# - `multi_camera`: by frame and camera, i.e. all cameras in lockstep, as a
+#   tracker going through time would.
+PATTERNS = ('sequential', 'shuffled', 'multi_camera')
+
+parser = ArgumentParser(description='Benchmark reading and embedding '
+                                    'detections from videos.',
+                        parents=[synthetic_duke.fixture_parser])
+
+parser.add_argument(
+    '--dataset_path', default=None,
+    help='Synthetic videos and detections written by `synthetic_duke.py`. '
+         'If omitted, they are generated into a temporary folder according '
+         'to the options above, and removed afterwards.')
+
+parser.add_argument(
+    '--output', default='detection_pipeline.json',
+    help='The JSON file to write the results to.')
+
+parser.add_argument(
+    '--patterns', nargs='+', choices=PATTERNS, default=list(PATTERNS),
+    help='Which access patterns to benchmark.')
+
+parser.add_argument(
+    '--max_detections', default=1000, type=common.positive_int,
+    help='The number of detections to sample for each benchmark.')
+
+parser.add_argument(
+    '--experiment_root', default=None,
+    help='A trained network to time. If omitted, one is built according to '
+         'the options below, with random weights.')
+
+parser.add_argument(
+    '--model_name', default='resnet_v1_50', choices=NET_CHOICES,
+    help='Name of the model to use without `--experiment_root`.')
+
+parser.add_argument(
+    '--head_name', default='fc1024', choices=HEAD_CHOICES,
+    help='Name of the head to use without `--experiment_root`.')
+
+parser.add_argument(
+    '--embedding_dim', default=128, type=common.positive_int,
+    help='Dimensionality of the embedding space without `--experiment_root`.')
+
+parser.add_argument(
+    '--net_input_height', default=256, type=common.positive_int,
+    help='Height of the input directly fed into the network.')
+
+parser.add_argument(
+    '--net_input_width', default=128, type=common.positive_int,
+    help='Width of the input directly fed into the network.')
+
+parser.add_argument(
+    '--batch_size', default=32, type=common.positive_int,
+    help='Batch size for the network and for writing embeddings.')
+
+parser.add_argument(
+    '--inference_batches', default=10, type=common.positive_int,
+    help='On how many batches to time the network, after a warm-up one.')
+
+parser.add_argument(
+    '--skip_end_to_end', action='store_true', default=False,
+    help='Don\'t time `embed_detections.py` as a whole.')
+
+
+def access_order(detections, pattern, rng):
+    """ The order in which to read `detections` for `pattern`. """
+    if pattern == 'sequential':
+        return np.lexsort((detections[:, 1], detections[:, 0]))
+    if pattern == 'shuffled':
+        return rng.permutation(len(detections))
+    return np.lexsort((detections[:, 0], detections[:, 1]))
+
+
+def benchmark_pattern(dataset_path, detections, order, image_size,
+                      embedding_dim, batch_size, filename):
+    """ Reads the snapshots of `detections` in `order` and writes embeddings
+    for them batch-wise, like `embed_detections.py`, timing each stage. """
+    timer = profiling.StageTimer()
+    reader = DukeVideoReader(dataset_path)
+    rng = np.random.RandomState(0)
+    prev, decoded, wrong = None, 0, 0
+    with h5py.File(filename, 'w') as f:
+        dataset = f.create_dataset(
+            'emb', (len(detections), embedding_dim), np.float32)
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            for i in rows:
+                camera, frame = int(detections[i, 0]), int(detections[i, 1])
+                if (camera, frame) != prev:
+                    with timer('decode'):
+                        img = reader.getFrame(camera, frame)
+                    decoded += 1
+                    wrong += synthetic_duke.read_stamp(img) != frame
+                    prev = (camera, frame)
+                with timer('crop'):
+                    snapshot = get_bb(img, detections[i, 2:6])
+                with timer('resize'):
+                    cv2.resize(snapshot, (image_size[1], image_size[0]))
+            embs = rng.randn(len(rows), embedding_dim).astype(np.float32)
+            with timer('write'):
+                sort = np.argsort(rows)
+                dataset[rows[sort]] = embs[sort]
+
+    # Decoding is per frame, everything else per detection.
+    counts = dict.fromkeys(timer.totals, len(order))
+    counts['decode'] = decoded
+    return {
+        'detections': len(order),
+        'frames_decoded': decoded,
+        'wrong_frames': int(wrong),
+        'seconds': timer.totals,
+        'per_second': {stage: counts[stage] / seconds
+                       for stage, seconds in timer.totals.items()},
+    }
+
+
+def benchmark_inference(net_args, checkpoint, image_size, batch_size,
+                        num_batches, save_to=None):
+    """ Times the network on random images. Without a `checkpoint` to
+    restore, its random weights are saved into the folder `save_to`. """
+    images = np.random.RandomState(0).uniform(
+        0, 255, (batch_size,) + image_size + (3,)).astype(np.float32)
+    with tf.Graph().as_default():
+        batch = tf.placeholder(tf.float32, (None,) + image_size + (3,))
+        emb = inference.embedding_network(
+            batch, net_args['model_name'], net_args['head_name'],
+            net_args['embedding_dim'])
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            if checkpoint is None:
+                sess.run(tf.global_variables_initializer())
+            else:
+                saver.restore(sess, checkpoint)
+            sess.run(emb, {batch: images})  # Warm-up.
+            start = time.time()
+            for _ in range(num_batches):
+                sess.run(emb, {batch: images})
+            seconds = time.time() - start
+            if save_to is not None:
+                saver.save(sess, os.path.join(save_to, 'checkpoint'),
+                           global_step=0)
+    return {'images': batch_size * num_batches, 'seconds': seconds,
+            'per_second': batch_size * num_batches / seconds}
+
+
+def time_generator(generator, limit):
+    """ Times pulling up to `limit` items out of `generator`. """
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        count = sum(1 for _ in islice(generator, limit))
+    seconds = time.time() - start
+    return {'detections': count, 'seconds': seconds,
+            'per_second': count / seconds}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp()
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'host': platform.node(),
+        'versions': {'python': platform.python_version(),
+                     'numpy': np.__version__, 'opencv': cv2.__version__,
+                     'tensorflow': tf.__version__},
+        'args': vars(args),
+    }
+
+    try:
+        # The fixture, generated unless given.
+        if args.dataset_path is None:
+            args.dataset_path = os.path.join(work_dir, 'dataset')
+            print('Generating the synthetic dataset...')
+            results['fixture'] = synthetic_duke.generate(
+                args.dataset_path, args.cameras, args.parts, args.part_frames,
+                args.gop, args.people, args.seed, args.ffmpeg)
+        else:
+            results['fixture'] = {'dataset_path': args.dataset_path}
+        dataset_path = os.path.join(args.dataset_path, '')
+        detections_path = os.path.join(dataset_path, 'detections', 'boxes.mat')
+        detections = sio.loadmat(detections_path)['detections']
+
+        # The same sample of detections for all patterns.
+        rng = np.random.RandomState(args.seed)
+        sample = np.sort(rng.choice(
+            len(detections), min(len(detections), args.max_detections),
+            replace=False))
+        sample_detections = detections[sample]
+
+        if args.experiment_root is None:
+            net_args = {key: getattr(args, key) for key in [
+                'model_name', 'head_name', 'embedding_dim',
+                'net_input_height', 'net_input_width']}
+            checkpoint = None
+        else:
+            net_args = inference.experiment_args(args.experiment_root)
+            checkpoint = inference.checkpoint_path(args.experiment_root)
+        image_size = (net_args['net_input_height'], net_args['net_input_width'])
+
+        results['patterns'] = {}
+        for pattern in args.patterns:
+            print('Reading {} detections {}...'.format(len(sample), pattern))
+            order = access_order(sample_detections, pattern, rng)
+            results['patterns'][pattern] = benchmark_pattern(
+                dataset_path, sample_detections, order, image_size,
+                net_args['embedding_dim'], args.batch_size,
+                os.path.join(work_dir, 'emb.h5'))
+
+        # Without a trained network, the random one is saved for running
+        # `embed_detections.py` with.
+        print('Timing the network...')
+        if checkpoint is None:
+            experiment_root = os.path.join(work_dir, 'experiment')
+            os.makedirs(experiment_root)
+            with open(os.path.join(experiment_root, 'args.json'), 'w') as f:
+                json.dump(dict(net_args, crop_augment=False, image_root=None,
+                               pre_crop_height=288, pre_crop_width=144), f)
+        else:
+            experiment_root = args.experiment_root
+        results['inference'] = benchmark_inference(
+            net_args, checkpoint, image_size, args.batch_size,
+            args.inference_batches,
+            save_to=experiment_root if checkpoint is None else None)
+
+        print('Timing the generators...')
+        read_order = np.lexsort(
+            (sample_detections[:, 1], sample_detections[:, 0]))
+        results['detections_generator'] = time_generator(
+            detections_generator(dataset_path, sample_detections,
+                                 image_size[0], image_size[1], read_order),
+            len(sample))
+        results['detections_generator_from_openpose'] = time_generator(
+            detections_generator_from_openpose(
+                1, dataset_path, os.path.join(
+                    dataset_path, 'detections', 'openpose')),
+            len(sample))
+
+        if not args.skip_end_to_end:
+            print('Running embed_detections.py...')
+            sample_path = os.path.join(work_dir, 'sample.mat')
+            sio.savemat(sample_path, {'detections': sample_detections})
+            start = time.time()
+            subprocess.check_call([
+                sys.executable, 'embed_detections.py',
+                '--experiment_root', experiment_root,
+                '--dataset_path', dataset_path,
+                '--detections_path', sample_path,
+                '--filename', os.path.join(work_dir, 'end_to_end.h5'),
+                '--batch_size', str(args.batch_size), '--quiet'],
+                cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+            seconds = time.time() - start
+            results['end_to_end'] = {
+                'detections': len(sample), 'seconds': seconds,
+                'per_second': len(sample) / seconds}
+    finally:
+        shutil.rmtree(work_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for pattern, result in results['patterns'].items():
+        print('{:12s}: {}{}'.format(pattern, ' | '.join(
+            '{} {:.1f}/s'.format(stage, speed)
+            for stage, speed in result['per_second'].items()),
+            ' | {} WRONG FRAMES'.format(result['wrong_frames'])
+            if result['wrong_frames'] else ''))
+    for name in ['inference', 'detections_generator',
+                 'detections_generator_from_openpose', 'end_to_end']:
+        if name in results:
+            print('{}: {:.1f}/s'.format(name, results[name]['per_second']))
+    print('Wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+""" Benchmarks the mAP/CMC computation of `evaluate.py` at realistic sizes.
+
+Uses the PIDs and FIDs of the bundled query/gallery csv files together with
+random embeddings, and compares the vectorized `metrics` against the former
+per-query loop over `sklearn.metrics.average_precision_score`.
+Run from the repository root, e.g. `python benchmarks/evaluation_metrics.py`.
+"""
+from argparse import ArgumentParser
+from importlib import import_module
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import common
+import metrics
+
+
+DATASETS = {
+    'duke': ('data/duke_query.csv', 'data/duke_test.csv', 'duke'),
+    'market1501': ('data/market1501_query.csv', 'data/market1501_test.csv', 'market1501'),
+}
+
+parser = ArgumentParser(description='Benchmark the evaluation metrics.')
+
+parser.add_argument(
+    '--datasets', nargs='+', choices=DATASETS.keys(), default=sorted(DATASETS),
+    help='Which of the bundled datasets to use the sizes and PIDs of.')
+
+parser.add_argument(
+    '--batch_size', default=256, type=common.positive_int,
+    help='Number of queries per batch, as in `evaluate.py`.')
+
+parser.add_argument(
+    '--sklearn_queries', default=512, type=common.nonnegative_int,
+    help='On how many queries to time and check against the sklearn reference.'
+         ' It is very slow, so the timing is extrapolated to all queries.')
+
+parser.add_argument(
+    '--embedding_dim', default=128, type=common.positive_int,
+    help='Dimensionality of the random embeddings.')
+
+
+def sklearn_reference(distances, pid_matches):
+    """ The former per-query loop of `evaluate.py`. """
+    from sklearn.metrics import average_precision_score
+    aps, ranks = [], []
+    scores = 1 / (1 + distances)
+    for i in range(len(distances)):
+        aps.append(average_precision_score(pid_matches[i], scores[i])
+                   if np.any(pid_matches[i]) else np.nan)
+        matches = np.where(pid_matches[i, np.argsort(distances[i])])[0]
+        ranks.append(matches[0] if len(matches) else -1)
+    return np.array(aps), np.array(ranks)
+
+
+def batches(query_embs, query_pids, query_fids, gallery_embs, gallery_pids,
+            excluder, metric, batch_size):
+    for start in range(0, len(query_embs), batch_size):
+        stop = start + batch_size
+        distances = metrics.cdist(query_embs[start:stop], gallery_embs, metric)
+        pid_matches = gallery_pids[None] == query_pids[start:stop, None]
+        mask = excluder(query_fids[start:stop])
+        distances[mask] = np.inf
+        pid_matches[mask] = False
+        yield distances, pid_matches
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.RandomState(42)
+
+    for name in args.datasets:
+        query_csv, gallery_csv, excluder_name = DATASETS[name]
+        query_pids, query_fids = common.load_dataset(query_csv, None)
+        gallery_pids, gallery_fids = common.load_dataset(gallery_csv, None)
+        excluder = import_module('excluders.' + excluder_name).Excluder(gallery_fids)
+
+        query_embs = rng.randn(len(query_pids), args.embedding_dim).astype(np.float32)
+        gallery_embs = rng.randn(len(gallery_pids), args.embedding_dim).astype(np.float32)
+        print('{}: {} queries, {} gallery images'.format(
+            name, len(query_pids), len(gallery_pids)))
+
+        data = (query_embs, query_pids, query_fids, gallery_embs, gallery_pids,
+                excluder, 'euclidean', args.batch_size)
+
+        start = time.time()
+        for distances, pid_matches in batches(*data):
+            pass
+        setup_time = time.time() - start
+
+        start = time.time()
+        aps, ranks = [], []
+        for distances, pid_matches in batches(*data):
+            aps.append(metrics.average_precision(distances, pid_matches))
+            ranks.append(metrics.first_match_rank(distances, pid_matches))
+        vectorized_time = time.time() - start - setup_time
+        aps, ranks = np.concatenate(aps), np.concatenate(ranks)
+        print('  distances and masks:  {:8.2f}s'.format(setup_time))
+        print('  vectorized metrics:   {:8.2f}s'.format(vectorized_time))
+
+        n = min(args.sklearn_queries, len(query_pids))
+        if n == 0:
+            continue
+        start = time.time()
+        ref_aps, ref_ranks = [], []
+        for distances, pid_matches in batches(*(data[:-1] + (n,))):
+            batch_aps, batch_ranks = sklearn_reference(distances, pid_matches)
+            ref_aps.append(batch_aps)
+            ref_ranks.append(batch_ranks)
+            break
+        sklearn_time = (time.time() - start) * len(query_pids) / n
+        print('  sklearn loop:         {:8.2f}s (extrapolated from {} queries)'.format(
+            sklearn_time, n))
+
+        ref_aps, ref_ranks = np.concatenate(ref_aps), np.concatenate(ref_ranks)
+        valid = np.logical_not(np.isnan(ref_aps))
+        print('  max AP difference:    {:.2e}'.format(
+            np.max(np.abs(aps[:n][valid] - ref_aps[valid]))))
+        print('  rank mismatches:      {}'.format(
+            np.sum(ranks[:n][valid] != ref_ranks[valid])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+""" Generates a tiny synthetic stand-in for the DukeMTMC videos and detections.
+
+The videos follow the `videos/cameraN/NNNNN.MTS` layout read by
+`duke_utils.DukeVideoReader`, but with few, short parts whose frame counts
+are listed in `videos/part_frames.json`. They are encoded by `ffmpeg` as
+H.264 in MPEG-TS, like the real ones, with a fixed GOP length. Each frame
+shows a few boxes moving in front of a static background, and its (global,
+1-based) frame number as a row of black and white blocks at the top, see
+`stamped_frame`, so readers can be checked for landing on the right frame.
+
+Next to the videos, it writes the detections of the boxes in all formats the
+pipeline consumes:
+
+- `detections/boxes.mat`: rows of `[camera, frame, left, top, width, height]`
+  of all cameras, as for `embed_detections.py`.
+- `detections/openpose/cameraN.mat`: poses fitting the boxes, rows of
+  `[camera, frame, x, y, confidence, ...]` with normalized coordinates, as
+  read by `compute_L0_features.m`.
+- `detections/openpose/cameraN_openpose.mat`: the same as a MATLAB v7.3
+  (HDF5) file, as read by `duke_utils.detections_generator_from_openpose`.
+
+Run from the repository root, e.g.
+`python benchmarks/synthetic_duke.py --dataset_path /tmp/synthetic_duke`.
+"""
+from argparse import ArgumentParser
+import json
+import os
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import scipy.io as sio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import common
+
+
+# The resolution of the DukeMTMC videos, which `duke_utils` assumes.
+WIDTH, HEIGHT = 1920, 1080
+
+# The frame number stamp, one block per bit, most significant first.
+STAMP_BITS = 24
+STAMP_BLOCK = 40
+
+# The OpenPose keypoints of a person `duke_utils.pose2bb` fits its template
+# box to, in the same (relative) coordinates as that box.
+REF_POSE = np.array([
+    [0, 0], [0, 23], [28, 23], [39, 66], [45, 108], [-28, 23], [-39, 66],
+    [-45, 108], [20, 106], [20, 169], [20, 231], [-20, 106], [-20, 169],
+    [-20, 231], [5, -7], [11, -8], [-5, -7], [-11, -8]], dtype=np.float64)
+REF_BOX = np.array([[-50, -15], [50, 240]], dtype=np.float64)
+
+# The options of the generated data, shared with the benchmarks using it.
+fixture_parser = ArgumentParser(add_help=False)
+
+fixture_parser.add_argument(
+    '--cameras', default=2, type=common.positive_int,
+    help='Number of cameras.')
+
+fixture_parser.add_argument(
+    '--parts', default=2, type=common.positive_int,
+    help='Number of video parts per camera.')
+
+fixture_parser.add_argument(
+    '--part_frames', default=300, type=common.positive_int,
+    help='Number of frames of each part.')
+
+fixture_parser.add_argument(
+    '--gop', default=30, type=common.positive_int,
+    help='Number of frames from one keyframe to the next. The DukeMTMC videos '
+         'have one every 30 frames, which `DukeVideoReader` relies on for '
+         'seeking.')
+
+fixture_parser.add_argument(
+    '--people', default=8, type=common.positive_int,
+    help='Number of people (boxes) per camera, each one visible during a '
+         'random part of the video.')
+
+fixture_parser.add_argument(
+    '--seed', default=0, type=int,
+    help='Seed for the placement and motion of the people.')
+
+fixture_parser.add_argument(
+    '--ffmpeg', default='ffmpeg',
+    help='The ffmpeg executable used for encoding.')
+
+parser = ArgumentParser(description='Generate synthetic DukeMTMC-like videos '
+                                    'and detections for benchmarking.',
+                        parents=[fixture_parser])
+
+parser.add_argument(
+    '--dataset_path', required=True,
+    help='Where to write the videos and detections, i.e. what to pass as '
+         '`--dataset_path` to `embed_detections.py`.')
+
+
+def stamped_frame(background, frame):
+    """ Returns a copy of `background` with `frame` stamped onto it. """
+    img = background.copy()
+    for bit in range(STAMP_BITS):
+        value = 255 if (frame >> (STAMP_BITS - 1 - bit)) & 1 else 0
+        img[:STAMP_BLOCK, bit*STAMP_BLOCK:(bit+1)*STAMP_BLOCK] = value
+    return img
+
+
+def read_stamp(img):
+    """ Returns the frame number stamped onto the decoded image `img`. """
+    half = STAMP_BLOCK // 2
+    frame = 0
+    for bit in range(STAMP_BITS):
+        center = img[half - 4:half + 4,
+                     bit*STAMP_BLOCK + half - 4:bit*STAMP_BLOCK + half + 4]
+        frame = (frame << 1) | int(np.mean(center) > 127)
+    return frame
+
+
+def people_tracks(num_frames, num_people, rng):
+    """ Returns the (num_people, num_frames, 4) boxes of people moving about,
+    as [left, top, width, height], and whether each one is visible. """
+    height = rng.uniform(200, 500, num_people)
+    width = 0.4 * height
+    # How far each box can move, without covering the stamp.
+    span = np.stack([WIDTH - width, HEIGHT - STAMP_BLOCK - height], axis=1)
+    position = rng.uniform(0, 1, (num_people, 2)) * span
+    velocity = rng.uniform(-6, 6, (num_people, 2))
+
+    # Move along straight lines, bouncing off the borders of the image.
+    t = np.arange(num_frames)[None, :, None]
+    span = span[:, None]
+    travelled = np.mod(position[:, None] + velocity[:, None] * t, 2 * span)
+    left_top = np.where(travelled > span, 2 * span - travelled, travelled)
+    left_top[..., 1] += STAMP_BLOCK
+    size = np.broadcast_to(
+        np.stack([width, height], axis=1)[:, None], left_top.shape)
+    boxes = np.concatenate([left_top, size], axis=2)
+
+    # Each person is only around for some part of the video.
+    start = rng.randint(0, num_frames // 2, num_people)
+    stop = start + rng.randint(num_frames // 4, num_frames, num_people)
+    visible = (t[..., 0] >= start[:, None]) & (t[..., 0] < stop[:, None])
+    return boxes, visible
+
+
+def render(background, frame, boxes, colors):
+    """ Renders the frame number `frame` with the people at `boxes`. """
+    img = stamped_frame(background, frame)
+    for box, color in zip(np.round(boxes).astype(int), colors):
+        left, top, width, height = box
+        person = img[top:top + height, left:left + width]
+        person[:] = color
+        # Some stripes, for the network to have something to look at.
+        person[::16] = 255 - color
+    return img
+
+
+def box_to_pose(box):
+    """ Returns the 18 keypoints of a pose `duke_utils.pose2bb` fits to
+    `box`, normalized by the image size, each as x, y and confidence. """
+    left, top, width, height = box
+    scale = height / (REF_BOX[1, 1] - REF_BOX[0, 1])
+    x = left + width / 2 + REF_POSE[:, 0] * scale
+    y = top + (REF_POSE[:, 1] - REF_BOX[0, 1]) * scale
+    return np.stack([x / WIDTH, y / HEIGHT, np.full(len(x), 0.9)], 1).ravel()
+
+
+def encode(path, frames, gop, ffmpeg='ffmpeg'):
+    """ Encodes the RGB images `frames` into the MPEG-TS file `path`, with a
+    keyframe every `gop` frames and no B-frames. """
+    command = [
+        ffmpeg, '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+        '-s', '{}x{}'.format(WIDTH, HEIGHT), '-r', '30', '-i', '-',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+        '-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0',
+        '-bf', '0', '-f', 'mpegts', path]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    for img in frames:
+        process.stdin.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError('Encoding {} failed.'.format(path))
+
+
+def generate(dataset_path, cameras=2, parts=2, part_frames=300, gop=30,
+             people=8, seed=0, ffmpeg='ffmpeg'):
+    """ Writes the synthetic videos and detections into `dataset_path`.
+
+    Returns:
+        A dict describing what was generated, for the benchmark results.
+    """
+    rng = np.random.RandomState(seed)
+    num_frames = parts * part_frames
+    openpose_dir = os.path.join(dataset_path, 'detections', 'openpose')
+    os.makedirs(openpose_dir, exist_ok=True)
+
+    all_boxes = []
+    for camera in range(1, cameras + 1):
+        video_dir = os.path.join(
+            dataset_path, 'videos', 'camera{}'.format(camera))
+        os.makedirs(video_dir, exist_ok=True)
+
+        yy, xx = np.mgrid[:HEIGHT, :WIDTH]
+        background = np.stack([xx * 255 // WIDTH, yy * 255 // HEIGHT,
+                               np.full_like(xx, 40 * camera % 256)], axis=2)
+        background = background.astype(np.uint8)
+        boxes, visible = people_tracks(num_frames, people, rng)
+        colors = rng.randint(0, 256, (people, 3))
+
+        for part in range(parts):
+            part_range = range(part * part_frames, (part + 1) * part_frames)
+            encode(os.path.join(video_dir, '{:05d}.MTS'.format(part)),
+                   (render(background, t + 1, boxes[visible[:, t], t],
+                           colors[visible[:, t]]) for t in part_range),
+                   gop, ffmpeg)
+
+        person, t = np.nonzero(visible)
+        order = np.lexsort((person, t))
+        person, t = person[order], t[order]
+        camera_boxes = np.column_stack([
+            np.full(len(t), camera), t + 1, boxes[person, t]])
+        all_boxes.append(camera_boxes)
+
+        poses = np.array([box_to_pose(box) for box in camera_boxes[:, 2:]])
+        pose_detections = np.column_stack([camera_boxes[:, :2], poses])
+        sio.savemat(os.path.join(openpose_dir, 'camera{}.mat'.format(camera)),
+                    {'detections': pose_detections})
+        # MATLAB v7.3 files store matrices transposed.
+        pose_file = os.path.join(
+            openpose_dir, 'camera{}_openpose.mat'.format(camera))
+        with h5py.File(pose_file, 'w') as f:
+            f.create_dataset('detections', data=pose_detections.T)
+
+    layout_file = os.path.join(dataset_path, 'videos', 'part_frames.json')
+    with open(layout_file, 'w') as f:
+        json.dump([[part_frames] * parts] * cameras, f)
+    detections = np.concatenate(all_boxes)
+    sio.savemat(os.path.join(dataset_path, 'detections', 'boxes.mat'),
+                {'detections': detections})
+
+    return {'cameras': cameras, 'parts': parts, 'part_frames': part_frames,
+            'gop': gop, 'people': people, 'seed': seed,
+            'detections': len(detections)}
+
+
+def main():
+    args = parser.parse_args()
+    info = generate(args.dataset_path, args.cameras, args.parts,
+                    args.part_frames, args.gop, args.people, args.seed,
+                    args.ffmpeg)
+    print('Wrote {detections} detections in {cameras} cameras of {parts} '
+          'parts of {part_frames} frames each.'.format(**info))
+
+
+if __name__ == '__main__':
+    main()
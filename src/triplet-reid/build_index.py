@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+import os
+import time
+
+import h5py
+import numpy as np
+
+import common
+import gallery_index
+import metrics
+
+
+parser = ArgumentParser(
+    description='Build an approximate nearest-neighbor index over a gallery '
+                'of embeddings, and optionally measure its recall.')
+
+parser.add_argument(
+    '--gallery_embeddings', required=True,
+    help='Path to the h5 file containing the gallery embeddings.')
+
+parser.add_argument(
+    '--group', default='/',
+    help='The group within the h5 files holding the embeddings, e.g. `model1` '
+         'for those of the first `--extra_model` of `embed.py`.')
+
+parser.add_argument(
+    '--index', default=None,
+    help='Where to store the index. Defaults to the embeddings file name with '
+         '`_ivf.npz` instead of `.h5`, preceded by the `group` if any, i.e. '
+         'next to the embeddings file.')
+
+parser.add_argument(
+    '--rebuild', action='store_true', default=False,
+    help='Build the index even if there already is one. An existing index '
+         'built for other embeddings or another metric is always rebuilt.')
+
+parser.add_argument(
+    '--metric', default='euclidean', choices=metrics.cdist.supported_metrics,
+    help='Which metric to use for the distance between embeddings.')
+
+parser.add_argument(
+    '--num_lists', default=None, type=common.positive_int,
+    help='Number of k-means clusters, defaults to four times the square root '
+         'of the gallery size.')
+
+parser.add_argument(
+    '--iterations', default=20, type=common.positive_int,
+    help='Number of k-means iterations.')
+
+parser.add_argument(
+    '--train_size', default=None, type=common.positive_int,
+    help='On how many random gallery embeddings to run k-means, defaults to '
+         '256 per list.')
+
+parser.add_argument(
+    '--seed', default=None, type=int,
+    help='Seed for the k-means sampling.')
+
+parser.add_argument(
+    '--query_embeddings', default=None,
+    help='If given, search the index with these queries and report the '
+         'recall@k against exhaustive search, as well as the speed.')
+
+parser.add_argument(
+    '--k', default=[1, 5, 10], nargs='+', type=common.positive_int,
+    help='The k to report recall@k for.')
+
+parser.add_argument(
+    '--nprobe', default=[1, 2, 4, 8, 16, 32], nargs='+',
+    type=common.positive_int,
+    help='The numbers of probed lists to report recall and speed for.')
+
+parser.add_argument(
+    '--batch_size', default=1024, type=common.positive_int,
+    help='Number of queries searched at once.')
+
+
+def main():
+    args = parser.parse_args()
+    index_file = args.index or gallery_index.default_path(
+        args.gallery_embeddings, args.group)
+
+    with h5py.File(args.gallery_embeddings, 'r') as f_gallery:
+        gallery_embs = np.array(f_gallery[args.group]['emb'])
+
+    index = None
+    if os.path.isfile(index_file) and not args.rebuild:
+        index = gallery_index.GalleryIndex.load(index_file)
+        if index.matches(gallery_embs, args.metric):
+            index.attach(gallery_embs)
+            print('Loaded the index with {} lists from {}'.format(
+                index.num_lists, index_file))
+        else:
+            print('The index in {} was built for other embeddings or another '
+                  'metric, rebuilding it.'.format(index_file))
+            index = None
+    if index is None:
+        start = time.time()
+        index = gallery_index.GalleryIndex.build(
+            gallery_embs, args.num_lists, args.metric, args.iterations,
+            args.train_size, args.seed)
+        index.save(index_file)
+        print('Built an index with {} lists in {:.1f}s, saved to {}'.format(
+            index.num_lists, time.time() - start, index_file))
+
+    if args.query_embeddings is None:
+        return
+
+    with h5py.File(args.query_embeddings, 'r') as f_query:
+        query_embs = np.array(f_query[args.group]['emb'])
+
+    max_k = max(args.k)
+    start = time.time()
+    true_idxs, _ = gallery_index.exact_search(
+        query_embs, gallery_embs, max_k, index.metric)
+    print('exhaustive: {:7.1f} queries/s'.format(
+        len(query_embs) / (time.time() - start)))
+
+    for nprobe in args.nprobe:
+        start = time.time()
+        idxs, _ = index.search(query_embs, max_k, nprobe, args.batch_size)
+        speed = len(query_embs) / (time.time() - start)
+        recalls = ' | '.join(
+            'recall@{}: {:.2%}'.format(k, gallery_index.recall_at_k(
+                idxs[:, :k], true_idxs[:, :k]))
+            for k in args.k)
+        print('nprobe {:4d}: {:7.1f} queries/s | {}'.format(nprobe, speed, recalls))
+
+
+if __name__ == '__main__':
+    main()
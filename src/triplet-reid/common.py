@@ -1,11 +1,19 @@
 """ A bunch of general utilities shared by train/embed/eval """
 
 from argparse import ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import hashlib
+import json
 import logging
 import os
+import queue
+import threading
 
 import numpy as np
-import tensorflow as tf
+
+# TensorFlow is only imported by the functions which need it, such that tools
+# like `evaluate.py` can use the rest of this module without it.
 
 # Commandline argument parsing
 ###
@@ -93,6 +101,144 @@ def float_or_string(arg):
 # Dataset handling
 ###
 
+# Where `load_dataset` keeps a manifest of each dataset it verified, such that
+# the next time, the files need not be checked again. Set the environment
+# variable to an empty string to disable this.
+MANIFEST_DIR = os.environ.get('TRIPLET_REID_MANIFESTS', os.path.join(
+    os.path.expanduser('~'), '.cache', 'triplet-reid', 'manifests'))
+
+# Directories holding at least this many of a dataset's files are listed for
+# checking whether they exist, instead of checking each file on its own.
+LIST_DIRECTORY_MIN_FILES = 8
+
+
+def read_csv(csv_file):
+    """ Parses a dataset .csv file of `pid,fid` rows in a single pass.
+
+    Empty lines and lines starting with `#` are skipped.
+
+    Args:
+        csv_file (string, file-like object): The csv data file to load.
+
+    Returns:
+        (pid_codes, pid_table, fids) a tuple of the index of each row's PID
+        into `pid_table`, an array of the distinct PIDs in the order of their
+        first appearance, and the array of FIDs.
+
+    Raises:
+        ValueError if a row doesn't have exactly two columns.
+    """
+    if isinstance(csv_file, str):
+        with open(csv_file, 'r', newline='') as f:
+            return read_csv(f)
+
+    codes = {}
+    pid_codes, fids = [], []
+    reader = csv.reader(csv_file)
+    for row in reader:
+        if not row or row[0].startswith('#'):
+            continue
+        if len(row) != 2:
+            raise ValueError('Line {} of the dataset file has {} columns '
+                             'instead of `pid,fid`.'.format(
+                                 reader.line_num, len(row)))
+        pid_codes.append(codes.setdefault(row[0], len(codes)))
+        fids.append(row[1])
+    return (np.array(pid_codes, dtype=np.int64),
+            np.array(list(codes), dtype=str), np.array(fids, dtype=str))
+
+
+def find_missing(image_root, fids, threads=16):
+    """ Returns whether each of the `fids` is missing from `image_root`.
+
+    Instead of asking for every single file, which takes ages on network
+    storage, each directory holding many of them is listed once. The files
+    of all other directories are checked one by one. Either way, this is
+    spread over a pool of `threads` threads.
+    """
+    paths = [os.path.join(image_root, fid) for fid in fids]
+    names = [os.path.basename(path) for path in paths]
+    by_directory = {}
+    for i, path in enumerate(paths):
+        by_directory.setdefault(os.path.dirname(path), []).append(i)
+
+    missing = np.zeros(len(fids), dtype=bool)
+
+    def check(directory, indices):
+        if len(indices) < LIST_DIRECTORY_MIN_FILES:
+            missing[indices] = [not os.path.isfile(paths[i]) for i in indices]
+            return
+        try:
+            listed = set(os.listdir(directory))
+        except OSError:
+            missing[indices] = True
+        else:
+            missing[indices] = [names[i] not in listed for i in indices]
+
+    with ThreadPoolExecutor(threads) as pool:
+        # Consume the results for any exception to be raised here.
+        list(pool.map(lambda item: check(*item), by_directory.items()))
+    return missing
+
+
+def _mtime(path):
+    """ The modification time of `path`, or None if it doesn't exist. """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def cached_find_missing(csv_file, image_root, fids):
+    """ Like `find_missing`, but if the manifest in `MANIFEST_DIR` tells that
+    `csv_file` was checked against `image_root` before, and neither changed
+    since (by modification time and size), its result is used instead.
+
+    Since adding or removing a file only changes the modification time of the
+    directory it is in, that of every directory holding any of the `fids` is
+    part of the check, too.
+    """
+    try:
+        csv_stat = os.stat(csv_file)
+        os.stat(image_root)
+    except (OSError, TypeError):
+        # Not a file name, or nothing to verify against, anyways.
+        return find_missing(image_root, fids)
+    if not MANIFEST_DIR:
+        return find_missing(image_root, fids)
+
+    csv_file, image_root = os.path.abspath(csv_file), os.path.abspath(image_root)
+    directories = sorted({os.path.dirname(os.path.join(image_root, fid))
+                          for fid in fids})
+    stamp = [csv_file, csv_stat.st_mtime, csv_stat.st_size, image_root,
+             [[directory, _mtime(directory)] for directory in directories],
+             len(fids)]
+    digest = hashlib.sha1('{}\0{}'.format(csv_file, image_root).encode())
+    manifest_file = os.path.join(MANIFEST_DIR, digest.hexdigest() + '.json')
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if manifest['stamp'] == stamp:
+            missing = np.zeros(len(fids), dtype=bool)
+            missing[manifest['missing']] = True
+            return missing
+    except (OSError, ValueError, KeyError):
+        pass
+
+    missing = find_missing(image_root, fids)
+    try:
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        # Write to a temporary file first, such that concurrent starts never
+        # read a half-written manifest.
+        tmp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'stamp': stamp,
+                       'missing': np.flatnonzero(missing).tolist()}, f)
+        os.replace(tmp_file, manifest_file)
+    except OSError:
+        pass  # Not being able to cache it is no reason to fail.
+    return missing
+
 
 def load_dataset(csv_file, image_root, fail_on_missing=True):
     """ Loads a dataset .csv file, returning PIDs and FIDs.
@@ -104,7 +250,8 @@ def load_dataset(csv_file, image_root, fail_on_missing=True):
         csv_file (string, file-like object): The csv data file to load.
         image_root (string): The path to which the image files as stored in the
             csv file are relative to. Used for verification purposes.
-            If this is `None`, no verification at all is made.
+            If this is `None`, no verification at all is made. Otherwise,
+            see `cached_find_missing` for how it's skipped on repeated loads.
         fail_on_missing (bool or None): If one or more files from the dataset
             are not present in the `image_root`, either raise an IOError (if
             True) or remove it from the returned dataset (if False).
@@ -116,14 +263,12 @@ def load_dataset(csv_file, image_root, fail_on_missing=True):
     Raises:
         IOError if any one file is missing and `fail_on_missing` is True.
     """
-    dataset = np.genfromtxt(csv_file, delimiter=',', dtype='|U')
-    pids, fids = dataset.T
+    pid_codes, pid_table, fids = read_csv(csv_file)
+    pids = pid_table[pid_codes]
 
     # Possibly check if all files exist
     if image_root is not None:
-        missing = np.full(len(fids), False, dtype=bool)
-        for i, fid in enumerate(fids):
-            missing[i] = not os.path.isfile(os.path.join(image_root, fid))
+        missing = cached_find_missing(csv_file, image_root, fids)
 
         missing_count = np.sum(missing)
         if missing_count > 0:
@@ -143,18 +288,119 @@ def load_dataset(csv_file, image_root, fail_on_missing=True):
 
 def fid_to_image(fid, pid, image_root, image_size):
     """ Loads and resizes an image given by FID. Pass-through the PID. """
+    import tensorflow as tf
+
     # Since there is no symbolic path.join, we just add a '/' to be sure.
     image_encoded = tf.read_file(tf.reduce_join([image_root, '/', fid]))
 
+    return decode_image(image_encoded, image_size), fid, pid
+
+
+def decode_image(image_encoded, image_size):
+    """ Decodes and resizes an encoded image file. """
+    import tensorflow as tf
+
     # tf.image.decode_image doesn't set the shape, not even the dimensionality,
     # because it potentially loads animated .gif files. Instead, we use either
     # decode_jpeg or decode_png, each of which can decode both.
     # Sounds ridiculous, but is true:
     # https://github.com/tensorflow/tensorflow/issues/9356#issuecomment-309144064
     image_decoded = tf.image.decode_jpeg(image_encoded, channels=3)
-    image_resized = tf.image.resize_images(image_decoded, image_size)
+    return tf.image.resize_images(image_decoded, image_size)
+
+
+def scoped_saver(scope, **kwargs):
+    """ Creates a saver for a network that was built within `scope`.
+
+    The variables are mapped to their names without the scope, i.e. the names
+    under which they are stored in a checkpoint of the network on its own.
+    This allows restoring a checkpoint into a network built side by side with
+    another one, e.g. a distillation teacher.
+
+    Args:
+        scope (string): The variable scope the network was built in.
+        kwargs: Passed on to `tf.train.Saver`.
+
+    Returns:
+        A `tf.train.Saver` for all global variables within `scope`.
+    """
+    import tensorflow as tf
+
+    prefix = scope + '/'
+    var_list = {var.op.name[len(prefix):]: var
+                for var in tf.global_variables()
+                if var.op.name.startswith(prefix)}
+    return tf.train.Saver(var_list, **kwargs)
+
+
+# TensorBoard summaries
+###
 
-    return image_resized, fid, pid
+
+class AsyncSummaryWriter(object):
+    """ Hands summaries to a `tf.summary.FileWriter` on a background thread.
+
+    The `FileWriter` already writes to disk asynchronously, but it parses the
+    serialized summary and builds the event on the calling thread, which adds
+    up for large histograms. With this wrapper, the training loop only pays for
+    putting the summary into a queue.
+
+    Args:
+        writer (tf.summary.FileWriter): The writer to forward everything to.
+        max_queue (int): How many summaries may be pending before `add_summary`
+            starts blocking.
+    """
+    def __init__(self, writer, max_queue=100):
+        self.writer = writer
+        self._queue = queue.Queue(max_queue)
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, name='AsyncSummaryWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_summary(self, summary, global_step=None):
+        self._put((self.writer.add_summary, (summary, global_step)))
+
+    def add_run_metadata(self, run_metadata, tag, global_step=None):
+        self._put((self.writer.add_run_metadata,
+                   (run_metadata, tag, global_step)))
+
+    def close(self):
+        """ Writes all pending summaries and closes the underlying writer.
+
+        Raises:
+            Whatever writing any of the summaries raised, if anything.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.close()
+        self._raise_error()
+
+    def _put(self, item):
+        """ Queues `item`, but first raises what writing an earlier one did. """
+        self._raise_error()
+        self._queue.put(item)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            # After a failure, keep draining the queue, such that the training
+            # loop never blocks on it, but only fails on its next summary.
+            if self._error is not None:
+                continue
+            method, args = item
+            try:
+                method(*args)
+            except Exception as e:
+                self._error = e
 
 
 def get_logging_dict(name):
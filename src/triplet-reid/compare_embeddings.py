@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+""" Reports how far approximate embeddings are off from exact ones.
+
+Meant for comparing the output of `embed_detections.py --reuse_every` with
+that of the exact mode on the same detections, but works for any two
+embedding files of the same images.
+"""
+from argparse import ArgumentParser
+
+import h5py
+import numpy as np
+import scipy.io as sio
+
+import metrics
+
+parser = ArgumentParser(description='Compare approximate embeddings to exact '
+                                    'ones of the same images.')
+
+parser.add_argument(
+    '--reference', required=True,
+    help='Path to the h5 file containing the exact embeddings.')
+
+parser.add_argument(
+    '--approximate', required=True,
+    help='Path to the h5 file containing the approximate embeddings.')
+
+parser.add_argument(
+    '--detections_path', default=None,
+    help='The detections .mat file both were computed from. If given, also '
+         'reports how often an approximate embedding is closer to the exact '
+         'one of another detection in the same frame than to its own.')
+
+parser.add_argument(
+    '--metric', default='euclidean', choices=metrics.cdist.supported_metrics,
+    help='Which metric to use for the distance between embeddings.')
+
+
+def pair_distances(a, b, metric):
+    """ The distances of corresponding rows of `a` and `b`. """
+    diff = a - b
+    if metric == 'cityblock':
+        return np.sum(np.abs(diff), axis=1)
+    sq = np.sum(np.square(diff), axis=1)
+    return sq if metric == 'sqeuclidean' else np.sqrt(sq + 1e-12)
+
+
+def main():
+    args = parser.parse_args()
+
+    with h5py.File(args.reference, 'r') as f:
+        reference = np.array(f['emb'])
+    with h5py.File(args.approximate, 'r') as f:
+        approximate = np.array(f['emb'])
+        is_key = np.array(f['is_key']) if 'is_key' in f else None
+    if reference.shape != approximate.shape:
+        parser.error('The embeddings are of different shapes: {} and {}.'.format(
+            reference.shape, approximate.shape))
+
+    # Put the errors in relation to typical distances between embeddings.
+    rng = np.random.RandomState(0)
+    a, b = rng.randint(len(reference), size=(2, min(len(reference), 65536)))
+    typical = np.median(pair_distances(reference[a], reference[b], args.metric))
+
+    errors = pair_distances(reference, approximate, args.metric)
+    print('Typical (median) distance between embeddings: {:.4f}'.format(typical))
+    subsets = [('all', np.ones(len(errors), dtype=bool))]
+    if is_key is not None:
+        print('Embedded {} of {} ({:.1%}), {:.2f}x fewer network calls.'.format(
+            np.sum(is_key), len(is_key), np.mean(is_key),
+            len(is_key) / max(np.sum(is_key), 1)))
+        subsets.append(('skipped', np.logical_not(is_key)))
+    for name, subset in subsets:
+        e = errors[subset]
+        if len(e) == 0:
+            continue
+        print('Error ({}, {}): mean {:.4f} | median {:.4f} | 95% {:.4f} | '
+              'max {:.4f} | mean relative {:.2%}'.format(
+                  name, len(e), np.mean(e), np.median(e),
+                  np.percentile(e, 95), np.max(e), np.mean(e) / typical))
+
+    if args.detections_path is None:
+        return
+
+    # Among the detections of the same camera and frame, is the approximate
+    # embedding still closest to its own exact one?
+    detections = sio.loadmat(args.detections_path)['detections']
+    _, group = np.unique(detections[:, :2], axis=0, return_inverse=True)
+    group = group.ravel()
+    order = np.argsort(group, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(np.r_[-1, group[order], -1]))
+    confused = np.zeros(len(errors), dtype=bool)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        members = order[lo:hi]
+        if len(members) > 1:
+            dists = metrics.cdist(
+                approximate[members], reference[members], args.metric)
+            confused[members] = np.argmin(dists, axis=1) != np.arange(len(members))
+    for name, subset in subsets:
+        print('Closer to another detection of the same frame ({}): {:.3%}'.format(
+            name, np.mean(confused[subset])))
+
+
+if __name__ == '__main__':
+    main()
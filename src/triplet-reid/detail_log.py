@@ -0,0 +1,178 @@
+""" An append-only, chunked and compressed format for detailed training logs.
+
+A log is a folder containing:
+- `fids.txt`, the string table: one FID per line, referred to by line number.
+- `chunk_{first:08d}_{last:08d}.npz`, one compressed file per chunk of
+  consecutive iterations, each holding the arrays
+    `iterations` (N,), `fids` (N, B) indexing into the string table,
+    `losses` (N, B) and `embeddings` (N, B, D), possibly in float16.
+
+Since the iteration range of a chunk is encoded in its filename, reading an
+iteration range only ever opens the chunks overlapping that range.
+"""
+
+import glob
+import os
+import re
+
+import numpy as np
+
+
+_CHUNK_RE = re.compile(r'chunk_(\d+)_(\d+)\.npz$')
+
+
+def _list_chunks(root):
+    """ Returns a sorted list of (first, last, filename) of all chunks. """
+    chunks = []
+    for filename in glob.glob(os.path.join(root, 'chunk_*.npz')):
+        match = _CHUNK_RE.search(filename)
+        if match is not None:
+            chunks.append((int(match.group(1)), int(match.group(2)), filename))
+    return sorted(chunks)
+
+
+def _load_fid_table(root):
+    try:
+        with open(os.path.join(root, 'fids.txt'), 'r') as f:
+            return [line.rstrip('\n') for line in f]
+    except IOError:
+        return []
+
+
+def _save_chunk(root, data):
+    its = data['iterations']
+    filename = os.path.join(
+        root, 'chunk_{:08d}_{:08d}.npz'.format(its[0], its[-1]))
+    # Write to a temporary file first, such that an interruption never leaves
+    # a half-written chunk behind.
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **data)
+    os.replace(filename + '.tmp', filename)
+
+
+class DetailLogWriter(object):
+    """ Appends per-iteration training details to a log folder.
+
+    Args:
+        root (string): The log folder, created if it doesn't exist yet.
+        fids (iterable of strings): All FIDs that may be logged. They are added
+            to the string table if not already present.
+        start_iteration (int): The first iteration which will be logged. When
+            resuming, anything logged at or after this iteration is discarded,
+            as it will be re-done.
+        chunk_size (int): How many iterations to collect in one chunk.
+        float16 (bool): Whether to store the embeddings as float16, halving
+            their size for a negligible loss in precision.
+    """
+    def __init__(self, root, fids, start_iteration=0, chunk_size=100,
+                 float16=False):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.emb_dtype = np.float16 if float16 else np.float32
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+        # Extend the string table by any FIDs it doesn't know yet.
+        table = _load_fid_table(root)
+        self.fid_index = {fid: i for i, fid in enumerate(table)}
+        new_fids = [fid for fid in fids if fid not in self.fid_index]
+        for fid in new_fids:
+            self.fid_index[fid] = len(self.fid_index)
+        if new_fids:
+            with open(os.path.join(root, 'fids.txt'), 'a') as f:
+                f.writelines(fid + '\n' for fid in new_fids)
+
+        # Cut off everything that will be logged again.
+        for first, last, filename in _list_chunks(root):
+            if first >= start_iteration:
+                os.remove(filename)
+            elif last >= start_iteration:
+                with np.load(filename) as chunk:
+                    keep = chunk['iterations'] < start_iteration
+                    data = {k: chunk[k][keep] for k in chunk.files}
+                os.remove(filename)
+                if np.any(keep):
+                    _save_chunk(root, data)
+
+        self._buffer = []
+
+    def append(self, iteration, embeddings, losses, fids):
+        """ Logs one iteration, `fids` may be either bytes or strings. """
+        fid_idxs = np.array([
+            self.fid_index[fid.decode() if isinstance(fid, bytes) else fid]
+            for fid in fids], np.int32)
+        self._buffer.append((iteration, fid_idxs, np.asarray(losses, np.float32),
+                             np.asarray(embeddings, self.emb_dtype)))
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ Writes all buffered iterations as one chunk. """
+        if not self._buffer:
+            return
+        iterations, fid_idxs, losses, embeddings = zip(*self._buffer)
+        _save_chunk(self.root, {
+            'iterations': np.array(iterations, np.int64),
+            'fids': np.stack(fid_idxs),
+            'losses': np.stack(losses),
+            'embeddings': np.stack(embeddings),
+        })
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.close()
+
+
+class DetailLogReader(object):
+    """ Reads iteration ranges from a log written by `DetailLogWriter`. """
+    def __init__(self, root):
+        self.root = root
+        self.fid_table = np.array(_load_fid_table(root))
+        self.chunks = _list_chunks(root)
+
+    def iteration_range(self):
+        """ Returns the (first, last) logged iteration, or None if empty. """
+        if not self.chunks:
+            return None
+        return self.chunks[0][0], self.chunks[-1][1]
+
+    def read(self, start=None, stop=None, fields=None):
+        """ Loads all logged iterations `i` with `start <= i < stop`.
+
+        Args:
+            start, stop (int or None): The half-open iteration range, with
+                `None` meaning unbounded on that side.
+            fields (list of strings or None): Which of `'embeddings'`,
+                `'losses'` and `'fids'` to load, defaults to all of them.
+
+        Returns:
+            A dict with the `iterations` and all requested `fields`, each
+            concatenated along the first axis. `fids` are returned as strings.
+        """
+        if fields is None:
+            fields = ['embeddings', 'losses', 'fids']
+        start = -np.inf if start is None else start
+        stop = np.inf if stop is None else stop
+
+        parts = {field: [] for field in ['iterations'] + list(fields)}
+        for first, last, filename in self.chunks:
+            if last < start or first >= stop:
+                continue
+            with np.load(filename) as chunk:
+                iterations = chunk['iterations']
+                keep = (start <= iterations) & (iterations < stop)
+                for field in parts:
+                    parts[field].append(chunk[field][keep])
+
+        result = {}
+        for field, arrays in parts.items():
+            result[field] = np.concatenate(arrays) if arrays else np.empty(0)
+        if 'fids' in result and len(result['fids']):
+            result['fids'] = self.fid_table[result['fids']]
+        return result
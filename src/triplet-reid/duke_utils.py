@@ -2,11 +2,14 @@ import cv2
 import math
 import numpy as np
 import csv
+import json
 import os
 import scipy.io as sio
 import h5py
 import tensorflow as tf
 
+from profiling import StageTimer
+
 class DukeVideoReader:
 # Use
 # reader = DukeVideoReader('g:/dukemtmc/')
@@ -14,7 +17,11 @@ class DukeVideoReader:
 # frame = 360720
 # img = reader.getFrame(camera, frame)
 
-    def __init__(self, dataset_path):
+    # Pass a `profiling.StageTimer` as `timer` to find out how long opening,
+    # seeking (including decoding the frames skipped) and decoding take.
+
+    def __init__(self, dataset_path, timer=None):
+        self.timer = timer if timer is not None else StageTimer()
         self.NumCameras = 8
         self.NumFrames = [359580, 360720, 355380, 374850, 366390, 344400, 337680, 353220]
         self.PartMaxFrame = 38370
@@ -28,6 +35,16 @@ class DukeVideoReader:
         self.PartFrames.append([38400, 38370, 38370, 38370, 38400, 38400, 38370, 38370, 37350, 0])
         self.PartFrames.append([38790, 38640, 38460, 38610, 38760, 38760, 38790, 38490, 28380, 0])
         self.PartFrames.append([38370, 38370, 38370, 38370, 38370, 38370, 38370, 38370, 38370, 7890])
+        # Other videos in the same layout, such as the synthetic ones of
+        # `benchmarks/synthetic_duke.py`, list the frame counts of each
+        # camera's parts in `videos/part_frames.json` instead.
+        layout_file = os.path.join(dataset_path, 'videos', 'part_frames.json')
+        if os.path.isfile(layout_file):
+            with open(layout_file, 'r') as f:
+                self.PartFrames = json.load(f)
+            self.NumCameras = len(self.PartFrames)
+            self.NumFrames = [sum(parts) for parts in self.PartFrames]
+            self.MaxPart = [len(parts) - 1 for parts in self.PartFrames]
         self.DatasetPath = dataset_path
         self.CurrentCamera = 1
         self.CurrentPart = 0
@@ -43,7 +60,7 @@ class DukeVideoReader:
         # Cam 4 77311
         #Coompute current frame and in which video part the frame belongs
         ksum = 0
-        for k in range(10):
+        for k in range(len(self.PartFrames[iCam-1])):
             ksumprev = ksum
             ksum += self.PartFrames[iCam-1][k]
             if iFrame <= ksum:
@@ -55,32 +72,37 @@ class DukeVideoReader:
             self.CurrentCamera = iCam
             self.CurrentPart = iPart
             self.PrevFrame = -1
-            self.Video = cv2.VideoCapture('{:s}videos/camera{:d}/{:05d}.MTS'.format(self.DatasetPath, self.CurrentCamera, self.CurrentPart), cv2.CAP_FFMPEG)
+            with self.timer('open'):
+                self.Video = cv2.VideoCapture('{:s}videos/camera{:d}/{:05d}.MTS'.format(self.DatasetPath, self.CurrentCamera, self.CurrentPart), cv2.CAP_FFMPEG)
         # Update time only if reading non-consecutive frames
         if not currentFrame == self.PrevFrame + 1:
+            with self.timer('seek'):
             
-            #if iCam == self.PrevCamera and iPart == self.PrevPart and currentFrame - self.PrevFrame < 30:
-            #    # Skip consecutive images if less than 30 frames difference
-            #    back_frame = max(self.PrevFrame, 0)
-            #else:
-            #    # Seek, but make sure a keyframe is read before decoding
-            back_frame = max(currentFrame - 31, 0) # Keyframes every 30 frames
-            #print('back_frame set to: {0}'.format(back_frame))
-            self.Video.set(cv2.CAP_PROP_POS_FRAMES, back_frame)
-            if not self.Video.get(cv2.CAP_PROP_POS_FRAMES) == back_frame:
-                print('Warning: OpenCV has failed to set back_frame to {0}. OpenCV value is {1}. Target value is {2}'.format(back_frame, self.Video.get(cv2.CAP_PROP_POS_FRAMES), currentFrame))
+                #if iCam == self.PrevCamera and iPart == self.PrevPart and currentFrame - self.PrevFrame < 30:
+                #    # Skip consecutive images if less than 30 frames difference
+                #    back_frame = max(self.PrevFrame, 0)
+                #else:
+                #    # Seek, but make sure a keyframe is read before decoding
+                back_frame = max(currentFrame - 31, 0) # Keyframes every 30 frames
+                #print('back_frame set to: {0}'.format(back_frame))
+                self.Video.set(cv2.CAP_PROP_POS_FRAMES, back_frame)
+                if not self.Video.get(cv2.CAP_PROP_POS_FRAMES) == back_frame:
+                    print('Warning: OpenCV has failed to set back_frame to {0}. OpenCV value is {1}. Target value is {2}'.format(back_frame, self.Video.get(cv2.CAP_PROP_POS_FRAMES), currentFrame))
           
-            back_frame = self.Video.get(cv2.CAP_PROP_POS_FRAMES)
-            #print('back_frame is: {0}'.format(back_frame))
-            while back_frame < currentFrame:
-                self.Video.read()
-                back_frame += 1
+                back_frame = self.Video.get(cv2.CAP_PROP_POS_FRAMES)
+                #print('back_frame is: {0}'.format(back_frame))
+                while back_frame < currentFrame:
+                    self.Video.read()
+                    self.timer.count('frames_skipped')
+                    back_frame += 1
         #print('currentFrame: {0}'.format(currentFrame))
         #print('current position: {0}'.format(self.Video.get(cv2.CAP_PROP_POS_FRAMES)))
         assert self.Video.get(cv2.CAP_PROP_POS_FRAMES) == currentFrame, 'Frame position error'
-        result, img = self.Video.read()
+        with self.timer('decode'):
+            result, img = self.Video.read()
         if result is False:
             print('-Could not read frame, trying again')
+            self.timer.count('read_retries')
             back_frame = max(currentFrame - 61, 0)
             self.Video.set(cv2.CAP_PROP_POS_FRAMES, back_frame)
             if not self.Video.get(cv2.CAP_PROP_POS_FRAMES) == back_frame:
@@ -89,6 +111,7 @@ class DukeVideoReader:
             #print('-back_frame is: {0}'.format(back_frame))
             while back_frame < currentFrame:
                 self.Video.read()
+                self.timer.count('frames_skipped')
                 back_frame += 1
             result, img = self.Video.read()
 
@@ -231,23 +254,38 @@ def convert_img(img):
     img = img - 0.5
     return img
 
-def detections_generator(base_path, detections, height, width):
+def detections_generator(base_path, detections, height, width, order=None,
+                         timer=None, crop_tiny=False):
+    # Yields the snapshots of the detections, in the given `order` if any.
+    # Reading them sorted by camera and frame avoids seeking in the videos.
+    # The time spent on each step goes into `timer`, a `StageTimer`, if any.
+    # Boxes under 20 pixels become black snapshots, unless `crop_tiny`.
 
-    reader = DukeVideoReader(base_path)
+    timer = timer if timer is not None else StageTimer()
+    reader = DukeVideoReader(base_path, timer)
+    if order is None:
+        order = range(detections.shape[0])
+    prev = None
 
-    for ind in range(detections.shape[0]):
-        print('reading detection {0}/{1}'.format(ind+1,detections.shape[0]))
+    for ind in order:
         camera = int(detections[ind][0])
         frame  = int(detections[ind][1])
         box    = detections[ind][2:6]
-        img = reader.getFrame(camera, frame)
-     
-        if box[2] < 20 or box[3] < 20:
+        # Decode each frame only once, however many detections it has.
+        if (camera, frame) != prev:
+            img = reader.getFrame(camera, frame)
+            prev = (camera, frame)
+
+        if not crop_tiny and (box[2] < 20 or box[3] < 20):
             snapshot = np.zeros((height,width,3))
+            timer.count('tiny_boxes')
         else:
-            snapshot = get_bb(img, box)
-            snapshot = cv2.resize(snapshot,(width, height))  
+            with timer('crop'):
+                snapshot = get_bb(img, box)
+            with timer('resize'):
+                snapshot = cv2.resize(snapshot,(width, height))  
 
+        timer.count('detections_read')
         yield snapshot
 
 def detections_generator_from_openpose(iCam, base_path, detections_path):
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from importlib import import_module
 from itertools import count
 import os
 
@@ -10,7 +9,10 @@ import numpy as np
 import tensorflow as tf
 
 from aggregators import AGGREGATORS
+import augmentation
 import common
+import inference
+import shards
 
 parser = ArgumentParser(description='Embed a dataset using a trained network.')
 
@@ -30,18 +32,46 @@ parser.add_argument(
     '--image_root', type=common.readable_directory,
     help='Path that will be pre-pended to the filenames in the train_set csv.')
 
+parser.add_argument(
+    '--shards', default=None,
+    help='Index of TFRecord shards of the dataset written by `make_shards.py`. '
+         'If provided, the images are streamed from these instead of read '
+         'from the `image_root` one by one.')
+
 parser.add_argument(
     '--checkpoint', default=None,
     help='Name of checkpoint file of the trained network within the experiment '
          'root. Uses the last checkpoint if not provided.')
 
+parser.add_argument(
+    '--frozen_graph', default=None,
+    help='Name of a frozen graph written by `export_frozen.py` within the '
+         'experiment root. If provided, it is used instead of building the '
+         'network and restoring `--checkpoint`, which starts up much faster. '
+         'A `.tflite` model written by `quantize_frozen.py` is run on the CPU '
+         'by the TFLite interpreter.')
+
+parser.add_argument(
+    '--extra_model', action='append', nargs='+', default=[],
+    metavar=('EXPERIMENT_ROOT', 'CHECKPOINT'),
+    help='Another trained network to embed the very same images with, given '
+         'by its experiment root and optionally the name of a checkpoint '
+         'within it (the last one if not provided). May be repeated. The '
+         'networks are built side by side, such that the images are only '
+         'loaded and augmented once. The embeddings of the k-th extra model '
+         'are stored in the group `modelk` of the output file.')
+
 parser.add_argument(
     '--loading_threads', default=8, type=common.positive_int,
     help='Number of threads used for parallel data loading.')
 
 parser.add_argument(
     '--batch_size', default=256, type=common.positive_int,
-    help='Batch size used during evaluation, adapt based on available memory.')
+    help='Number of images the network embeds at once, adapt based on '
+         'available memory. With test-time augmentation, this counts the '
+         'augmented images, i.e. each batch holds `batch_size` divided by the '
+         'number of augmentations (e.g. 10 with flips and five crops) of the '
+         'input images, but at least one.')
 
 parser.add_argument(
     '--filename', default=None,
@@ -67,34 +97,16 @@ parser.add_argument(
     help='The type of aggregation used to combine the different embeddings '
          'after augmentation.')
 
+parser.add_argument(
+    '--no_emb_aug', action='store_true', default=False,
+    help='Don\'t store the embeddings of the individual augmented variants '
+         '(`emb_aug`), only the aggregated ones.')
+
 parser.add_argument(
     '--quiet', action='store_true', default=False,
     help='Don\'t be so verbose.')
 
 
-def flip_augment(image, fid, pid):
-    """ Returns both the original and the horizontal flip of an image. """
-    images = tf.stack([image, tf.reverse(image, [1])])
-    return images, tf.stack([fid]*2), tf.stack([pid]*2)
-
-
-def five_crops(image, crop_size):
-    """ Returns the central and four corner crops of `crop_size` from `image`. """
-    image_size = tf.shape(image)[:2]
-    crop_margin = tf.subtract(image_size, crop_size)
-    assert_size = tf.assert_non_negative(
-        crop_margin, message='Crop size must be smaller or equal to the image size.')
-    with tf.control_dependencies([assert_size]):
-        top_left = tf.floor_div(crop_margin, 2)
-        bottom_right = tf.add(top_left, crop_size)
-    center       = image[top_left[0]:bottom_right[0], top_left[1]:bottom_right[1]]
-    top_left     = image[:-crop_margin[0], :-crop_margin[1]]
-    top_right    = image[:-crop_margin[0], crop_margin[1]:]
-    bottom_left  = image[crop_margin[0]:, :-crop_margin[1]]
-    bottom_right = image[crop_margin[0]:, crop_margin[1]:]
-    return center, top_left, top_right, bottom_left, bottom_right
-
-
 def main():
     # Verify that parameters are set correctly.
     args = parser.parse_args()
@@ -145,103 +157,131 @@ def main():
     # Load the data from the CSV file.
     print(args.dataset)
     print(args.image_root)
-    _, data_fids = common.load_dataset(args.dataset, args.image_root)
+    _, data_fids = common.load_dataset(
+        args.dataset, None if args.shards else args.image_root)
 
     net_input_size = (args.net_input_height, args.net_input_width)
     pre_crop_size = (args.pre_crop_height, args.pre_crop_width)
-
-    # Setup a tf Dataset containing all images.
-    dataset = tf.data.Dataset.from_tensor_slices(data_fids)
-
-    # Convert filenames to actual image tensors.
-    dataset = dataset.map(
-        lambda fid: common.fid_to_image(
-            fid, tf.constant('dummy'), image_root=args.image_root,
-            image_size=pre_crop_size if args.crop_augment else net_input_size),
-        num_parallel_calls=args.loading_threads)
-
-    # Augment the data if specified by the arguments.
-    # `modifiers` is a list of strings that keeps track of which augmentations
-    # have been applied, so that a human can understand it later on.
-    modifiers = ['original']
-    if args.flip_augment:
-        dataset = dataset.map(flip_augment)
-        dataset = dataset.apply(tf.contrib.data.unbatch())
-        modifiers = [o + m for m in ['', '_flip'] for o in modifiers]
-
-    if args.crop_augment == 'center':
-        dataset = dataset.map(lambda im, fid, pid:
-            (five_crops(im, net_input_size)[0], fid, pid))
-        modifiers = [o + '_center' for o in modifiers]
-    elif args.crop_augment == 'five':
-        dataset = dataset.map(lambda im, fid, pid: (
-            tf.stack(five_crops(im, net_input_size)),
-            tf.stack([fid]*5),
-            tf.stack([pid]*5)))
-        dataset = dataset.apply(tf.contrib.data.unbatch())
-        modifiers = [o + m for o in modifiers for m in [
-            '_center', '_top_left', '_top_right', '_bottom_left', '_bottom_right']]
-    elif args.crop_augment == 'avgpool':
-        modifiers = [o + '_avgpool' for o in modifiers]
+    image_size = pre_crop_size if args.crop_augment else net_input_size
+
+    if args.shards:
+        # The shards hold the rows of the dataset in its order, so stream them.
+        shard_fids = shards.load_index(args.shards)['fids']
+        if not np.array_equal(shard_fids, data_fids):
+            raise IOError('The shards of `{}` do not hold the dataset `{}`.'
+                          .format(args.shards, args.dataset))
+        dataset = shards.dataset(args.shards, args.loading_threads)
+        dataset = dataset.map(
+            lambda image, fid, pid: (
+                common.decode_image(image, image_size), fid, pid),
+            num_parallel_calls=args.loading_threads)
     else:
-        modifiers = [o + '_resize' for o in modifiers]
-
-    # Group it back into PK batches.
-    dataset = dataset.batch(args.batch_size)
+        # Setup a tf Dataset containing all images.
+        dataset = tf.data.Dataset.from_tensor_slices(data_fids)
+
+        # Convert filenames to actual image tensors.
+        dataset = dataset.map(
+            lambda fid: common.fid_to_image(
+                fid, tf.constant('dummy'), image_root=args.image_root,
+                image_size=image_size),
+            num_parallel_calls=args.loading_threads)
+
+    # Batch it up, the augmentation happens batch-wise in the graph, so only
+    # take as many images as fit into the batch size after augmenting them.
+    batch_size = max(1, args.batch_size // augmentation.num_augmentations(
+        args.flip_augment, args.crop_augment))
+    dataset = dataset.batch(batch_size)
 
     # Overlap producing and consuming.
     dataset = dataset.prefetch(1)
 
     images, _, _ = dataset.make_one_shot_iterator().get_next()
 
-    # Create the model and an embedding head.
-    model = import_module('nets.' + args.model_name)
-    head = import_module('heads.' + args.head_name)
-
-    endpoints, body_prefix = model.endpoints(images, is_training=False)
-    with tf.name_scope('head'):
-        endpoints = head.head(endpoints, args.embedding_dim, is_training=False)
+    # Augment the data if specified by the arguments.
+    # `modifiers` is a list of strings that keeps track of which augmentations
+    # have been applied, so that a human can understand it later on.
+    images, modifiers = augmentation.augment(
+        images, args.flip_augment, args.crop_augment, net_input_size)
+
+    if args.frozen_graph is None:
+        # Create the model and an embedding head.
+        emb = inference.embedding_network(
+            images, args.model_name, args.head_name, args.embedding_dim)
+        restores = [(tf.train.Saver(), inference.checkpoint_path(
+            args.experiment_root, args.checkpoint))]
+    else:
+        restores = []
+        emb = inference.import_frozen(
+            os.path.join(args.experiment_root, args.frozen_graph), images)
+
+    # `outputs` lists, per model, the prefix of the HDF5 datasets to write
+    # into, and the embeddings and those of the individual variants.
+    outputs = [('', args.embedding_dim) + augmentation.aggregate(
+        emb, len(modifiers), args.aggregator)]
+
+    # Create the extra models, each in its own scope, on the same images.
+    extra_checkpoints = {}
+    for i, (experiment_root, *checkpoint) in enumerate(args.extra_model, 1):
+        if len(checkpoint) > 1:
+            parser.error('--extra_model takes an experiment root and at most '
+                         'one checkpoint.')
+        extra_args = inference.experiment_args(experiment_root)
+        if (extra_args['net_input_height'], extra_args['net_input_width']) != (
+                net_input_size):
+            parser.error('The extra model in {} has a different input size.'
+                         .format(experiment_root))
+        scope = 'model{}'.format(i)
+        with tf.variable_scope(scope):
+            emb = inference.embedding_network(
+                images, extra_args['model_name'], extra_args['head_name'],
+                extra_args['embedding_dim'])
+        outputs.append((scope + '/', extra_args['embedding_dim']) +
+                       augmentation.aggregate(
+                           emb, len(modifiers), args.aggregator))
+        extra_checkpoints[scope] = inference.checkpoint_path(
+            experiment_root, *checkpoint)
+        restores.append((common.scoped_saver(scope), extra_checkpoints[scope]))
 
     with h5py.File(args.filename, 'w') as f_out, tf.Session() as sess:
-        # Initialize the network/load the checkpoint.
-        if args.checkpoint is None:
-            checkpoint = tf.train.latest_checkpoint(args.experiment_root)
-        else:
-            checkpoint = os.path.join(args.experiment_root, args.checkpoint)
-        if not args.quiet:
-            print('Restoring from checkpoint: {}'.format(checkpoint))
-        tf.train.Saver().restore(sess, checkpoint)
-
-        # Go ahead and embed the whole dataset, with all augmented versions too.
-        emb_storage = np.zeros(
-            (len(data_fids) * len(modifiers), args.embedding_dim), np.float32)
-        for start_idx in count(step=args.batch_size):
+        # Initialize the networks/load the checkpoints, unless frozen.
+        for saver, checkpoint in restores:
+            if not args.quiet:
+                print('Restoring from checkpoint: {}'.format(checkpoint))
+            saver.restore(sess, checkpoint)
+
+        # Go ahead and embed the whole dataset with all models, straight into
+        # the output file.
+        fetches, datasets = {}, {}
+        for prefix, embedding_dim, emb, emb_aug in outputs:
+            name = prefix + 'emb'
+            fetches[name] = emb
+            datasets[name] = f_out.create_dataset(
+                name, (len(data_fids), embedding_dim), np.float32)
+            if len(modifiers) > 1 and not args.no_emb_aug:
+                # Store the embedding of all individual variants too.
+                name = prefix + 'emb_aug'
+                fetches[name] = emb_aug
+                datasets[name] = f_out.create_dataset(
+                    name, (len(modifiers), len(data_fids), embedding_dim),
+                    np.float32)
+        for scope, checkpoint in extra_checkpoints.items():
+            f_out[scope].attrs['checkpoint'] = checkpoint
+
+        for start_idx in count(step=batch_size):
             try:
-                emb = sess.run(endpoints['emb'])
-                print('\rEmbedded batch {}-{}/{}'.format(
-                        start_idx, start_idx + len(emb), len(emb_storage)),
-                    flush=True, end='')
-                emb_storage[start_idx:start_idx + len(emb)] = emb
+                result = sess.run(fetches)
             except tf.errors.OutOfRangeError:
                 break  # This just indicates the end of the dataset.
-
+            end_idx = start_idx + len(result['emb'])
+            print('\rEmbedded batch {}-{}/{}'.format(
+                    start_idx, end_idx, len(data_fids)),
+                flush=True, end='')
+            for name, values in result.items():
+                if name.endswith('emb_aug'):
+                    datasets[name][:, start_idx:end_idx] = values
+                else:
+                    datasets[name][start_idx:end_idx] = values
         print()
-        if not args.quiet:
-            print("Done with embedding, aggregating augmentations...", flush=True)
-
-        if len(modifiers) > 1:
-            # Pull out the augmentations into a separate first dimension.
-            emb_storage = emb_storage.reshape(len(data_fids), len(modifiers), -1)
-            emb_storage = emb_storage.transpose((1,0,2))  # (Aug,FID,128D)
-
-            # Store the embedding of all individual variants too.
-            emb_dataset = f_out.create_dataset('emb_aug', data=emb_storage)
-
-            # Aggregate according to the specified parameter.
-            emb_storage = AGGREGATORS[args.aggregator](emb_storage)
-
-        # Store the final embeddings.
-        emb_dataset = f_out.create_dataset('emb', data=emb_storage)
 
         # Store information about the produced augmentation and in case no crop
         # augmentation was used, if the images are resized or avg pooled.
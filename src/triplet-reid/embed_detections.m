@@ -1,6 +1,9 @@
-function features = embed_detections(opts, detections)
+function features = embed_detections(opts, detections, features_filename)
 % Computes feature embeddings for given detections
 % Detections are in format [cam, frame, left, top, width, height]
+% If features_filename is given, the features of the (single camera's)
+% detections are written there frame-indexed instead of being returned,
+% see feature_store.py
 net = opts.net;
 
 % Detection images read in python and embedded 
@@ -8,7 +11,10 @@ cur_dir = pwd;
 cd src/triplet-reid
 
 % Temporary file to store the bounding box coordinates
-features_filename = fullfile(net.experiment_root, 'temp_features.h5');
+keep_features = nargin > 2;
+if ~keep_features
+    features_filename = fullfile(net.experiment_root, 'temp_features.h5');
+end
 detections_filename = fullfile(net.experiment_root, 'temp_detections.mat');
 save(detections_filename, 'detections');
 
@@ -17,10 +23,16 @@ command = strcat(opts.python3, ' embed_detections.py' , ...
     sprintf(' --dataset_path %s', opts.dataset_path), ...
     sprintf(' --detections_path %s', detections_filename), ...
     sprintf(' --filename %s', features_filename));
+if keep_features
+    command = strcat(command, ' --frame_index');
+end
 system(command);
 
 % Load features / delete temp files
-features = h5read(features_filename, '/emb');
+features = [];
+if ~keep_features
+    features = h5read(features_filename, '/emb');
+    delete(features_filename);
+end
 delete(detections_filename);
-delete(features_filename);
-cd(cur_dir)
\ No newline at end of file
+cd(cur_dir)
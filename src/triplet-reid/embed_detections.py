@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from importlib import import_module
 from itertools import count
 import os
+import time
 
 import h5py
 import json
@@ -10,10 +10,15 @@ import numpy as np
 import tensorflow as tf
 
 from aggregators import AGGREGATORS
+import augmentation
 import common
+import inference
 from duke_utils import *
 import scipy.io as sio
 import functools
+import feature_store
+import profiling
+import temporal_reuse
 
 parser = ArgumentParser(description='Embed a dataset using a trained network.')
 
@@ -42,13 +47,35 @@ parser.add_argument(
     help='Name of checkpoint file of the trained network within the experiment '
          'root. Uses the last checkpoint if not provided.')
 
+parser.add_argument(
+    '--frozen_graph', default=None,
+    help='Name of a frozen graph written by `export_frozen.py` within the '
+         'experiment root. If provided, it is used instead of building the '
+         'network and restoring `--checkpoint`, which starts up much faster. '
+         'A `.tflite` model written by `quantize_frozen.py` is run on the CPU '
+         'by the TFLite interpreter.')
+
+parser.add_argument(
+    '--extra_model', action='append', nargs='+', default=[],
+    metavar=('EXPERIMENT_ROOT', 'CHECKPOINT'),
+    help='Another trained network to embed the very same images with, given '
+         'by its experiment root and optionally the name of a checkpoint '
+         'within it (the last one if not provided). May be repeated. The '
+         'networks are built side by side, such that the images are only '
+         'loaded and augmented once. The embeddings of the k-th extra model '
+         'are stored in the group `modelk` of the output file.')
+
 parser.add_argument(
     '--loading_threads', default=8, type=common.positive_int,
     help='Number of threads used for parallel data loading.')
 
 parser.add_argument(
     '--batch_size', default=256, type=common.positive_int,
-    help='Batch size used during evaluation, adapt based on available memory.')
+    help='Number of images the network embeds at once, adapt based on '
+         'available memory. With test-time augmentation, this counts the '
+         'augmented images, i.e. each batch holds `batch_size` divided by the '
+         'number of augmentations (e.g. 10 with flips and five crops) of the '
+         'input images, but at least one.')
 
 
 
@@ -71,33 +98,83 @@ parser.add_argument(
          'after augmentation.')
 
 parser.add_argument(
-    '--quiet', action='store_true', default=False,
-    help='Don\'t be so verbose.')
+    '--no_emb_aug', action='store_true', default=False,
+    help='Don\'t store the embeddings of the individual augmented variants '
+         '(`emb_aug`), only the aggregated ones.')
+
+parser.add_argument(
+    '--frame_index', action='store_true', default=False,
+    help='Store the embeddings sorted by frame, chunked by frame ranges, along '
+         'with an index of the rows of each frame, such that windows of '
+         'frames can be read on their own, see `feature_store.py`. Needs the '
+         'detections of a single camera.')
+
+parser.add_argument(
+    '--chunk_frames', default=500, type=common.positive_int,
+    help='About how many frames each chunk of a `--frame_index` file spans.')
 
+parser.add_argument(
+    '--float16', action='store_true', default=False,
+    help='Store the embeddings as float16, halving the file size. Note that '
+         'MATLAB\'s `h5read` can\'t read these.')
 
+parser.add_argument(
+    '--trajectory_column', default=None, type=int,
+    help='Zero-based column of the detections holding a trajectory ID, e.g. 6 '
+         'for rows of [camera, frame, left, top, width, height, trajectory, '
+         'k]. If provided, the mean embedding of each trajectory is stored as '
+         '`trajectory_emb` too, along with the sorted `trajectory_ids`. Boxes '
+         'under 20 pixels are then cropped like all others, instead of being '
+         'embedded as a black image.')
 
+parser.add_argument(
+    '--reuse_every', default=None, type=common.positive_int,
+    help='Approximate mode: link detections across adjacent frames of a '
+         'camera by their boxes, and only embed every Nth one of each chain, '
+         'plus those whose box or image changed too much since. All others '
+         'are filled in from these. Off when not provided.')
+
+parser.add_argument(
+    '--reuse_link_iou', default=0.5, type=float,
+    help='How much the boxes of detections in adjacent frames need to overlap '
+         'to be linked.')
 
-def flip_augment(image, fid, pid):
-    """ Returns both the original and the horizontal flip of an image. """
-    images = tf.stack([image, tf.reverse(image, [1])])
-    return images, tf.stack([fid]*2), tf.stack([pid]*2)
+parser.add_argument(
+    '--reuse_min_iou', default=0.7, type=float,
+    help='Embed a detection anew if its box overlaps less than this with the '
+         'one of the last embedded detection of its chain.')
 
+parser.add_argument(
+    '--reuse_max_change', default=0.1, type=float,
+    help='Embed a detection anew if its image differs from the one of the '
+         'last embedded detection of its chain by more than this on average, '
+         'relative to the full intensity range.')
 
-def five_crops(image, crop_size):
-    """ Returns the central and four corner crops of `crop_size` from `image`. """
-    image_size = tf.shape(image)[:2]
-    crop_margin = tf.subtract(image_size, crop_size)
-    assert_size = tf.assert_non_negative(
-        crop_margin, message='Crop size must be smaller or equal to the image size.')
-    with tf.control_dependencies([assert_size]):
-        top_left = tf.floor_div(crop_margin, 2)
-        bottom_right = tf.add(top_left, crop_size)
-    center       = image[top_left[0]:bottom_right[0], top_left[1]:bottom_right[1]]
-    top_left     = image[:-crop_margin[0], :-crop_margin[1]]
-    top_right    = image[:-crop_margin[0], crop_margin[1]:]
-    bottom_left  = image[crop_margin[0]:, :-crop_margin[1]]
-    bottom_right = image[crop_margin[0]:, crop_margin[1]:]
-    return center, top_left, top_right, bottom_left, bottom_right
+parser.add_argument(
+    '--reuse_fill', choices=['interpolate', 'copy'], default='interpolate',
+    help='Whether to interpolate the skipped embeddings between the embedded '
+         'ones before and after them, or copy the one before.')
+
+parser.add_argument(
+    '--progress_interval', default=10.0, type=float,
+    help='Print the progress and the time spent in each stage at most every '
+         'so many seconds. A report of all timings and counts is written '
+         'next to the output file in any case, ending in `_report.json`.')
+
+parser.add_argument(
+    '--quiet', action='store_true', default=False,
+    help='Don\'t be so verbose.')
+
+
+def progress_line(timer, embedded, num_detections, seconds, queue_depth):
+    """ A one-line summary of the progress and the time spent so far. """
+    read = timer.events.get('detections_read', 0)
+    # The reading thread may add stages meanwhile, hence the copy.
+    stages = ' | '.join('{} {:.1f}s'.format(stage, total)
+                        for stage, total in list(timer.totals.items()))
+    return ('Read {}/{} detections ({:.1f}/s), embedded {}, {} queued | {}'
+            .format(read, num_detections, read / max(seconds, 1e-9),
+                    embedded, queue_depth, stages))
 
 
 def main():
@@ -155,93 +232,228 @@ def main():
     matfile = sio.loadmat(args.detections_path)
     detections = matfile['detections']
     num_detections = detections.shape[0]
-
-    # Setup a tf Dataset generator
-    generator = functools.partial(detections_generator, args.dataset_path, detections, net_input_size[0], net_input_size[1])
-    dataset = tf.data.Dataset.from_generator(generator, tf.float32, tf.TensorShape([net_input_size[0], net_input_size[1], 3]))
-    
-    modifiers = ['original']
-    if args.flip_augment:
-        dataset = dataset.map(flip_augment)
-        dataset = dataset.apply(tf.contrib.data.unbatch())
-        modifiers = [o + m for m in ['', '_flip'] for o in modifiers]
-
-    if args.crop_augment == 'center':
-        dataset = dataset.map(lambda im, fid, pid:
-            (five_crops(im, net_input_size)[0], fid, pid))
-        modifiers = [o + '_center' for o in modifiers]
-    elif args.crop_augment == 'five':
-        dataset = dataset.map(lambda im, fid, pid:
-            (tf.stack(five_crops(im, net_input_size)), [fid]*5, [pid]*5))
-        dataset = dataset.apply(tf.contrib.data.unbatch())
-        modifiers = [o + m for o in modifiers for m in [
-            '_center', '_top_left', '_top_right', '_bottom_left', '_bottom_right']]
-    elif args.crop_augment == 'avgpool':
-        modifiers = [o + '_avgpool' for o in modifiers]
-    else:
-        modifiers = [o + '_resize' for o in modifiers]
-    
-
-    # Group it back into PK batches.
-    dataset = dataset.batch(args.batch_size)
+    if args.frame_index and len(np.unique(detections[:, 0])) > 1:
+        parser.error('--frame_index needs the detections of a single camera.')
+
+    # Setup a tf Dataset generator, reading the detections sorted by camera
+    # and frame, such that each video is decoded front to back only once.
+    read_order = np.lexsort((detections[:, 1], detections[:, 0]))
+
+    # The row of the output each detection's embedding is stored in. That's
+    # the read order for a frame index, else the order of the detections.
+    row_of = np.arange(num_detections)
+    if args.frame_index:
+        row_of[read_order] = np.arange(num_detections)
+    image_size = pre_crop_size if args.crop_augment else net_input_size
+    # The time spent in each stage, and counts of what happened, for the
+    # progress and the final report.
+    timer = profiling.StageTimer()
+    start_time = time.time()
+    # The snapshots of trajectories are all averaged, so rather than a black
+    # image, tiny boxes contribute whatever is in them, as they always did.
+    generator = functools.partial(detections_generator, args.dataset_path, detections, image_size[0], image_size[1], read_order, timer,
+                                  crop_tiny=args.trajectory_column is not None)
+    if args.reuse_every is not None:
+        # Only pass on the detections which need to be embedded.
+        predecessor = temporal_reuse.link(detections, args.reuse_link_iou)
+        selector = temporal_reuse.KeySelector(
+            detections, predecessor, args.reuse_every, args.reuse_min_iou,
+            args.reuse_max_change)
+        all_snapshots = generator
+        def generator():
+            for i, snapshot in zip(read_order, all_snapshots()):
+                with timer('select'):
+                    is_key = selector(i, snapshot)
+                if is_key:
+                    yield snapshot
+    # Count what goes into the input pipeline, to tell how far it's ahead.
+    queued_snapshots = generator
+    def generator():
+        for snapshot in queued_snapshots():
+            timer.count('snapshots_queued')
+            yield snapshot
+    dataset = tf.data.Dataset.from_generator(generator, tf.float32, tf.TensorShape([image_size[0], image_size[1], 3]))
+
+    # Batch it up, the augmentation happens batch-wise in the graph, so only
+    # take as many images as fit into the batch size after augmenting them.
+    batch_size = max(1, args.batch_size // augmentation.num_augmentations(
+        args.flip_augment, args.crop_augment))
+    dataset = dataset.batch(batch_size)
 
     # Overlap producing and consuming.
-    dataset = dataset.prefetch(args.batch_size)
+    dataset = dataset.prefetch(batch_size)
     images = dataset.make_one_shot_iterator().get_next()
 
-    # Create the model and an embedding head.
-    model = import_module('nets.' + args.model_name)
-    head = import_module('heads.' + args.head_name)
+    # Augment the data if specified by the arguments.
+    images, modifiers = augmentation.augment(
+        images, args.flip_augment, args.crop_augment, net_input_size)
 
-    endpoints, body_prefix = model.endpoints(images, is_training=False)
-    with tf.name_scope('head'):
-        endpoints = head.head(endpoints, args.embedding_dim, is_training=False)
+    if args.frozen_graph is None:
+        # Create the model and an embedding head.
+        emb = inference.embedding_network(
+            images, args.model_name, args.head_name, args.embedding_dim)
+        restores = [(tf.train.Saver(), inference.checkpoint_path(
+            args.experiment_root, args.checkpoint))]
+    else:
+        restores = []
+        emb = inference.import_frozen(
+            os.path.join(args.experiment_root, args.frozen_graph), images)
+
+    # `outputs` lists, per model, the prefix of the HDF5 datasets to write
+    # into, and the embeddings and those of the individual variants.
+    outputs = [('', args.embedding_dim) + augmentation.aggregate(
+        emb, len(modifiers), args.aggregator)]
+
+    # Create the extra models, each in its own scope, on the same images.
+    extra_checkpoints = {}
+    for i, (experiment_root, *checkpoint) in enumerate(args.extra_model, 1):
+        if len(checkpoint) > 1:
+            parser.error('--extra_model takes an experiment root and at most '
+                         'one checkpoint.')
+        extra_args = inference.experiment_args(experiment_root)
+        if (extra_args['net_input_height'], extra_args['net_input_width']) != (
+                net_input_size):
+            parser.error('The extra model in {} has a different input size.'
+                         .format(experiment_root))
+        scope = 'model{}'.format(i)
+        with tf.variable_scope(scope):
+            emb = inference.embedding_network(
+                images, extra_args['model_name'], extra_args['head_name'],
+                extra_args['embedding_dim'])
+        outputs.append((scope + '/', extra_args['embedding_dim']) +
+                       augmentation.aggregate(
+                           emb, len(modifiers), args.aggregator))
+        extra_checkpoints[scope] = inference.checkpoint_path(
+            experiment_root, *checkpoint)
+        restores.append((common.scoped_saver(scope), extra_checkpoints[scope]))
 
     with h5py.File(args.filename, 'w') as f_out, tf.Session() as sess:
-        # Initialize the network/load the checkpoint.
-        if args.checkpoint is None:
-            checkpoint = tf.train.latest_checkpoint(args.experiment_root)
-        else:
-            checkpoint = os.path.join(args.experiment_root, args.checkpoint)
-        if not args.quiet:
-            print('Restoring from checkpoint: {}'.format(checkpoint))
-        tf.train.Saver().restore(sess, checkpoint)
-
-        # Go ahead and embed the whole dataset, with all augmented versions too.
-        emb_storage = np.zeros(
-            (num_detections * len(modifiers), args.embedding_dim), np.float32)
-        
-        for start_idx in count(step=args.batch_size):
+        # Initialize the networks/load the checkpoints, unless frozen.
+        for saver, checkpoint in restores:
+            if not args.quiet:
+                print('Restoring from checkpoint: {}'.format(checkpoint))
+            saver.restore(sess, checkpoint)
+
+        # Go ahead and embed the whole dataset with all models, straight into
+        # the output file.
+        fetches, datasets = {}, {}
+        dtype = np.float16 if args.float16 else np.float32
+        chunks = None
+        if args.frame_index:
+            chunks = feature_store.chunk_rows(
+                detections[:, 1], args.chunk_frames)
+            feature_store.write_index(
+                f_out, detections[read_order, 1], read_order)
+        for prefix, embedding_dim, emb, emb_aug in outputs:
+            name = prefix + 'emb'
+            fetches[name] = emb
+            datasets[name] = f_out.create_dataset(
+                name, (num_detections, embedding_dim), dtype,
+                chunks=chunks and (chunks, embedding_dim))
+            if len(modifiers) > 1 and not args.no_emb_aug:
+                # Store the embedding of all individual variants too.
+                name = prefix + 'emb_aug'
+                fetches[name] = emb_aug
+                datasets[name] = f_out.create_dataset(
+                    name, (len(modifiers), num_detections, embedding_dim),
+                    dtype, chunks=chunks and (
+                        len(modifiers), chunks, embedding_dim))
+        for scope, checkpoint in extra_checkpoints.items():
+            f_out[scope].attrs['checkpoint'] = checkpoint
+
+        # How many snapshots wait in the input pipeline before each batch.
+        queue_depths = []
+        last_progress = time.time()
+        end_idx = 0
+        for start_idx in count(step=batch_size):
+            queue_depths.append(
+                timer.events.get('snapshots_queued', 0) - start_idx)
+            run_start = time.time()
             try:
-                emb = sess.run(endpoints['emb'])
-                print('\rEmbedded batch {}-{}/{}'.format(
-                        start_idx, start_idx + len(emb), len(emb_storage)),
-                    flush=True, end='')
-                emb_storage[start_idx:start_idx + len(emb)] = emb
+                result = sess.run(fetches)
             except tf.errors.OutOfRangeError:
                 break  # This just indicates the end of the dataset.
-
-        if not args.quiet:
-            print("Done with embedding, aggregating augmentations...", flush=True)
-
-        if len(modifiers) > 1:
-            # Pull out the augmentations into a separate first dimension.
-            emb_storage = emb_storage.reshape(len(data_fids), len(modifiers), -1)
-            emb_storage = emb_storage.transpose((1,0,2))  # (Aug,FID,128D)
-
-            # Store the embedding of all individual variants too.
-            emb_dataset = f_out.create_dataset('emb_aug', data=emb_storage)
-
-            # Aggregate according to the specified parameter.
-            emb_storage = AGGREGATORS[args.aggregator](emb_storage)
-
-        # Store the final embeddings.
-        emb_dataset = f_out.create_dataset('emb', data=emb_storage)
+            timer.add('inference', time.time() - run_start)
+            end_idx = start_idx + len(result['emb'])
+            # Put the embeddings into the rows of their detections.
+            with timer('write'):
+                if args.reuse_every is None:
+                    rows = row_of[read_order[start_idx:end_idx]]
+                else:
+                    rows = row_of[selector.keys[start_idx:end_idx]]
+                sort = np.argsort(rows)
+                rows = rows[sort]
+                for name, values in result.items():
+                    if name.endswith('emb_aug'):
+                        datasets[name][:, rows] = values[:, sort]
+                    else:
+                        datasets[name][rows] = values[sort]
+            if time.time() - last_progress >= args.progress_interval:
+                last_progress = time.time()
+                print(progress_line(timer, end_idx, num_detections,
+                                    last_progress - start_time,
+                                    queue_depths[-1]), flush=True)
+        queue_depths.pop()  # The end of the dataset.
+        print(progress_line(timer, end_idx, num_detections,
+                            time.time() - start_time,
+                            queue_depths[-1] if queue_depths else 0))
+
+        if args.reuse_every is not None:
+            # Fill in the embeddings of all skipped detections.
+            for name, dataset in datasets.items():
+                with timer('fill'):
+                    embs = np.moveaxis(dataset[()], -2, 0)[row_of]
+                    temporal_reuse.fill(
+                        embs, selector.is_key, detections, predecessor,
+                        interpolate=args.reuse_fill == 'interpolate')
+                    dataset[()] = np.moveaxis(
+                        embs[np.argsort(row_of)], 0, -2)
+            f_out.create_dataset('is_key', data=selector.is_key[read_order]
+                                 if args.frame_index else selector.is_key)
+            if not args.quiet:
+                print('Embedded {} of {} detections ({:.1%}).'.format(
+                    len(selector.keys), num_detections,
+                    len(selector.keys) / num_detections))
+
+        if args.trajectory_column is not None:
+            # Average the embeddings of each trajectory.
+            trajectories = detections[:, args.trajectory_column]
+            for prefix, _, _, _ in outputs:
+                with timer('trajectories'):
+                    ids, means = feature_store.trajectory_means(
+                        datasets[prefix + 'emb'][()][row_of], trajectories)
+                    f_out.create_dataset(prefix + 'trajectory_emb', data=means)
+            f_out.create_dataset('trajectory_ids', data=ids)
 
         # Store information about the produced augmentation and in case no crop
         # augmentation was used, if the images are resized or avg pooled.
         f_out.create_dataset('augmentation_types', data=np.asarray(modifiers, dtype='|S'))
 
+    # Report where the time went, next to the embeddings.
+    report = timer.report()
+    report.update({
+        'seconds': time.time() - start_time,
+        'detections': num_detections,
+        'embedded': end_idx,
+        'batches': timer.counts.get('inference', 0),
+        'frames_decoded': timer.counts.get('decode', 0),
+        'frames_skipped': timer.events.get('frames_skipped', 0),
+        'crops': timer.counts.get('crop', 0),
+        # The network waited for input whenever less than a batch was queued.
+        'queue_depth': {
+            'min': int(np.min(queue_depths)) if queue_depths else 0,
+            'mean': float(np.mean(queue_depths)) if queue_depths else 0.0,
+            'max': int(np.max(queue_depths)) if queue_depths else 0,
+            'starved_batches': int(np.sum(
+                np.asarray(queue_depths) < batch_size)),
+        },
+    })
+    report_file = os.path.splitext(args.filename)[0] + '_report.json'
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    if not args.quiet:
+        print('Wrote the timings to {}'.format(report_file))
+
 
 if __name__ == '__main__':
     main()
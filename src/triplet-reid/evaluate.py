@@ -1,23 +1,24 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser, FileType
 from importlib import import_module
-from itertools import count
 import os
 
 import h5py
 import json
 import numpy as np
-from sklearn.metrics import average_precision_score
-import tensorflow as tf
 
 import common
-import loss
+from excluders import EXCLUDER_CHOICES
+import metrics
+from product_quantization import ProductQuantizer
+import reranking
+import result_cache
 
 
 parser = ArgumentParser(description='Evaluate a ReID embedding.')
 
 parser.add_argument(
-    '--excluder', required=True, choices=('market1501', 'diagonal'),
+    '--excluder', required=True, choices=EXCLUDER_CHOICES,
     help='Excluder function to mask certain matches. Especially for multi-'
          'camera datasets, one often excludes pictures of the query person from'
          ' the gallery if it is taken from the same camera. The `diagonal`'
@@ -40,7 +41,12 @@ parser.add_argument(
     help='Path to the h5 file containing the gallery embeddings.')
 
 parser.add_argument(
-    '--metric', required=True, choices=loss.cdist.supported_metrics,
+    '--group', default='/',
+    help='The group within both h5 files holding the embeddings, e.g. '
+         '`model1` for those of the first `--extra_model` of `embed.py`.')
+
+parser.add_argument(
+    '--metric', required=True, choices=metrics.cdist.supported_metrics,
     help='Which metric to use for the distance between embeddings.')
 
 parser.add_argument(
@@ -49,7 +55,52 @@ parser.add_argument(
 
 parser.add_argument(
     '--batch_size', default=256, type=common.positive_int,
-    help='Batch size used during evaluation, adapt based on your memory usage.')
+    help='Number of queries evaluated at once.')
+
+parser.add_argument(
+    '--memory_limit', default=1024, type=common.positive_int,
+    help='Roughly how many MiB the distance computations may use per worker. '
+         'The gallery is processed in tiles as large as this allows.')
+
+parser.add_argument(
+    '--workers', default=1, type=common.positive_int,
+    help='Number of processes to spread the queries over. The results are '
+         'exactly the same for any number of workers.')
+
+parser.add_argument(
+    '--top_k', default=0, type=common.nonnegative_int,
+    help='If positive, also store the FIDs of the `top_k` closest gallery '
+         'images of each query in the json file.')
+
+parser.add_argument(
+    '--cache', default=None,
+    help='Optional name of a file caching everything needed for evaluating the '
+         'same embedding files again, with any excluder or `top_k` up to '
+         '{}. It is rebuilt whenever the embeddings, datasets or metric '
+         'change.'.format(result_cache.MIN_TOP_K))
+
+parser.add_argument(
+    '--rerank', action='store_true', default=False,
+    help='Evaluate k-reciprocal re-ranked distances (Zhong et al., CVPR 2017) '
+         'instead of the plain ones.')
+
+parser.add_argument(
+    '--rerank_k1', default=20, type=common.positive_int,
+    help='Size of the k-reciprocal neighborhoods for re-ranking.')
+
+parser.add_argument(
+    '--rerank_k2', default=6, type=common.positive_int,
+    help='Size of the local query expansion for re-ranking, 1 disables it.')
+
+parser.add_argument(
+    '--rerank_lambda', default=0.3, type=float,
+    help='Weight of the original distance in the re-ranked distance.')
+
+parser.add_argument(
+    '--rerank_nprobe', default=None, type=common.positive_int,
+    help='If given, find the re-ranking neighbors approximately through an '
+         'index probing this many lists, see `build_index.py`. Otherwise, '
+         'they are found exactly, which is quadratic in the dataset size.')
 
 
 def main():
@@ -62,84 +113,108 @@ def main():
 
     # Load the two datasets fully into memory.
     with h5py.File(args.query_embeddings, 'r') as f_query:
-        query_embs = np.array(f_query['emb'])
+        query_embs = np.array(f_query[args.group]['emb'])
+    # The gallery may also be compressed by `quantize_embeddings.py`, in which
+    # case the distances are computed directly on the codes.
+    metric = args.metric
     with h5py.File(args.gallery_embeddings, 'r') as f_gallery:
-        gallery_embs = np.array(f_gallery['emb'])
+        f_gallery = f_gallery[args.group]
+        if 'pq_codes' in f_gallery:
+            quantizer = ProductQuantizer.load(f_gallery)
+            gallery_embs = np.array(f_gallery['pq_codes'])
+            gallery_dim = quantizer.dim
+            metric = quantizer.distance_function(args.metric)
+        else:
+            gallery_embs = np.array(f_gallery['emb'])
+            gallery_dim = gallery_embs.shape[1]
 
     # Just a quick sanity check that both have the same embedding dimension!
     query_dim = query_embs.shape[1]
-    gallery_dim = gallery_embs.shape[1]
     if query_dim != gallery_dim:
         raise ValueError('Shape mismatch between query ({}) and gallery ({}) '
                          'dimension'.format(query_dim, gallery_dim))
 
     # Setup the dataset specific matching function
+    # and parse all queries for it only once.
     excluder = import_module('excluders.' + args.excluder).Excluder(gallery_fids)
-
-    # We go through the queries in batches, but we always need the whole gallery
-    batch_pids, batch_fids, batch_embs = tf.data.Dataset.from_tensor_slices(
-        (query_pids, query_fids, query_embs)
-    ).batch(args.batch_size).make_one_shot_iterator().get_next()
-
-    batch_distances = loss.cdist(batch_embs, gallery_embs, metric=args.metric)
-
-    # Loop over the query embeddings and compute their APs and the CMC curve.
-    aps = []
-    cmc = np.zeros(len(gallery_pids), dtype=np.int32)
-    with tf.Session() as sess:
-        for start_idx in count(step=args.batch_size):
-            try:
-                # Compute distance to all gallery embeddings
-                distances, pids, fids = sess.run([
-                    batch_distances, batch_pids, batch_fids])
-                print('\rEvaluating batch {}-{}/{}'.format(
-                        start_idx, start_idx + len(fids), len(query_fids)),
-                      flush=True, end='')
-            except tf.errors.OutOfRangeError:
-                print()  # Done!
-                break
-
-            # Convert the array of objects back to array of strings
-            pids, fids = np.array(pids, '|U'), np.array(fids, '|U')
-
-            # Compute the pid matches
-            pid_matches = gallery_pids[None] == pids[:,None]
-
-            # Get a mask indicating True for those gallery entries that should
-            # be ignored for whatever reason (same camera, junk, ...) and
-            # exclude those in a way that doesn't affect CMC and mAP.
-            mask = excluder(fids)
-            distances[mask] = np.inf
-            pid_matches[mask] = False
-
-            # Keep track of statistics. Invert distances to scores using any
-            # arbitrary inversion, as long as it's monotonic and well-behaved,
-            # it won't change anything.
-            scores = 1 / (1 + distances)
-            for i in range(len(distances)):
-                ap = average_precision_score(pid_matches[i], scores[i])
-
-                if np.isnan(ap):
-                    print()
-                    print("WARNING: encountered an AP of NaN!")
-                    print("This usually means a person only appears once.")
-                    print("In this case, it's because of {}.".format(fids[i]))
-                    print("I'm excluding this person from eval and carrying on.")
-                    print()
-                    continue
-
-                aps.append(ap)
-                # Find the first true match and increment the cmc data from there on.
-                k = np.where(pid_matches[i, np.argsort(distances[i])])[0][0]
-                cmc[k:] += 1
+    excluded = excluder.excluded_pairs(excluder.encode(query_fids))
+
+    # Re-ranking precomputes sparse neighborhoods, and then takes the place of
+    # the metric, working on indices into the embeddings instead.
+    if args.rerank:
+        if callable(metric):
+            parser.error('Re-ranking needs uncompressed gallery embeddings.')
+        print('Preparing re-ranking...')
+        reranker = reranking.KReciprocalReRanker(
+            query_embs, gallery_embs, metric, args.rerank_k1, args.rerank_k2,
+            args.rerank_lambda, args.rerank_nprobe, args.batch_size,
+            args.memory_limit * 2**20)
+        query_embs, gallery_embs = reranker.query_keys, reranker.gallery_keys
+        metric = reranker
+
+    def progress(done, total):
+        print('\rEvaluated {}/{} queries'.format(done, total), flush=True, end='')
+
+    tiled_args = dict(batch_size=args.batch_size,
+                      memory_limit=args.memory_limit * 2**20,
+                      workers=args.workers, progress=progress)
+
+    if args.cache is None:
+        # Go through the queries in batches, and through the gallery in tiles
+        # fitting into the memory limit, never holding all distances at once.
+        result = metrics.evaluate_tiled(
+            query_embs, query_pids, gallery_embs, gallery_pids, metric,
+            excluded=excluded, exclude_gallery=excluder.junk,
+            top_k=args.top_k, **tiled_args)
+        print()  # Done!
+    else:
+        # The same, but without any exclusions and only if not cached yet.
+        # Applying the exclusions afterwards only needs the cached counts.
+        description = '{} {}'.format(args.group, args.metric)
+        if args.rerank:
+            description += ' rerank {} {} {} {}'.format(
+                args.rerank_k1, args.rerank_k2, args.rerank_lambda,
+                args.rerank_nprobe)
+        key = result_cache.cache_key(
+            [args.query_embeddings, args.gallery_embeddings],
+            [query_pids, gallery_pids], description)
+        cached = result_cache.load(args.cache, key, args.top_k)
+        if cached is None:
+            print('Computing all distances for the cache {}'.format(args.cache))
+            cached = metrics.evaluate_tiled(
+                query_embs, query_pids, gallery_embs, gallery_pids, metric,
+                top_k=max(args.top_k, result_cache.MIN_TOP_K),
+                match_details=True, **tiled_args)
+            print()  # Done!
+            result_cache.save(args.cache, key, cached)
+        else:
+            print('Using the cached distances from {}'.format(args.cache))
+        result = result_cache.apply_exclusions(
+            cached, query_embs, query_pids, gallery_embs, gallery_pids, metric,
+            excluded, excluder.junk, args.top_k, args.batch_size)
+
+    for fid in query_fids[np.isnan(result.aps)]:
+        print()
+        print("WARNING: encountered an AP of NaN!")
+        print("This usually means a person only appears once.")
+        print("In this case, it's because of {}.".format(fid))
+        print("I'm excluding this person from eval and carrying on.")
+        print()
 
     # Compute the actual cmc and mAP values
-    cmc = cmc / len(query_pids)
+    valid = np.logical_not(np.isnan(result.aps))
+    aps = result.aps[valid]
+    cmc = metrics.cmc(result.ranks[valid], len(gallery_pids), len(query_pids))
     mean_ap = np.mean(aps)
 
     # Save important data
     if args.filename is not None:
-        json.dump({'mAP': mean_ap, 'CMC': list(cmc), 'aps': list(aps)}, args.filename)
+        results = {'mAP': mean_ap, 'CMC': list(cmc), 'aps': list(aps)}
+        if args.top_k > 0:
+            results['top_k'] = [
+                [gallery_fids[i] for i in idxs if i >= 0]
+                for idxs in result.top_k_indices]
+        json.dump(results, args.filename)
 
     # Print out a short summary.
     print('mAP: {:.2%} | top-1: {:.2%} top-2: {:.2%} | top-5: {:.2%} | top-10: {:.2%}'.format(
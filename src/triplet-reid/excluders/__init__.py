@@ -0,0 +1,6 @@
+# Used for the commandline flags.
+EXCLUDER_CHOICES = (
+    'diagonal',
+    'duke',
+    'market1501',
+)
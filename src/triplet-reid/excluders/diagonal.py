@@ -1,8 +1,10 @@
-class Excluder(object):
-    def __init__(self, gallery_fids):
-        # Store the gallery data
-        self.gallery_fids = gallery_fids
+import numpy as np
 
-    def __call__(self, query_fids):
-        # Only make sure we don't match the exact same image.
-        return self.gallery_fids[None] == query_fids[..., None]
+from excluders.keyed import KeyedExcluder
+
+
+class Excluder(KeyedExcluder):
+    """ Only makes sure we don't match the exact same image. """
+    def _parse(self, fids):
+        fids = np.asarray(fids)
+        return fids, np.zeros(len(fids), dtype=bool)
@@ -0,0 +1,24 @@
+import os
+import re
+
+import numpy as np
+
+from excluders.keyed import KeyedExcluder
+
+
+class Excluder(KeyedExcluder):
+    """
+    In the DukeMTMC-reID evaluation, we need to exclude the same PID in the
+    same camera (CID). There are no "junk" images.
+    """
+    # Regexp for extracting the PID and camera (CID) from a FID.
+    regexp = re.compile(r'(\S+)_c(\d+)_f(\d+)')
+
+    def _parse(self, fids):
+        """ Return the PID_CID keys and the junk extracted from the FIDs. """
+        keys = []
+        for fid in fids:
+            filename = os.path.splitext(os.path.basename(fid))[0]
+            pid, cid, _ = self.regexp.match(filename).groups()
+            keys.append(pid + '_' + cid)
+        return np.asarray(keys), np.zeros(len(keys), dtype=bool)
@@ -0,0 +1,69 @@
+""" The common base of all excluders.
+
+Every gallery image gets a key, such as its PID and camera, and gallery images
+sharing the key of a query are ignored for that query. Additionally, some
+gallery images may be "junk" which is ignored for all queries.
+The keys are parsed and integer-coded only once, after which exclusions are
+simple integer comparisons or, without any dense matrix at all, lists of
+(query, gallery) index pairs.
+"""
+
+import numpy as np
+
+
+class KeyedExcluder(object):
+    """ Base class, subclasses only need to implement `_parse`.
+
+    Args:
+        gallery_fids (1D array of strings): The FIDs of the whole gallery.
+    """
+    def __init__(self, gallery_fids):
+        keys, junk = self._parse(gallery_fids)
+        self.keys, self.gallery_codes = np.unique(keys, return_inverse=True)
+        self.junk = np.asarray(junk, dtype=bool)
+
+        # The gallery sorted by key, such that all gallery images sharing a
+        # query's key can be found by binary search.
+        self._order = np.argsort(self.gallery_codes, kind='mergesort')
+        self._sorted_codes = self.gallery_codes[self._order]
+
+    def __call__(self, query_fids):
+        """ Returns the (Q, G) boolean mask of gallery images to ignore. """
+        return self.mask(self.encode(query_fids))
+
+    def encode(self, query_fids):
+        """ Integer-codes the queries' keys, -1 if not present in the gallery.
+
+        Coding all queries once up-front makes `mask` and `excluded_pairs`
+        cheap enough to call for every batch.
+        """
+        keys, _ = self._parse(query_fids)
+        codes = np.searchsorted(self.keys, keys)
+        codes[codes == len(self.keys)] = 0
+        codes[self.keys[codes] != keys] = -1
+        return codes
+
+    def mask(self, query_codes):
+        """ Like calling the excluder, but for queries coded by `encode`. """
+        return np.logical_or(self.gallery_codes[None] == query_codes[:, None],
+                             self.junk[None])
+
+    def excluded_pairs(self, query_codes):
+        """ The sparse version of `mask`, excluding the junk.
+
+        Returns:
+            (rows, cols), index arrays into the queries and into the gallery,
+            of all pairs sharing their key. The `junk` is excluded for every
+            query on top of these.
+        """
+        lo = np.searchsorted(self._sorted_codes, query_codes, side='left')
+        hi = np.searchsorted(self._sorted_codes, query_codes, side='right')
+        counts = np.where(query_codes >= 0, hi - lo, 0)
+        rows = np.repeat(np.arange(len(query_codes)), counts)
+        # All of the ranges lo[i]:hi[i], concatenated.
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return rows, self._order[np.repeat(lo, counts) + offsets]
+
+    def _parse(self, fids):
+        """ Returns a string array of keys and a boolean junk array. """
+        raise NotImplementedError
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+""" Exports a trained network as a frozen inference graph.
+
+The result is a single `.pb` file going from (B, H, W, 3) `images` to (B, D)
+`emb`, which `embed.py --frozen_graph` and `inference.FrozenEmbedder` load
+within a few seconds, without building the network or restoring a
+checkpoint. All variables are turned into constants, constant subgraphs are
+folded, batch-norm is folded into the preceding convolutions, and everything
+not needed for computing `emb` is stripped.
+"""
+from argparse import ArgumentParser
+import os
+
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+import inference
+
+parser = ArgumentParser(description='Export a trained network as a frozen '
+                                    'inference graph.')
+
+parser.add_argument(
+    '--experiment_root', required=True,
+    help='Location used to store checkpoints and dumped data.')
+
+parser.add_argument(
+    '--checkpoint', default=None,
+    help='Name of checkpoint file of the trained network within the experiment '
+         'root. Uses the last checkpoint if not provided.')
+
+parser.add_argument(
+    '--filename', default='frozen_emb.pb',
+    help='Name of the file in which to store the frozen graph, relative to the '
+         '`experiment_root` location.')
+
+parser.add_argument(
+    '--quiet', action='store_true', default=False,
+    help='Don\'t be so verbose.')
+
+
+# The graph transforms applied after freezing, in order.
+TRANSFORMS = [
+    'strip_unused_nodes',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'strip_unused_nodes',
+    'sort_by_execution_order',
+]
+
+
+def main():
+    args = parser.parse_args()
+
+    # Load the args from the original experiment.
+    for key, value in inference.experiment_args(args.experiment_root).items():
+        args.__dict__.setdefault(key, value)
+    checkpoint = inference.checkpoint_path(args.experiment_root, args.checkpoint)
+
+    # Build the inference-only network on a placeholder of any image size.
+    images = tf.placeholder(
+        tf.float32, (None, None, None, 3), name=inference.INPUT_NAME)
+    emb = inference.embedding_network(
+        images, args.model_name, args.head_name, args.embedding_dim)
+    tf.identity(emb, name=inference.OUTPUT_NAME)
+
+    with tf.Session() as sess:
+        if not args.quiet:
+            print('Restoring from checkpoint: {}'.format(checkpoint))
+        tf.train.Saver().restore(sess, checkpoint)
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            sess, sess.graph.as_graph_def(), [inference.OUTPUT_NAME])
+
+    num_nodes = len(graph_def.node)
+    graph_def = TransformGraph(
+        graph_def, [inference.INPUT_NAME], [inference.OUTPUT_NAME], TRANSFORMS)
+
+    filename = os.path.join(args.experiment_root, args.filename)
+    with tf.gfile.GFile(filename, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    if not args.quiet:
+        print('Wrote {} nodes (from {}) to {}'.format(
+            len(graph_def.node), num_nodes, filename))
+
+
+if __name__ == '__main__':
+    main()
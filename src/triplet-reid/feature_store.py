@@ -0,0 +1,92 @@
+""" Frame-indexed embedding files of a camera's detections.
+
+`embed_detections.py --frame_index` stores the embeddings sorted by frame and
+HDF5-chunked by frame ranges, next to two auxiliary datasets:
+
+- `frame_offsets`, with an attribute `first_frame`: the embeddings of frame
+  `f` are the rows `frame_offsets[f - first_frame]` up to (excluding)
+  `frame_offsets[f - first_frame + 1]`.
+- `detection_index`: the row of the detections file each row belongs to.
+
+Consumers working on windows of frames thus only need to read the rows of
+their window, see `FeatureStore.window` (or `compute_L1_tracklets.m`).
+
+With `--trajectory_column`, the detections' embeddings are also averaged per
+trajectory, see `trajectory_means`.
+"""
+
+import h5py
+import numpy as np
+
+
+def frame_offsets(frames):
+    """ Returns the first frame and the row offsets of all frames up to the
+    last, for rows sorted by their `frames`. """
+    first_frame = int(np.min(frames))
+    counts = np.bincount(np.asarray(frames, dtype=np.int64) - first_frame)
+    return first_frame, np.concatenate([[0], np.cumsum(counts)])
+
+
+def chunk_rows(frames, chunk_frames):
+    """ How many rows make an HDF5 chunk spanning about `chunk_frames`
+    frames, on average. """
+    num_frames = int(np.max(frames)) - int(np.min(frames)) + 1
+    rows = int(round(len(frames) * chunk_frames / num_frames))
+    return min(max(rows, 1), len(frames))
+
+
+def trajectory_means(embs, trajectories):
+    """ Averages the (N, D) `embs` of detections per trajectory ID.
+
+    Returns:
+        The sorted (T,) int64 trajectory IDs and their (T, D) float32 mean
+        embeddings.
+    """
+    ids, trajectory = np.unique(trajectories, return_inverse=True)
+    trajectory = trajectory.ravel()
+    sums = np.zeros((len(ids), embs.shape[1]))
+    np.add.at(sums, trajectory, embs)
+    counts = np.bincount(trajectory, minlength=len(ids))[:, None]
+    return ids.astype(np.int64), (sums / counts).astype(np.float32)
+
+
+def write_index(f_out, frames, detection_index):
+    """ Stores the index of rows sorted by `frames`, which belong to the
+    detections `detection_index`, into the open HDF5 file `f_out`. """
+    first_frame, offsets = frame_offsets(frames)
+    f_out.create_dataset('frame_offsets', data=offsets)
+    f_out['frame_offsets'].attrs['first_frame'] = first_frame
+    f_out.create_dataset('detection_index', data=detection_index)
+
+
+class FeatureStore(object):
+    """ Reads the embeddings of windows of frames from a frame-indexed file.
+
+    Args:
+        path (string): The file written by `embed_detections.py
+            --frame_index`.
+        name (string): The embeddings dataset within, e.g. `model1/emb`.
+    """
+    def __init__(self, path, name='emb'):
+        self.file = h5py.File(path, 'r')
+        self.emb = self.file[name]
+        self.offsets = np.array(self.file['frame_offsets'])
+        self.first_frame = int(self.file['frame_offsets'].attrs['first_frame'])
+        self.detection_index = np.array(self.file['detection_index'])
+
+    def rows(self, first_frame, last_frame):
+        """ The rows of frames `first_frame` to `last_frame`, inclusive. """
+        lo, hi = np.clip([first_frame - self.first_frame,
+                          last_frame + 1 - self.first_frame],
+                         0, len(self.offsets) - 1)
+        return slice(self.offsets[lo], self.offsets[max(lo, hi)])
+
+    def window(self, first_frame, last_frame):
+        """ Returns the detection indices and float32 embeddings of all
+        detections from `first_frame` to `last_frame`, inclusive. """
+        rows = self.rows(first_frame, last_frame)
+        return (self.detection_index[rows],
+                np.asarray(self.emb[rows], dtype=np.float32))
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,251 @@
+""" An approximate nearest-neighbor index over gallery embeddings.
+
+The index is an inverted file (IVF): k-means splits the gallery into lists
+around coarse centroids, and a query only scans the gallery entries of its
+`nprobe` closest lists. More probes mean higher recall but slower queries,
+and probing all lists gives the exact result.
+
+The index only stores the centroids and the list assignment, not the
+embeddings themselves, so it is small and lives next to the HDF5 file of
+embeddings it was built for, see `default_path`. Along with them, it stores
+a `fingerprint` of those embeddings and the metric, such that a stale index
+is never used for re-computed embeddings.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+import metrics
+
+
+def default_path(embeddings_file, group='/'):
+    """ Where the index of an `embed.py` output file is stored by default,
+    `group` being the HDF5 group holding the embeddings, as for `evaluate.py`. """
+    name = os.path.splitext(embeddings_file)[0]
+    group = group.strip('/').replace('/', '_')
+    if group:
+        name += '_' + group
+    return name + '_ivf.npz'
+
+
+def fingerprint(gallery, metric):
+    """ A SHA-1 hex digest of the `gallery` embeddings and the `metric`. """
+    gallery = np.ascontiguousarray(gallery)
+    digest = hashlib.sha1('{} {} {}'.format(
+        gallery.shape, gallery.dtype.str, metric).encode())
+    digest.update(gallery.data)
+    return digest.hexdigest()
+
+
+def kmeans(data, num_clusters, iterations=20, metric='euclidean',
+           batch_size=4096, seed=None):
+    """ Plain Lloyd's k-means, initialized on random data points.
+
+    Args:
+        data (2D array): The (N, F) points to cluster.
+        num_clusters (int): The number of clusters K.
+        iterations (int): How many assignment/update steps to run.
+        metric (string): The metric used for assignments.
+        batch_size (int): How many points to assign at once.
+        seed (int or None): Seed for the initialization.
+
+    Returns:
+        (centroids, assignment), the (K, F) centroids and the (N,) index of
+        the closest centroid of each point.
+    """
+    rng = np.random.RandomState(seed)
+    centroids = data[rng.choice(len(data), num_clusters, replace=False)]
+    centroids = np.array(centroids, dtype=np.float32)
+    for _ in range(iterations):
+        assignment = assign(data, centroids, metric, batch_size)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        order = np.argsort(assignment, kind='mergesort')
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        sums[counts > 0] = np.add.reduceat(
+            data[order].astype(np.float64),
+            np.concatenate([[0], np.cumsum(counts)[:-1]])[counts > 0])
+        # Empty clusters are re-seeded on random points instead of dying.
+        empty = counts == 0
+        sums[empty] = data[rng.choice(len(data), np.sum(empty))]
+        counts[empty] = 1
+        centroids = (sums / counts[:, None]).astype(np.float32)
+    return centroids, assign(data, centroids, metric, batch_size)
+
+
+def assign(data, centroids, metric='euclidean', batch_size=4096):
+    """ Returns the index of the closest centroid of each point in `data`. """
+    return np.concatenate([
+        np.argmin(metrics.cdist(data[i:i + batch_size], centroids, metric), axis=1)
+        for i in range(0, len(data), batch_size)])
+
+
+def exact_search(queries, gallery, k, metric='euclidean', memory_limit=2**28):
+    """ The exhaustive search the index approximates, tiled like `evaluate.py`.
+
+    Returns:
+        (indices, distances), both (Q, k) and sorted by distance.
+    """
+    num_queries = len(queries)
+    width = max(1, memory_limit // (4 * 4 * max(1, num_queries)))
+    top_dists = np.empty((num_queries, 0), dtype=np.float32)
+    top_idxs = np.empty((num_queries, 0), dtype=np.int64)
+    for lo in range(0, len(gallery), width):
+        hi = min(lo + width, len(gallery))
+        top_dists, top_idxs = metrics.merge_top_k(
+            top_dists, top_idxs, metrics.cdist(queries, gallery[lo:hi], metric),
+            np.arange(lo, hi), k)
+    return _sorted(top_idxs, top_dists)
+
+
+def _sorted(top_idxs, top_dists):
+    order = np.argsort(top_dists, axis=1, kind='mergesort')
+    top_idxs = np.take_along_axis(top_idxs, order, axis=1)
+    top_dists = np.take_along_axis(top_dists, order, axis=1)
+    top_idxs[np.isinf(top_dists)] = -1
+    return top_idxs, top_dists
+
+
+def recall_at_k(found, truth):
+    """ The fraction of the true (Q, k) neighbors `truth` found in `found`. """
+    k = truth.shape[1]
+    hits = [len(np.intersect1d(f[:k], t[t >= 0])) for f, t in zip(found, truth)]
+    return np.sum(hits) / max(1, np.sum(truth >= 0))
+
+
+class GalleryIndex(object):
+    """ The IVF index, see the module documentation.
+
+    Create one with `build` or `load`, the constructor is just for those.
+
+    Args:
+        centroids (2D array): The (L, F) centroids of the L lists.
+        offsets (1D array): The (L+1,) start of each list in `ids`.
+        ids (1D array): The (G,) gallery indices, sorted by list.
+        metric (string): The metric the index was built for.
+        fingerprint (string or None): The `fingerprint` of the gallery and
+            metric the index was built for. Without one, no gallery matches.
+    """
+    def __init__(self, centroids, offsets, ids, metric, fingerprint=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.metric = metric
+        self.fingerprint = fingerprint
+        self.gallery = None
+
+    @classmethod
+    def build(cls, gallery, num_lists=None, metric='euclidean', iterations=20,
+              train_size=None, seed=None):
+        """ Clusters the `gallery` embeddings into `num_lists` lists.
+
+        Args:
+            gallery (2D array): The (G, F) gallery embeddings.
+            num_lists (int or None): Defaults to `4 * sqrt(G)`.
+            metric (string): One of `metrics.cdist.supported_metrics`.
+            iterations (int): The number of k-means iterations.
+            train_size (int or None): If given, k-means only runs on this
+                many random gallery entries, which is a lot faster for large
+                galleries. Defaults to 256 entries per list.
+            seed (int or None): Seed for the k-means sampling.
+        """
+        num_lists = num_lists or int(4 * np.sqrt(len(gallery)))
+        num_lists = max(1, min(num_lists, len(gallery)))
+        train_size = min(len(gallery), train_size or 256 * num_lists)
+        rng = np.random.RandomState(seed)
+        sample = gallery[np.sort(rng.choice(len(gallery), train_size, replace=False))]
+        centroids, _ = kmeans(sample, num_lists, iterations, metric, seed=seed)
+
+        assignment = assign(gallery, centroids, metric)
+        ids = np.argsort(assignment, kind='mergesort')
+        offsets = np.concatenate([[0], np.cumsum(
+            np.bincount(assignment, minlength=num_lists))])
+        index = cls(centroids, offsets, ids, metric,
+                    fingerprint(gallery, metric))
+        index.gallery = gallery
+        return index
+
+    @classmethod
+    def load(cls, path, gallery=None):
+        """ Loads an index saved by `save`, optionally attaching `gallery`. """
+        with np.load(path) as f:
+            # Indices saved before fingerprints existed never match.
+            index = cls(f['centroids'], f['offsets'], f['ids'], str(f['metric']),
+                        str(f['fingerprint']) if 'fingerprint' in f else None)
+        if gallery is not None:
+            index.attach(gallery)
+        return index
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets,
+                 ids=self.ids, metric=self.metric, fingerprint=self.fingerprint)
+
+    def matches(self, gallery, metric=None):
+        """ Whether the index was built for `gallery` and `metric`, which
+        defaults to the index' own. """
+        return (self.fingerprint is not None and len(gallery) == len(self.ids)
+                and self.fingerprint == fingerprint(
+                    gallery, metric or self.metric))
+
+    def attach(self, gallery):
+        """ Sets the gallery embeddings, which must be the indexed ones.
+
+        Raises:
+            ValueError if the index was built for other embeddings.
+        """
+        if not self.matches(gallery):
+            raise ValueError('The index was built for other gallery embeddings '
+                             'than the given {}, rebuild it.'.format(len(gallery)))
+        self.gallery = gallery
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    def search(self, queries, k, nprobe=1, batch_size=1024):
+        """ Finds the approximate `k` nearest gallery entries of each query.
+
+        Args:
+            queries (2D array): The (Q, F) query embeddings.
+            k (int): How many neighbors to return.
+            nprobe (int): How many of the closest lists to scan per query.
+                This trades speed for recall.
+            batch_size (int): How many queries to process at once.
+
+        Returns:
+            (indices, distances), both (Q, k) and sorted by distance. If fewer
+            than `k` entries were scanned, the remaining indices are -1.
+        """
+        nprobe = min(nprobe, self.num_lists)
+        results = [self._search_batch(queries[i:i + batch_size], k, nprobe)
+                   for i in range(0, len(queries), batch_size)]
+        return (np.concatenate([idxs for idxs, _ in results]),
+                np.concatenate([dists for _, dists in results]))
+
+    def _search_batch(self, queries, k, nprobe):
+        top_dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+        top_idxs = np.full((len(queries), k), -1, dtype=np.int64)
+
+        probes = metrics.cdist(queries, self.centroids, self.metric)
+        if nprobe < self.num_lists:
+            probes = np.argpartition(probes, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(self.num_lists), probes.shape)
+
+        # Go through the probed lists instead of the queries, such that every
+        # list is scanned for all queries probing it with a single `cdist`.
+        rows = np.repeat(np.arange(len(queries)), probes.shape[1])
+        lists = probes.ravel()
+        order = np.argsort(lists, kind='mergesort')
+        rows, lists = rows[order], lists[order]
+        bounds = np.flatnonzero(np.diff(lists)) + 1
+        for qs, l in zip(np.split(rows, bounds), lists[np.r_[0, bounds]]):
+            ids = self.ids[self.offsets[l]:self.offsets[l + 1]]
+            if len(ids) == 0:
+                continue
+            dists = metrics.cdist(queries[qs], self.gallery[ids], self.metric)
+            top_dists[qs], top_idxs[qs] = metrics.merge_top_k(
+                top_dists[qs], top_idxs[qs], dists, ids, k)
+
+        return _sorted(top_idxs, top_dists)
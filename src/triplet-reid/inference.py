@@ -0,0 +1,135 @@
+""" Loading frozen inference graphs, as written by `export_frozen.py`.
+
+A frozen graph is a single `GraphDef` with all variables turned into
+constants, batch-norm folded into the convolutions, and nothing left but what
+is needed to go from the `images` input to the `emb` output. Loading it takes
+no more than reading that file, no network code or checkpoint is involved.
+
+Frozen graphs converted to quantized TFLite models by `quantize_frozen.py`
+(`.tflite` files) can be loaded the same way, they are then run on the CPU by
+the TFLite interpreter.
+"""
+
+from importlib import import_module
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+# The names of the input and output tensors of a frozen graph.
+INPUT_NAME = 'images'
+OUTPUT_NAME = 'emb'
+
+
+def experiment_args(experiment_root):
+    """ Loads the `args.json` of a training run as a dict. """
+    args_file = os.path.join(experiment_root, 'args.json')
+    if not os.path.isfile(args_file):
+        raise IOError('`args.json` could not be found in: {}'.format(args_file))
+    with open(args_file, 'r') as f:
+        return json.load(f)
+
+
+def checkpoint_path(experiment_root, checkpoint=None):
+    """ The path of `checkpoint` within `experiment_root`, or of the latest
+    one if it's None. """
+    if checkpoint is None:
+        return tf.train.latest_checkpoint(experiment_root)
+    return os.path.join(experiment_root, checkpoint)
+
+
+def embedding_network(images, model_name, head_name, embedding_dim):
+    """ Builds a network and its embedding head in inference mode on
+    `images`, returning the (B, D) embeddings. """
+    model = import_module('nets.' + model_name)
+    head = import_module('heads.' + head_name)
+    endpoints, _ = model.endpoints(images, is_training=False)
+    with tf.name_scope('head'):
+        endpoints = head.head(endpoints, embedding_dim, is_training=False)
+    return endpoints['emb']
+
+
+def load_graph_def(path):
+    """ Reads a frozen `GraphDef` from `path`. """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def import_frozen(path, images, name='frozen'):
+    """ Imports the frozen graph at `path` into the current graph.
+
+    Args:
+        path (string): The `.pb` file written by `export_frozen.py`, or a
+            `.tflite` file written by `quantize_frozen.py`, which is run
+            through a `tf.py_func`.
+        images (4D tensor): The (B, H, W, 3) images to feed into the network,
+            in place of its input placeholder.
+        name (string): The name scope to import the graph under.
+
+    Returns:
+        The (B, D) embedding tensor.
+    """
+    if path.endswith('.tflite'):
+        embedder = TFLiteEmbedder(path)
+        with tf.name_scope(name):
+            emb = tf.py_func(embedder, [images], tf.float32)
+        emb.set_shape([None, embedder.embedding_dim])
+        return emb
+
+    emb, = tf.import_graph_def(
+        load_graph_def(path), input_map={INPUT_NAME + ':0': images},
+        return_elements=[OUTPUT_NAME + ':0'], name=name)
+    return emb
+
+
+class FrozenEmbedder(object):
+    """ Embeds batches of images given as numpy arrays with a frozen graph,
+    in its own graph and session, e.g. for serving:
+
+        embedder = FrozenEmbedder('experiment/frozen_emb.pb')
+        embs = embedder(images)  # (B, H, W, 3) -> (B, D)
+    """
+    def __init__(self, path, config=None):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.images = tf.placeholder(tf.float32, (None, None, None, 3))
+            self.emb = import_frozen(path, self.images)
+        self.session = tf.Session(graph=self.graph, config=config)
+
+    def __call__(self, images):
+        return self.session.run(self.emb, {self.images: images})
+
+    def close(self):
+        self.session.close()
+
+
+class TFLiteEmbedder(object):
+    """ Embeds batches of images given as numpy arrays with a TFLite model,
+    the same way as `FrozenEmbedder`. The input is resized to each new batch
+    shape on the fly.
+
+    Like a TensorFlow session, it uses as many threads as there are CPUs,
+    unless `num_threads` is given.
+    """
+    def __init__(self, path, num_threads=None):
+        self.num_threads = num_threads or os.cpu_count()
+        self.interpreter = tf.lite.Interpreter(
+            model_path=path, num_threads=self.num_threads)
+        self.input = self.interpreter.get_input_details()[0]['index']
+        output = self.interpreter.get_output_details()[0]
+        self.output = output['index']
+        self.embedding_dim = output['shape'][-1]
+        self.input_shape = None
+
+    def __call__(self, images):
+        if images.shape != self.input_shape:
+            self.interpreter.resize_tensor_input(self.input, images.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = images.shape
+        self.interpreter.set_tensor(self.input, images.astype(np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output).copy()
@@ -241,3 +241,49 @@ LOSS_CHOICES = {
     'batch_hard': batch_hard,
     'weighted_triplet': weighted_triplet,
 }
+
+
+# Knowledge distillation
+def embedding_distillation(embs, teacher_embs, metric):
+    """Makes the student reproduce the teacher's embeddings exactly.
+
+    Args:
+        embs (2D tensor): The student's embeddings of the batch, shape (B, F).
+        teacher_embs (2D tensor): The teacher's embeddings of the same batch,
+            which need to be of the same dimensionality.
+        metric (string): Unused, only there for a uniform signature.
+
+    Returns:
+        A 1D tensor of shape (B,) containing the squared euclidean distance
+        between each student and teacher embedding.
+    """
+    with tf.name_scope("embedding_distillation"):
+        return tf.reduce_sum(tf.square(embs - teacher_embs), axis=1)
+
+
+def distance_distillation(embs, teacher_embs, metric):
+    """Makes the student reproduce the teacher's pairwise distances.
+
+    This only constrains the geometry of the embedding space, not the space
+    itself, and thus works across different embedding dimensionalities.
+
+    Args:
+        embs (2D tensor): The student's embeddings of the batch, shape (B, F1).
+        teacher_embs (2D tensor): The teacher's embeddings of the same batch,
+            shape (B, F2).
+        metric (string): Which metric to use for the distances, see `cdist`.
+
+    Returns:
+        A 1D tensor of shape (B,) containing, for each sample, the mean squared
+        difference between its student and teacher distances to the batch.
+    """
+    with tf.name_scope("distance_distillation"):
+        dists = cdist(embs, embs, metric=metric)
+        teacher_dists = cdist(teacher_embs, teacher_embs, metric=metric)
+        return tf.reduce_mean(tf.square(dists - teacher_dists), axis=1)
+
+
+DISTILLATION_CHOICES = {
+    'embedding': embedding_distillation,
+    'distance': distance_distillation,
+}
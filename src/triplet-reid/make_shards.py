@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+""" Packs the images of a dataset .csv file into a few large TFRecord shards.
+
+The resulting index, `<output_dir>/<name>.index.npz`, can be passed as
+`--shards` to `train.py`, `train_wvt.py` and `embed.py`, which then read the
+shards instead of every single image file, see `shards.py`.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+import common
+import shards
+
+parser = ArgumentParser(description='Pack the images of a dataset into a few '
+                                    'large TFRecord shards.')
+
+parser.add_argument(
+    '--dataset', required=True,
+    help='Path to the dataset csv file whose images to pack.')
+
+parser.add_argument(
+    '--image_root', required=True, type=common.readable_directory,
+    help='Path that will be pre-pended to the filenames in the csv file.')
+
+parser.add_argument(
+    '--output_dir', required=True, type=common.writeable_directory,
+    help='Where to write the shards and their index.')
+
+parser.add_argument(
+    '--name', default=None,
+    help='Name of the shards and their index. Defaults to the name of the '
+         'dataset file, without extension.')
+
+parser.add_argument(
+    '--shard_size', default=256, type=common.positive_int,
+    help='About how large each shard should get, in MiB.')
+
+parser.add_argument(
+    '--num_shards', default=None, type=common.positive_int,
+    help='Exactly how many shards to write, instead of going by the size.')
+
+parser.add_argument(
+    '--threads', default=16, type=common.positive_int,
+    help='Number of threads used for reading the images.')
+
+
+def main():
+    args = parser.parse_args()
+    name = args.name or os.path.splitext(os.path.basename(args.dataset))[0]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    pids, fids = common.load_dataset(args.dataset, args.image_root)
+
+    num_shards = args.num_shards
+    if num_shards is None:
+        with ThreadPoolExecutor(args.threads) as pool:
+            total = sum(pool.map(
+                lambda fid: os.path.getsize(os.path.join(args.image_root, fid)),
+                fids))
+        num_shards = max(1, int(np.ceil(total / (args.shard_size * 2**20))))
+
+    index_file = shards.write_shards(
+        args.output_dir, name, pids, fids, args.image_root, num_shards,
+        args.threads)
+    print('Wrote {} images into {} shards, indexed by {}'.format(
+        len(fids), num_shards, index_file))
+
+
+if __name__ == '__main__':
+    main()
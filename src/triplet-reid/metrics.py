@@ -0,0 +1,543 @@
+""" Vectorized computation of the re-identification metrics (mAP and CMC).
+
+Unlike calling `sklearn.metrics.average_precision_score` per query, everything
+in here works on whole batches of queries at once, and only needs NumPy.
+`evaluate_tiled` additionally tiles the gallery, such that the full distance
+matrix never needs to exist, not even for a single batch of queries.
+"""
+
+from collections import namedtuple
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+
+def cdist(a, b, metric='euclidean'):
+    """ NumPy counterpart of `loss.cdist`, see there for the metrics.
+
+    Args:
+        a (2D array): The left-hand side, shaped (B1, F).
+        b (2D array): The right-hand side, shaped (B2, F).
+        metric (string): Which distance metric to use.
+
+    Returns:
+        The (B1, B2) matrix of all pairwise distances in the dtype of `a`.
+    """
+    if metric in ('euclidean', 'sqeuclidean'):
+        # The expanded form goes through BLAS and doesn't need a (B1, B2, F)
+        # temporary, but can become slightly negative due to cancellation.
+        sq = (np.sum(np.square(a), axis=1)[:, None]
+              + np.sum(np.square(b), axis=1)[None, :]
+              - 2 * np.dot(a, b.T))
+        sq = np.maximum(sq, 0, out=sq)
+        if metric == 'sqeuclidean':
+            return sq
+        # Same fudge-factor as in `loss.cdist`, for consistency.
+        return np.sqrt(sq + 1e-12, out=sq)
+    elif metric == 'cityblock':
+        return np.sum(np.abs(a[:, None, :] - b[None, :, :]), axis=-1)
+    else:
+        raise NotImplementedError(
+            'The following metric is not implemented by `cdist` yet: {}'.format(metric))
+cdist.supported_metrics = [
+    'euclidean',
+    'sqeuclidean',
+    'cityblock',
+]
+
+
+def match_counts(distances, matches, max_elements=2**24):
+    """ Counts what's needed for the AP of each match in a distance matrix.
+
+    Args:
+        distances (2D array): The (Q, G) query to gallery distances.
+        matches (2D bool array): The (Q, G) mask of correct matches.
+        max_elements (int): Upper bound on the size of temporaries.
+
+    Returns:
+        (rows, match_dists, num_closer, num_matches_closer), four 1D arrays
+        with one entry per match, sorted by query (row) and distance:
+        - the query (row) index of the match,
+        - the distance of the match,
+        - the number of gallery entries at most as far as the match,
+        - the number of matches at most as far as the match.
+        Both counts include the match itself and all of its ties.
+    """
+    rows, cols = np.nonzero(matches)
+    rows, match_dists = _sort_matches(rows, distances[rows, cols])
+
+    # Comparing each match against its row is much cheaper than sorting the
+    # row, as long as there are few matches per query, which is typical.
+    num_closer = np.zeros(len(rows), dtype=np.int64)
+    _count_closer(distances, rows, match_dists, num_closer, max_elements)
+
+    return rows, match_dists, num_closer, _num_matches_closer(rows, match_dists)
+
+
+def _sort_matches(rows, match_dists):
+    order = np.lexsort((match_dists, rows))
+    return rows[order], match_dists[order]
+
+
+def _count_closer(distances, rows, values, out, max_elements, out_strict=None):
+    """ Adds the number of entries in `distances[rows[i]]` at most as large
+    as `values[i]` to `out[i]`, and if given, the number of those smaller
+    than `values[i]` to `out_strict[i]`. """
+    step = max(1, max_elements // max(1, distances.shape[1]))
+    for start in range(0, len(rows), step):
+        stop = start + step
+        block = distances[rows[start:stop]]
+        out[start:stop] += np.count_nonzero(
+            block <= values[start:stop, None], axis=1)
+        if out_strict is not None:
+            out_strict[start:stop] += np.count_nonzero(
+                block < values[start:stop, None], axis=1)
+
+
+def _num_matches_closer(rows, match_dists):
+    """ For matches sorted by row and distance, the number of matches of the
+    same row at most as far, which is the position of the end of the match's
+    group of ties within its row. """
+    num_matches = len(rows)
+    is_group_end = np.ones(num_matches, dtype=bool)
+    is_group_end[:-1] = ((rows[1:] != rows[:-1]) |
+                         (match_dists[1:] != match_dists[:-1]))
+    group_end = np.where(is_group_end, np.arange(num_matches), num_matches)
+    group_end = np.minimum.accumulate(group_end[::-1])[::-1]
+    return group_end - np.searchsorted(rows, rows) + 1
+
+
+def average_precision(distances, matches):
+    """ Computes the average precision of each row of a distance matrix.
+
+    This gives the same result as `sklearn.metrics.average_precision_score`
+    (v0.19 and later) with the matches as labels and any score monotonically
+    decreasing in the distance. Just like there, entries with equal distances
+    are ranked as one group sharing the precision at the end of the group.
+    In other words, the AP is the mean over all matches of the fraction of
+    matches among all entries at most as far as that match.
+
+    Args:
+        distances (2D array): The (Q, G) query to gallery distances. Entries
+            which should be ignored can be set to `np.inf`, as long as they are
+            not marked as a match.
+        matches (2D bool array): The (Q, G) mask of correct matches.
+
+    Returns:
+        The (Q,) array of APs, with NaN for queries without a single match.
+    """
+    rows, _, num_closer, num_matches_closer = match_counts(distances, matches)
+    return aps_from_counts(rows, num_closer, num_matches_closer, len(distances))
+
+
+def aps_from_counts(rows, num_closer, num_matches_closer, num_queries):
+    """ Averages the per-match precisions of `match_counts` into APs. """
+    precisions = np.bincount(rows, weights=num_matches_closer / num_closer,
+                             minlength=num_queries)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return precisions / np.bincount(rows, minlength=num_queries)
+
+
+def first_match_rank(distances, matches):
+    """ Computes the 0-based rank of the closest match of each row.
+
+    Entries with a distance equal to that of the closest match are counted as
+    ranked behind it, i.e. ties are resolved in favour of the match.
+
+    Args:
+        distances (2D array): The (Q, G) query to gallery distances.
+        matches (2D bool array): The (Q, G) mask of correct matches.
+
+    Returns:
+        The (Q,) integer array of ranks, with -1 for queries without a match.
+    """
+    closest_match = np.min(np.where(matches, distances, np.inf), axis=1)
+    ranks = np.sum(distances < closest_match[:, None], axis=1)
+    ranks[~np.any(matches, axis=1)] = -1
+    return ranks
+
+
+def cmc(ranks, length, num_queries=None):
+    """ Turns first-match ranks into a CMC curve of the given `length`.
+
+    Queries with a rank of -1 (or beyond `length`) never count as a hit, but
+    they are still part of `num_queries`, which defaults to `len(ranks)`.
+    """
+    if num_queries is None:
+        num_queries = len(ranks)
+    ranks = np.asarray(ranks)
+    hist = np.bincount(ranks[(0 <= ranks) & (ranks < length)], minlength=length)
+    return np.cumsum(hist) / num_queries
+
+
+def evaluate(query_embs, query_pids, gallery_embs, gallery_pids, metric,
+             mask=None):
+    """ Computes APs and first-match ranks of all queries in one go.
+
+    This is meant for smaller query/gallery sets which fit into memory as a
+    whole, as done for validation during training.
+
+    Args:
+        query_embs, gallery_embs (2D arrays): The embeddings, shaped (Q, F)
+            and (G, F).
+        query_pids, gallery_pids (1D arrays): Their identities.
+        metric (string): One of `cdist.supported_metrics`.
+        mask (2D bool array or None): The (Q, G) mask of gallery entries to
+            ignore for each query, as returned by an excluder.
+
+    Returns:
+        (aps, ranks), see `average_precision` and `first_match_rank`.
+    """
+    distances = cdist(query_embs, gallery_embs, metric)
+    matches = gallery_pids[None] == query_pids[:, None]
+    if mask is not None:
+        distances[mask] = np.inf
+        matches[mask] = False
+    return average_precision(distances, matches), first_match_rank(distances, matches)
+
+
+# Tiled evaluation
+###
+
+TiledResult = namedtuple('TiledResult', [
+    'aps', 'ranks', 'top_k_indices', 'top_k_distances', 'matches'])
+
+MatchDetails = namedtuple('MatchDetails', [
+    'rows', 'cols', 'dists', 'num_closer', 'num_strictly_closer'])
+
+
+def evaluate_tiled(query_embs, query_pids, gallery_embs, gallery_pids, metric,
+                   excluded=None, exclude_gallery=None, batch_size=256,
+                   memory_limit=2**30, top_k=0, match_details=False, workers=1,
+                   progress=None):
+    """ Computes APs and first-match ranks tile by tile within a memory limit.
+
+    The queries are processed in batches, and for each batch, the gallery is
+    processed in tiles which are as wide as `memory_limit` allows. Only a few
+    counts per query and per match are kept across tiles, so neither the
+    query nor the gallery size are limited by memory.
+
+    The trick is to process queries sorted by PID, and the gallery via a PID
+    sorted index. This way, all matches of a batch lie within one contiguous
+    "span" of the sorted gallery, which is processed first in order to learn
+    all match distances. All other tiles then only add to the counts.
+    Every distance is computed by exactly one tile, so ties are consistent.
+
+    With multiple `workers`, the batches are spread over as many processes.
+    All arrays are shared with them through memory-mapped files in a temporary
+    directory instead of being pickled. Since the batches and tiles stay
+    exactly the same, so do the results.
+
+    Args:
+        query_embs, gallery_embs (2D arrays): The embeddings, shaped (Q, F)
+            and (G, F).
+        query_pids, gallery_pids (1D arrays): Their identities, of any type.
+        metric (string or callable): One of `cdist.supported_metrics`, or a
+            function computing the (Q, N) distances of a query and gallery
+            block like `cdist`, e.g. to compare against compressed gallery
+            embeddings as in `product_quantization`. It needs to be picklable
+            for multiple `workers`.
+        excluded (tuple or None): The (rows, cols) index arrays of all pairs
+            of queries and gallery entries to ignore, as returned by
+            `excluders.keyed.KeyedExcluder.excluded_pairs`.
+        exclude_gallery (1D bool array or None): The gallery entries to ignore
+            for all queries, such as junk images.
+        batch_size (int): How many queries to process at once.
+        memory_limit (int): Roughly how many bytes the tiles may use, per
+            worker.
+        top_k (int): If positive, also keep track of the `top_k` closest
+            gallery entries of each query.
+        match_details (bool): Whether to also return the counts underlying
+            the APs and ranks for each single match.
+        workers (int): How many processes to evaluate in.
+        progress (callable or None): Called as `progress(done, total)` after
+            each batch of queries.
+
+    Returns:
+        A `TiledResult` with the (Q,) `aps` and `ranks` as documented in
+        `average_precision` and `first_match_rank`, and if `top_k` is positive,
+        the (Q, top_k) `top_k_indices` into the gallery, sorted by distance,
+        along with their `top_k_distances`. Excluded entries are never part of
+        these, and their index is -1 if fewer than `top_k` entries are left.
+        If `match_details` is set, `matches` is a `MatchDetails` with one
+        entry per (non-excluded) match, sorted by query and distance: its
+        query `rows` and gallery `cols`, its `dists` and the number of
+        non-excluded gallery entries at most as far (`num_closer`) and
+        strictly closer (`num_strictly_closer`) than the match.
+    """
+    arrays = _tiled_arrays(query_embs, query_pids, gallery_embs, gallery_pids,
+                           excluded, exclude_gallery)
+    kwargs = dict(metric=metric, batch_size=batch_size,
+                  memory_limit=memory_limit, top_k=top_k,
+                  match_details=match_details)
+
+    num_queries = len(query_embs)
+    aps = np.full(num_queries, np.nan)
+    ranks = np.full(num_queries, -1, dtype=np.int64)
+    if top_k > 0:
+        top_k_indices = np.full((num_queries, top_k), -1, dtype=np.int64)
+        top_k_distances = np.full((num_queries, top_k), np.inf)
+    else:
+        top_k_indices = top_k_distances = None
+    matches = []
+
+    def collect(batches, done):
+        for idxs, batch in batches:
+            aps[idxs], ranks[idxs] = batch['aps'], batch['ranks']
+            if top_k > 0:
+                top_k_indices[idxs] = batch['top_k_indices']
+                top_k_distances[idxs] = batch['top_k_distances']
+            if match_details:
+                rows, *details = batch['matches']
+                matches.append([idxs[rows]] + details)
+            done += len(idxs)
+            if progress is not None:
+                progress(done, num_queries)
+        return done
+
+    starts = np.arange(0, num_queries, batch_size)
+    if workers <= 1:
+        collect(_evaluate_batches(arrays, starts, **kwargs), 0)
+    else:
+        # Several shards per worker balance the load a little better.
+        shards = [s for s in np.array_split(starts, 4 * workers) if len(s)]
+        with tempfile.TemporaryDirectory() as directory:
+            for name, array in arrays.items():
+                np.save(os.path.join(directory, name + '.npy'), array)
+            del arrays
+            with multiprocessing.Pool(workers, _init_worker,
+                                      (directory, kwargs)) as pool:
+                done = 0
+                for shard in pool.imap_unordered(_evaluate_shard, shards):
+                    done = collect(shard, done)
+
+    if match_details:
+        matches = [np.concatenate(d) for d in zip(*matches)] if matches else [
+            np.empty(0, np.int64)] * len(MatchDetails._fields)
+        order = np.lexsort((matches[2], matches[0]))
+        matches = MatchDetails(*[d[order] for d in matches])
+    else:
+        matches = None
+    return TiledResult(aps, ranks, top_k_indices, top_k_distances, matches)
+
+
+def _tiled_arrays(query_embs, query_pids, gallery_embs, gallery_pids,
+                  excluded, exclude_gallery):
+    """ Everything needed for evaluating any batch, as a dict of arrays. """
+    # Integer-encode the PIDs once and sort both sides by them.
+    _, codes = np.unique(np.concatenate([query_pids, gallery_pids]),
+                         return_inverse=True)
+    query_codes, gallery_codes = codes[:len(query_pids)], codes[len(query_pids):]
+    gallery_order = np.argsort(gallery_codes, kind='mergesort')
+    gallery_rank = np.empty_like(gallery_order)
+    gallery_rank[gallery_order] = np.arange(len(gallery_order))
+
+    # The excluded pairs in compressed sparse row format, grouped by query.
+    if excluded is None:
+        excluded = (np.empty(0, np.int64), np.empty(0, np.int64))
+    rows, cols = excluded
+    order = np.argsort(rows, kind='mergesort')
+    if exclude_gallery is None:
+        exclude_gallery = np.zeros(len(gallery_embs), dtype=bool)
+
+    return {
+        'query_embs': np.asarray(query_embs),
+        'query_codes': query_codes,
+        'query_order': np.argsort(query_codes, kind='mergesort'),
+        'gallery_embs': np.asarray(gallery_embs),
+        'gallery_sorted_codes': gallery_codes[gallery_order],
+        'gallery_order': gallery_order,
+        'gallery_rank': gallery_rank,
+        'gallery_excluded': np.asarray(exclude_gallery, dtype=bool),
+        'excluded_indptr': np.searchsorted(
+            rows[order], np.arange(len(query_embs) + 1)),
+        'excluded_cols': np.asarray(cols)[order],
+    }
+
+
+def _evaluate_batches(arrays, starts, metric, batch_size, memory_limit, top_k,
+                      match_details):
+    """ Yields the query indices and results of the batches at `starts`. """
+    gallery = _SortedGallery(arrays)
+    query_order = arrays['query_order']
+    indptr = arrays['excluded_indptr']
+    itemsize = np.result_type(
+        arrays['query_embs'], arrays['gallery_embs']).itemsize
+
+    for start in starts:
+        idxs = query_order[start:start + batch_size]
+        # Enough room for the tile, `cdist`'s temporaries and the comparisons.
+        width = max(1, memory_limit // (4 * itemsize * len(idxs)))
+        counts = indptr[idxs + 1] - indptr[idxs]
+        excluded = (np.repeat(np.arange(len(idxs)), counts),
+                    arrays['excluded_cols'][_ranges(indptr[idxs], counts)])
+        yield idxs, _evaluate_batch(
+            arrays['query_embs'][idxs], arrays['query_codes'][idxs], gallery,
+            metric, excluded, width, top_k, match_details,
+            max_elements=memory_limit // 4)
+
+
+def _ranges(starts, counts):
+    """ The concatenation of all `range(start, start + count)`. """
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+# The worker processes' memory-mapped arrays and evaluation arguments.
+_worker_arrays = None
+_worker_kwargs = None
+
+
+def _init_worker(directory, kwargs):
+    global _worker_arrays, _worker_kwargs
+    _worker_arrays = {
+        os.path.splitext(name)[0]: np.load(
+            os.path.join(directory, name), mmap_mode='r')
+        for name in os.listdir(directory)}
+    _worker_kwargs = kwargs
+
+
+def _evaluate_shard(starts):
+    return list(_evaluate_batches(_worker_arrays, starts, **_worker_kwargs))
+
+
+class _SortedGallery(object):
+    """ The gallery along with the PID-sorted order used for finding spans. """
+    def __init__(self, arrays):
+        self.embs = arrays['gallery_embs']
+        self.excluded = arrays['gallery_excluded']
+        self.sorted_codes = arrays['gallery_sorted_codes']
+        self.order = arrays['gallery_order']
+        self.rank = arrays['gallery_rank']
+
+    def __len__(self):
+        return len(self.embs)
+
+
+def _evaluate_batch(query_embs, query_codes, gallery, metric, excluded, width,
+                    top_k, match_details, max_elements):
+    """ Evaluates one batch of queries against the whole gallery, tile-wise. """
+    num_queries = len(query_embs)
+    match_lo = np.searchsorted(gallery.sorted_codes, query_codes, side='left')
+    match_hi = np.searchsorted(gallery.sorted_codes, query_codes, side='right')
+    span_lo, span_hi = np.min(match_lo), np.max(match_hi)
+    ex_rows, ex_cols = excluded
+    ex_pos = gallery.rank[ex_cols]
+    if callable(metric):
+        distance = metric
+    else:
+        distance = lambda a, b: cdist(a, b, metric)
+
+    def span_tile(lo, hi):
+        """ Distances and matches for sorted gallery positions [lo, hi). """
+        cols = gallery.order[lo:hi]
+        dists = distance(query_embs, gallery.embs[cols])
+        pos = np.arange(lo, hi)
+        matches = (match_lo[:, None] <= pos) & (pos < match_hi[:, None])
+        dists[:, gallery.excluded[cols]] = np.inf
+        matches[:, gallery.excluded[cols]] = False
+        ex = (lo <= ex_pos) & (ex_pos < hi)
+        dists[ex_rows[ex], ex_pos[ex] - lo] = np.inf
+        matches[ex_rows[ex], ex_pos[ex] - lo] = False
+        return dists, matches
+
+    def regular_tile(lo, hi):
+        """ Distances for gallery entries [lo, hi) outside of the span. """
+        dists = distance(query_embs, gallery.embs[lo:hi])
+        rank = gallery.rank[lo:hi]
+        dists[:, (span_lo <= rank) & (rank < span_hi)] = np.inf
+        dists[:, gallery.excluded[lo:hi]] = np.inf
+        ex = (lo <= ex_cols) & (ex_cols < hi)
+        dists[ex_rows[ex], ex_cols[ex] - lo] = np.inf
+        return dists
+
+    # First pass over the span, collecting the distances of all matches.
+    span_bounds = [(lo, min(lo + width, span_hi))
+                   for lo in range(span_lo, span_hi, width)]
+    rows, cols, match_dists = [np.empty(0, np.int64)], [np.empty(0, np.int64)], []
+    for lo, hi in span_bounds:
+        dists, matches = span_tile(lo, hi)
+        r, c = np.nonzero(matches)
+        rows.append(r)
+        cols.append(gallery.order[lo + c])
+        match_dists.append(dists[r, c])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    match_dists = np.concatenate(match_dists or [np.empty(0)])
+    order = np.lexsort((match_dists, rows))
+    rows, cols, match_dists = rows[order], cols[order], match_dists[order]
+    closest_match = np.full(num_queries, np.inf)
+    np.minimum.at(closest_match, rows, match_dists)
+
+    # Second pass over everything, counting what's closer than the matches.
+    # A span which fits into a single tile doesn't need to be computed again.
+    num_closer = np.zeros(len(rows), dtype=np.int64)
+    num_strictly_closer = np.zeros(len(rows), dtype=np.int64)
+    ranks = np.zeros(num_queries, dtype=np.int64)
+    top_dists = np.empty((num_queries, 0))
+    top_idxs = np.empty((num_queries, 0), dtype=np.int64)
+
+    def count(dists, cols):
+        nonlocal top_dists, top_idxs
+        _count_closer(dists, rows, match_dists, num_closer, max_elements,
+                      num_strictly_closer if match_details else None)
+        ranks[:] += np.count_nonzero(dists < closest_match[:, None], axis=1)
+        if top_k > 0:
+            top_dists, top_idxs = merge_top_k(
+                top_dists, top_idxs, dists, cols, top_k)
+
+    for lo, hi in span_bounds:
+        if len(span_bounds) > 1:
+            dists, _ = span_tile(lo, hi)
+        count(dists, gallery.order[lo:hi])
+    for lo in range(0, len(gallery), width):
+        hi = min(lo + width, len(gallery))
+        count(regular_tile(lo, hi), np.arange(lo, hi))
+
+    aps = aps_from_counts(
+        rows, num_closer, _num_matches_closer(rows, match_dists), num_queries)
+    ranks[np.isinf(closest_match)] = -1
+    result = {'aps': aps, 'ranks': ranks}
+    if match_details:
+        result['matches'] = (rows, cols, match_dists, num_closer,
+                             num_strictly_closer)
+    if top_k <= 0:
+        return result
+
+    # Sort the k closest, and pad/invalidate wherever there weren't enough.
+    order = np.argsort(top_dists, axis=1, kind='mergesort')
+    top_dists = np.take_along_axis(top_dists, order, axis=1)
+    top_idxs = np.take_along_axis(top_idxs, order, axis=1)
+    top_idxs[np.isinf(top_dists)] = -1
+    missing = top_k - top_dists.shape[1]
+    if missing > 0:
+        top_dists = np.pad(top_dists, [(0, 0), (0, missing)], 'constant',
+                           constant_values=np.inf)
+        top_idxs = np.pad(top_idxs, [(0, 0), (0, missing)], 'constant',
+                          constant_values=-1)
+    result['top_k_indices'], result['top_k_distances'] = top_idxs, top_dists
+    return result
+
+
+def merge_top_k(top_dists, top_idxs, dists, cols, k):
+    """ Merges a tile's `dists` to gallery `cols` into the running top-k.
+
+    Args:
+        top_dists, top_idxs (2D arrays): The (Q, K) running top-k distances and
+            gallery indices, in no particular order. K may be anything.
+        dists (2D array): The (Q, N) distances of the tile.
+        cols (1D array): The (N,) gallery indices of the tile's columns.
+        k (int): How many to keep.
+
+    Returns:
+        The merged (top_dists, top_idxs), unsorted, with at most `k` columns.
+    """
+    top_dists = np.concatenate([top_dists, dists], axis=1)
+    top_idxs = np.concatenate(
+        [top_idxs, np.broadcast_to(cols, dists.shape)], axis=1)
+    if top_dists.shape[1] > k:
+        keep = np.argpartition(top_dists, k - 1, axis=1)[:, :k]
+        top_dists = np.take_along_axis(top_dists, keep, axis=1)
+        top_idxs = np.take_along_axis(top_idxs, keep, axis=1)
+    return top_dists, top_idxs
@@ -13,7 +13,14 @@ def endpoints(image, is_training):
     with tf.contrib.slim.arg_scope(resnet_arg_scope(batch_norm_decay=0.9, weight_decay=0.0)):
         _, endpoints = resnet_v1_101(image, num_classes=None, is_training=is_training, global_pool=True)
 
+    # The end-points are named after their full variable scope, which includes
+    # any outer scope, e.g. when building two networks side by side.
+    outer_scope = tf.get_variable_scope().name
+    block4 = 'resnet_v1_101/block4'
+    if outer_scope:
+        block4 = outer_scope + '/' + block4
+
     endpoints['model_output'] = endpoints['global_pool'] = tf.reduce_mean(
-        endpoints['resnet_v1_101/block4'], [1, 2], name='pool5')
+        endpoints[block4], [1, 2], name='pool5')
 
     return endpoints, 'resnet_v1_101'
@@ -0,0 +1,136 @@
+""" Product quantization (PQ) for storing embeddings in a few bytes each.
+
+The embedding dimensions are split into M equally sized subspaces, and each
+subspace gets its own codebook of 256 centroids learned by k-means. An
+embedding is then stored as the M uint8 indices of the closest centroid in
+every subspace, i.e. in M bytes instead of 4 bytes per dimension.
+
+Queries don't need to be quantized: with asymmetric distance computation
+(ADC), the distances of a query's subvectors to all centroids are computed
+once into a small table, and the distance to any code is just a sum of M
+lookups into that table.
+
+A quantized embeddings file holds `pq_codes` (N, M) and `pq_codebooks`
+(M, 256, F/M) instead of `emb`, see `ProductQuantizer.save_codes`.
+"""
+
+import numpy as np
+
+import gallery_index
+import metrics
+
+
+class ProductQuantizer(object):
+    """ Encodes, decodes and compares embeddings against PQ codes.
+
+    Create one using `train`, or `load` from a quantized embeddings file.
+
+    Args:
+        codebooks (3D array): The (M, K, F/M) centroids of each subspace.
+    """
+    def __init__(self, codebooks):
+        self.codebooks = np.asarray(codebooks, dtype=np.float32)
+
+    @classmethod
+    def train(cls, embs, code_size, iterations=20, train_size=None, seed=None):
+        """ Learns the codebooks on (a sample of) `embs`.
+
+        Args:
+            embs (2D array): The (N, F) embeddings to learn from.
+            code_size (int): The number of bytes M per code, which needs to
+                divide the embedding dimension F.
+            iterations (int): The number of k-means iterations.
+            train_size (int or None): If given, only train on this many
+                random embeddings, which is much faster for large N.
+            seed (int or None): Seed for the sampling and k-means.
+        """
+        dim = embs.shape[1]
+        if dim % code_size != 0:
+            raise ValueError('The code size ({}) has to divide the embedding '
+                             'dimension ({}).'.format(code_size, dim))
+        if train_size is not None and train_size < len(embs):
+            rng = np.random.RandomState(seed)
+            embs = embs[np.sort(rng.choice(len(embs), train_size, replace=False))]
+        num_centroids = min(256, len(embs))
+        codebooks = [
+            gallery_index.kmeans(sub, num_centroids, iterations, seed=seed)[0]
+            for sub in np.split(np.asarray(embs, np.float32), code_size, axis=1)]
+        return cls(np.stack(codebooks))
+
+    @classmethod
+    def load(cls, f):
+        """ Loads the codebooks from an open h5 file written by `save_codes`. """
+        return cls(np.array(f['pq_codebooks']))
+
+    @property
+    def code_size(self):
+        return len(self.codebooks)
+
+    @property
+    def dim(self):
+        return self.code_size * self.codebooks.shape[2]
+
+    def encode(self, embs, batch_size=4096):
+        """ Quantizes the (N, F) `embs` into (N, M) uint8 codes. """
+        codes = np.empty((len(embs), self.code_size), dtype=np.uint8)
+        for start in range(0, len(embs), batch_size):
+            batch = np.asarray(embs[start:start + batch_size], np.float32)
+            for m, sub in enumerate(np.split(batch, self.code_size, axis=1)):
+                codes[start:start + batch_size, m] = gallery_index.assign(
+                    sub, self.codebooks[m])
+        return codes
+
+    def decode(self, codes):
+        """ Reconstructs approximate (N, F) embeddings from (N, M) codes. """
+        return np.concatenate([
+            self.codebooks[m][codes[:, m]] for m in range(self.code_size)],
+            axis=1)
+
+    def distance_tables(self, queries, metric='euclidean'):
+        """ The (M, Q, K) per-subspace distances of queries to centroids.
+
+        For the euclidean metrics, these are squared distances, such that the
+        sum over subspaces gives the squared distance to a code.
+        """
+        sub_metric = 'cityblock' if metric == 'cityblock' else 'sqeuclidean'
+        subs = np.split(np.asarray(queries, np.float32), self.code_size, axis=1)
+        return np.stack([metrics.cdist(sub, codebook, sub_metric)
+                         for sub, codebook in zip(subs, self.codebooks)])
+
+    def adc(self, queries, codes, metric='euclidean'):
+        """ Asymmetric distances of (Q, F) `queries` to (N, M) `codes`.
+
+        Returns:
+            The (Q, N) distances, approximating `metrics.cdist` of the queries
+            and the decoded codes, without ever decoding them.
+        """
+        if metric not in metrics.cdist.supported_metrics:
+            raise NotImplementedError(
+                'The following metric is not implemented by `adc` yet: {}'.format(metric))
+        tables = self.distance_tables(queries, metric)
+        dists = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for m in range(self.code_size):
+            dists += tables[m][:, codes[:, m]]
+        if metric == 'euclidean':
+            # Same fudge-factor as in `metrics.cdist`, for consistency.
+            dists = np.sqrt(np.maximum(dists, 0, out=dists) + 1e-12, out=dists)
+        return dists
+
+    def distance_function(self, metric='euclidean'):
+        """ An `adc` for `metrics.evaluate_tiled`'s `metric` argument. """
+        return _ADC(self, metric)
+
+    def save_codes(self, f, codes):
+        """ Writes `codes` and the codebooks into an open h5 file. """
+        f.create_dataset('pq_codes', data=codes)
+        f.create_dataset('pq_codebooks', data=self.codebooks)
+
+
+class _ADC(object):
+    """ A picklable `adc` with a fixed metric. """
+    def __init__(self, quantizer, metric):
+        self.quantizer = quantizer
+        self.metric = metric
+
+    def __call__(self, queries, codes):
+        return self.quantizer.adc(queries, codes, self.metric)
@@ -0,0 +1,133 @@
+""" Utilities for finding out where the time of a training step goes. """
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import time
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class StageTimer(object):
+    """ Accumulates the wall-clock time spent in named stages of a loop.
+
+    Use as:
+    timer = StageTimer()
+    for i in range(n):
+        timer.reset()
+        with timer('compute'):
+            # work
+        print(timer.current)
+
+    `current` only holds the stages of the ongoing iteration (since the last
+    `reset`), while `totals` and `counts` keep accumulating over all of them.
+    Untimed occurrences of anything else can be counted in `events`.
+    """
+    def __init__(self):
+        self.current = OrderedDict()
+        self.totals = OrderedDict()
+        self.counts = OrderedDict()
+        self.events = OrderedDict()
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def add(self, stage, seconds):
+        self.current[stage] = self.current.get(stage, 0.0) + seconds
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def count(self, event, n=1):
+        self.events[event] = self.events.get(event, 0) + n
+
+    def reset(self):
+        self.current = OrderedDict()
+
+    def summary(self, prefix='timing/'):
+        """ Returns a `tf.Summary` with one scalar per stage of `current`. """
+        summary = tf.Summary()
+        for stage, seconds in self.current.items():
+            summary.value.add(tag=prefix + stage, simple_value=seconds)
+        return summary
+
+    def means(self):
+        """ Returns the mean seconds per occurrence of each stage so far. """
+        return OrderedDict((stage, total / self.counts[stage])
+                           for stage, total in self.totals.items())
+
+    def report(self):
+        """ Returns the totals, counts and rates of all stages so far, and
+        the events, as a dict ready for dumping to JSON. """
+        stages = OrderedDict(
+            (stage, {'seconds': total, 'count': self.counts[stage],
+                     'per_second': self.counts[stage] / max(total, 1e-9)})
+            for stage, total in self.totals.items())
+        return {'stages': stages, 'events': self.events}
+
+
+class TraceSampler(object):
+    """ Decides which steps to fully trace and dumps those traces.
+
+    A step is traced if it is a multiple of `frequency`, or if the step before
+    it took longer than `slow_threshold` seconds. The latter can't trace the
+    slow step itself, as that one has already run, but spikes tend to come in
+    bursts, so the next one is usually just as telling.
+
+    Each trace is written to `out_dir` both as the raw serialized `RunMetadata`
+    and as a Chrome-trace timeline which can be opened in chrome://tracing.
+    """
+    def __init__(self, out_dir, frequency=0, slow_threshold=None):
+        self.out_dir = out_dir
+        self.frequency = frequency
+        self.slow_threshold = slow_threshold
+        self._trace_next = False
+
+    @property
+    def enabled(self):
+        return self.frequency > 0 or self.slow_threshold is not None
+
+    def should_trace(self, step):
+        if self._trace_next:
+            return True
+        return self.frequency > 0 and step % self.frequency == 0
+
+    def run_args(self, step):
+        """ Returns the `options` and `run_metadata` to pass to `sess.run`. """
+        if not self.should_trace(step):
+            return None, None
+        self._trace_next = False
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        return options, tf.RunMetadata()
+
+    def observe(self, step, seconds):
+        """ Report how long `step` took, possibly scheduling the next trace.
+
+        The `seconds` should only cover the step itself, i.e. waiting for the
+        input and computing, and traced steps shouldn't be reported at all,
+        lest every trace triggers the next one.
+        """
+        if self.slow_threshold is not None and seconds > self.slow_threshold:
+            self._trace_next = True
+
+    def write(self, step, run_metadata, summary_writer=None):
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+
+        basename = os.path.join(self.out_dir, '{:06d}'.format(step))
+        with open(basename + '_run_metadata.pb', 'wb') as f:
+            f.write(run_metadata.SerializeToString())
+
+        trace = timeline.Timeline(run_metadata.step_stats)
+        with open(basename + '_timeline.json', 'w') as f:
+            f.write(trace.generate_chrome_trace_format(show_memory=True))
+
+        # This makes the trace show up in TensorBoard's graph tab, too.
+        if summary_writer is not None:
+            summary_writer.add_run_metadata(
+                run_metadata, 'step{:06d}'.format(step), step)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from importlib import import_module
+import os
+import time
+
+import h5py
+import numpy as np
+
+import common
+from excluders import EXCLUDER_CHOICES
+import metrics
+from product_quantization import ProductQuantizer
+
+
+parser = ArgumentParser(
+    description='Compress embeddings by product quantization, and optionally '
+                'report the loss in mAP for each code size.')
+
+parser.add_argument(
+    '--gallery_embeddings', required=True,
+    help='Path to the h5 file containing the embeddings to compress.')
+
+parser.add_argument(
+    '--code_sizes', default=[8, 16, 32], nargs='+', type=common.positive_int,
+    help='The code sizes in bytes per embedding to try. Each of them needs to '
+         'divide the embedding dimension.')
+
+parser.add_argument(
+    '--save', action='store_true', default=False,
+    help='Store the codes for each code size M next to the embeddings file, '
+         'named like it but ending in `_pqM.h5`. These files can be used as '
+         'gallery embeddings in `evaluate.py`.')
+
+parser.add_argument(
+    '--train_size', default=65536, type=common.positive_int,
+    help='On how many random embeddings to learn the codebooks.')
+
+parser.add_argument(
+    '--iterations', default=20, type=common.positive_int,
+    help='Number of k-means iterations for learning the codebooks.')
+
+parser.add_argument(
+    '--seed', default=None, type=int,
+    help='Seed for the sampling and k-means.')
+
+parser.add_argument(
+    '--query_embeddings', default=None,
+    help='If given along with both datasets and an excluder, evaluate the '
+         'compressed gallery embeddings like `evaluate.py` does.')
+
+parser.add_argument(
+    '--query_dataset', default=None,
+    help='Path to the query dataset csv file.')
+
+parser.add_argument(
+    '--gallery_dataset', default=None,
+    help='Path to the gallery dataset csv file.')
+
+parser.add_argument(
+    '--excluder', default=None, choices=EXCLUDER_CHOICES,
+    help='Excluder to use for the evaluation, see `evaluate.py`.')
+
+parser.add_argument(
+    '--metric', default='euclidean', choices=metrics.cdist.supported_metrics,
+    help='Which metric to use for the distance between embeddings.')
+
+
+def main():
+    args = parser.parse_args()
+
+    evaluation = (args.query_embeddings, args.query_dataset,
+                  args.gallery_dataset, args.excluder)
+    if any(evaluation) and not all(evaluation):
+        parser.error('Evaluation needs all of --query_embeddings, '
+                     '--query_dataset, --gallery_dataset and --excluder.')
+
+    with h5py.File(args.gallery_embeddings, 'r') as f_gallery:
+        gallery_embs = np.array(f_gallery['emb'])
+
+    if all(evaluation):
+        query_pids, query_fids = common.load_dataset(args.query_dataset, None)
+        gallery_pids, gallery_fids = common.load_dataset(args.gallery_dataset, None)
+        with h5py.File(args.query_embeddings, 'r') as f_query:
+            query_embs = np.array(f_query['emb'])
+        excluder = import_module('excluders.' + args.excluder).Excluder(gallery_fids)
+        excluded = excluder.excluded_pairs(excluder.encode(query_fids))
+
+        def evaluate(gallery, metric):
+            result = metrics.evaluate_tiled(
+                query_embs, query_pids, gallery, gallery_pids, metric,
+                excluded=excluded, exclude_gallery=excluder.junk)
+            valid = np.logical_not(np.isnan(result.aps))
+            cmc = metrics.cmc(result.ranks[valid], 10, len(query_pids))
+            return np.mean(result.aps[valid]), cmc[0]
+
+        float_map, float_top1 = evaluate(gallery_embs, args.metric)
+        print('float32 ({:4d} bytes): mAP: {:.2%} | top-1: {:.2%}'.format(
+            gallery_embs.shape[1] * 4, float_map, float_top1))
+
+    for code_size in args.code_sizes:
+        start = time.time()
+        quantizer = ProductQuantizer.train(
+            gallery_embs, code_size, args.iterations, args.train_size, args.seed)
+        codes = quantizer.encode(gallery_embs)
+        line = 'PQ{:<4d} ({:4d} bytes): trained and encoded in {:.1f}s'.format(
+            code_size, code_size, time.time() - start)
+
+        if all(evaluation):
+            pq_map, pq_top1 = evaluate(
+                codes, quantizer.distance_function(args.metric))
+            line += ' | mAP: {:.2%} ({:+.2%}) | top-1: {:.2%} ({:+.2%})'.format(
+                pq_map, pq_map - float_map, pq_top1, pq_top1 - float_top1)
+        print(line)
+
+        if args.save:
+            filename = '{}_pq{}.h5'.format(
+                os.path.splitext(args.gallery_embeddings)[0], code_size)
+            with h5py.File(filename, 'w') as f_out:
+                quantizer.save_codes(f_out, codes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+""" Converts a frozen graph into post-training quantized TFLite models.
+
+With `int8`, weights and activations are quantized to 8 bit, the activation
+ranges being calibrated on a random sample of (training) images. With
+`float16`, only the weights are stored as half floats. The resulting
+`.tflite` files can be passed to the embedders' `--frozen_graph`.
+
+Given a query and gallery dataset and an excluder, both are embedded with the
+frozen float32 graph and each of the quantized models, reporting images per
+second next to the mAP and top-1 and how much they changed.
+"""
+from argparse import ArgumentParser
+from importlib import import_module
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import common
+from excluders import EXCLUDER_CHOICES
+import inference
+import metrics
+
+parser = ArgumentParser(description='Quantize a frozen graph for fast CPU '
+                                    'inference, and optionally report the '
+                                    'resulting speed and accuracy.')
+
+parser.add_argument(
+    '--experiment_root', required=True,
+    help='Location used to store checkpoints and dumped data.')
+
+parser.add_argument(
+    '--calibration_dataset', required=True,
+    help='Path to a dataset csv file, e.g. the training set, from which to '
+         'sample the images for calibrating the activation ranges.')
+
+parser.add_argument(
+    '--image_root', type=common.readable_directory,
+    help='Path that will be pre-pended to the filenames in the csv files.')
+
+parser.add_argument(
+    '--frozen_graph', default='frozen_emb.pb',
+    help='Name of the frozen graph written by `export_frozen.py` within the '
+         'experiment root. The quantized models are written next to it, '
+         'named like it but ending in `_MODE.tflite`.')
+
+parser.add_argument(
+    '--modes', default=['int8', 'float16'], nargs='+',
+    choices=['int8', 'float16'],
+    help='Which quantizations to produce.')
+
+parser.add_argument(
+    '--calibration_size', default=256, type=common.positive_int,
+    help='On how many random images to calibrate.')
+
+parser.add_argument(
+    '--seed', default=None, type=int,
+    help='Seed for sampling the calibration images.')
+
+parser.add_argument(
+    '--query_dataset', default=None,
+    help='If given along with a gallery dataset and an excluder, embed and '
+         'evaluate both with each of the models like `evaluate.py` does.')
+
+parser.add_argument(
+    '--gallery_dataset', default=None,
+    help='Path to the gallery dataset csv file.')
+
+parser.add_argument(
+    '--excluder', default=None, choices=EXCLUDER_CHOICES,
+    help='Excluder to use for the evaluation, see `evaluate.py`.')
+
+parser.add_argument(
+    '--metric', default='euclidean', choices=metrics.cdist.supported_metrics,
+    help='Which metric to use for the distance between embeddings.')
+
+parser.add_argument(
+    '--batch_size', default=64, type=common.positive_int,
+    help='Batch size used for embedding during the evaluation.')
+
+parser.add_argument(
+    '--loading_threads', default=8, type=common.positive_int,
+    help='Number of threads used for parallel data loading.')
+
+parser.add_argument(
+    '--threads', default=os.cpu_count(), type=common.positive_int,
+    help='Number of threads each model runs on during the evaluation, the '
+         'same for the frozen graph and the TFLite models. Defaults to the '
+         'number of CPUs.')
+
+
+def load_images(fids, image_root, image_size, batch_size, loading_threads):
+    """ Yields batches of the images `fids`, loaded like the embedders do. """
+    with tf.Graph().as_default():
+        dataset = tf.data.Dataset.from_tensor_slices(fids)
+        dataset = dataset.map(
+            lambda fid: common.fid_to_image(
+                fid, tf.constant('dummy'), image_root, image_size)[0],
+            num_parallel_calls=loading_threads)
+        dataset = dataset.batch(batch_size).prefetch(1)
+        images = dataset.make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            while True:
+                try:
+                    yield sess.run(images)
+                except tf.errors.OutOfRangeError:
+                    return
+
+
+def convert(frozen_graph, image_size, mode, calibration_images):
+    """ Returns the serialized TFLite model of `frozen_graph`, quantized
+    according to `mode`, either `int8` or `float16`. """
+    input_shape = [1, image_size[0], image_size[1], 3]
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(
+        frozen_graph, [inference.INPUT_NAME], [inference.OUTPUT_NAME],
+        input_shapes={inference.INPUT_NAME: input_shape})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'int8':
+        converter.representative_dataset = lambda: (
+            [image[None]] for image in calibration_images)
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        converter.target_spec.supported_types = [tf.float16]
+    return converter.convert()
+
+
+def main():
+    args = parser.parse_args()
+
+    evaluation = (args.query_dataset, args.gallery_dataset, args.excluder)
+    if any(evaluation) and not all(evaluation):
+        parser.error('Evaluation needs all of --query_dataset, '
+                     '--gallery_dataset and --excluder.')
+
+    # Load the args from the original experiment.
+    args_resumed = inference.experiment_args(args.experiment_root)
+    for key, value in args_resumed.items():
+        args.__dict__.setdefault(key, value)
+    image_root = args.image_root or args_resumed['image_root']
+    image_size = (args.net_input_height, args.net_input_width)
+
+    # Quantize, calibrating on a sample of images.
+    _, fids = common.load_dataset(args.calibration_dataset, image_root)
+    fids = np.random.RandomState(args.seed).choice(
+        fids, min(len(fids), args.calibration_size), replace=False)
+    calibration_images = np.concatenate(list(load_images(
+        fids, image_root, image_size, args.batch_size, args.loading_threads)))
+
+    frozen_graph = os.path.join(args.experiment_root, args.frozen_graph)
+    models = {}
+    for mode in args.modes:
+        start = time.time()
+        models[mode] = '{}_{}.tflite'.format(
+            os.path.splitext(frozen_graph)[0], mode)
+        with open(models[mode], 'wb') as f:
+            f.write(convert(frozen_graph, image_size, mode, calibration_images))
+        print('Wrote {} ({:.1f} MiB) in {:.1f}s'.format(
+            models[mode], os.path.getsize(models[mode]) / 2**20,
+            time.time() - start))
+
+    if not all(evaluation):
+        return
+
+    # Embed both datasets with all models in a single pass over the images,
+    # only timing the models themselves.
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.threads,
+                            inter_op_parallelism_threads=args.threads)
+    embedders = [('float32', inference.FrozenEmbedder(frozen_graph, config))]
+    embedders += [(mode, inference.TFLiteEmbedder(models[mode], args.threads))
+                  for mode in args.modes]
+    datasets = {}
+    for name, csv_file in [('query', args.query_dataset),
+                           ('gallery', args.gallery_dataset)]:
+        pids, fids = common.load_dataset(csv_file, image_root)
+        embs = {mode: [] for mode, _ in embedders}
+        seconds = dict.fromkeys(embs, 0.0)
+        for images in load_images(fids, image_root, image_size,
+                                  args.batch_size, args.loading_threads):
+            for mode, embedder in embedders:
+                start = time.time()
+                embs[mode].append(embedder(images))
+                seconds[mode] += time.time() - start
+            print('\rEmbedded {} {}/{}'.format(
+                name, sum(map(len, embs['float32'])), len(fids)),
+                flush=True, end='')
+        print()
+        datasets[name] = pids, fids, embs, seconds
+
+    query_pids, query_fids, query_embs, query_seconds = datasets['query']
+    gallery_pids, gallery_fids, gallery_embs, gallery_seconds = datasets['gallery']
+    excluder = import_module('excluders.' + args.excluder).Excluder(gallery_fids)
+    excluded = excluder.excluded_pairs(excluder.encode(query_fids))
+    num_images = len(query_fids) + len(gallery_fids)
+
+    for mode, _ in embedders:
+        result = metrics.evaluate_tiled(
+            np.concatenate(query_embs[mode]), query_pids,
+            np.concatenate(gallery_embs[mode]), gallery_pids, args.metric,
+            excluded=excluded, exclude_gallery=excluder.junk)
+        valid = np.logical_not(np.isnan(result.aps))
+        mean_ap = np.mean(result.aps[valid])
+        top1 = metrics.cmc(result.ranks[valid], 1, len(query_pids))[0]
+        speed = num_images / (query_seconds[mode] + gallery_seconds[mode])
+        line = ('{:8s}: {:7.1f} images/s on {} threads | mAP: {:.2%} | '
+                'top-1: {:.2%}'.format(mode, speed, args.threads, mean_ap, top1))
+        if mode == 'float32':
+            float_speed, float_map, float_top1 = speed, mean_ap, top1
+        else:
+            line += ' | {:.2f}x faster, mAP {:+.2%}, top-1 {:+.2%}'.format(
+                speed / float_speed, mean_ap - float_map, top1 - float_top1)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+""" k-reciprocal re-ranking on sparse neighbor lists.
+
+This is the re-ranking of "Re-ranking Person Re-identification with
+k-reciprocal Encoding" (Zhong et al., CVPR 2017), reformulated such that it
+never needs a dense (Q+G)x(Q+G) matrix:
+
+- The k1+1 nearest neighbors of all query and gallery items are found in
+  tiles (or approximately, with `gallery_index`), which is O((Q+G)*k1).
+- The k-reciprocal sets, their expansion and the encoding vectors V only ever
+  live in sparse matrices with O(k1^2) entries per row.
+- The Jaccard distance of a query and a gallery item is 1 unless their sets
+  overlap, so only the overlapping pairs are computed and stored, through an
+  inverted index over the sparse sets.
+
+The final distance of a pair is `lambda * d + (1 - lambda) * jaccard`, with
+`d` the original distance normalized by the largest distance of the query.
+Since everything else is a sparse correction to that, the re-ranked distances
+are computed tile by tile, see `KReciprocalReRanker.__call__`.
+"""
+
+import numpy as np
+import scipy.sparse
+
+import gallery_index
+import metrics
+
+
+class KReciprocalReRanker(object):
+    """ Computes re-ranked distances of query and gallery items.
+
+    Everything is precomputed on construction. Afterwards, the re-ranker is
+    used as a distance function on item keys instead of embeddings, which
+    makes it a drop-in `metric` for `metrics.evaluate_tiled`:
+
+        reranker = KReciprocalReRanker(query_embs, gallery_embs)
+        metrics.evaluate_tiled(reranker.query_keys, query_pids,
+                               reranker.gallery_keys, gallery_pids, reranker)
+
+    Args:
+        query_embs, gallery_embs (2D arrays): The (Q, F) and (G, F) embeddings.
+        metric (string): One of `metrics.cdist.supported_metrics`.
+        k1 (int): The size of the k-reciprocal neighborhoods.
+        k2 (int): The size of the local query expansion, 1 to disable it.
+        lambda_value (float): The weight of the original distance.
+        nprobe (int or None): If given, the neighbors are searched for
+            approximately with an IVF index probing this many lists, and the
+            normalization of the original distances is estimated on a sample.
+        batch_size (int): How many items to process at once.
+        memory_limit (int): Roughly how many bytes the distance tiles may use.
+        seed (int or None): Seed for the index and the sample.
+    """
+    def __init__(self, query_embs, gallery_embs, metric='euclidean', k1=20,
+                 k2=6, lambda_value=0.3, nprobe=None, batch_size=256,
+                 memory_limit=2**28, seed=None):
+        self.num_queries = len(query_embs)
+        self.embs = np.concatenate([query_embs, gallery_embs]).astype(np.float32)
+        self.metric = metric
+        self.lambda_value = lambda_value
+
+        neighbors, self.max_dists = _nearest_neighbors(
+            self.embs, k1 + 1, metric, nprobe, batch_size, memory_limit, seed)
+        encoding = self._encode(neighbors, k1, k2, batch_size)
+        self.overlaps = _min_sums(encoding[:self.num_queries],
+                                  encoding[self.num_queries:], batch_size)
+
+    @property
+    def query_keys(self):
+        """ What to pass as query embeddings to the distance function. """
+        return np.arange(self.num_queries)[:, None]
+
+    @property
+    def gallery_keys(self):
+        """ What to pass as gallery embeddings to the distance function. """
+        return np.arange(len(self.embs) - self.num_queries)[:, None]
+
+    def __call__(self, query_keys, gallery_keys):
+        """ The (Q, N) re-ranked distances of the given query/gallery keys. """
+        q, g = query_keys[:, 0], gallery_keys[:, 0]
+        dists = metrics.cdist(
+            self.embs[q], self.embs[self.num_queries + g], self.metric)
+        dists /= self.max_dists[q, None]
+        # min-sum m over max-sum (2 - m) of the encodings, each summing to 1.
+        overlap = self.overlaps[q][:, g].toarray()
+        jaccard = 1 - overlap / (2 - overlap)
+        return (self.lambda_value * dists
+                + (1 - self.lambda_value) * jaccard).astype(np.float32)
+
+    def _encode(self, neighbors, k1, k2, batch_size):
+        """ The sparse (N, N) encoding V, with local query expansion. """
+        reciprocal = _k_reciprocal(neighbors, k1, batch_size)
+        half = _k_reciprocal(neighbors, int(np.around(k1 / 2)), batch_size)
+
+        rows, cols = [], []
+        for start in range(0, len(neighbors), batch_size):
+            stop = start + batch_size
+            expanded = _expand(reciprocal[start:stop], half)
+            r, c = np.nonzero(expanded >= 0)
+            rows.append(r + start)
+            cols.append(expanded[r, c])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+        weights = np.exp(-_pair_distances(self.embs, rows, cols, self.metric)
+                         / self.max_dists[rows])
+        weights /= np.bincount(rows, weights, minlength=len(neighbors))[rows]
+        encoding = scipy.sparse.csr_matrix(
+            (weights, (rows, cols)), shape=(len(neighbors),) * 2)
+
+        if k2 > 1:
+            # Each item's encoding becomes the mean of its k2 neighbors' ones.
+            rows, cols = np.nonzero(neighbors[:, :k2] >= 0)
+            counts = np.bincount(rows, minlength=len(neighbors))
+            mean = scipy.sparse.csr_matrix(
+                (1 / counts[rows], (rows, neighbors[rows, cols])),
+                shape=encoding.shape)
+            encoding = mean.dot(encoding)
+        return encoding.tocsr()
+
+
+def _nearest_neighbors(embs, k, metric, nprobe, batch_size, memory_limit, seed):
+    """ The (N, k) sorted nearest neighbors of all items among themselves, -1
+    where there are fewer, and the largest distance of each item. """
+    num_items = len(embs)
+    if nprobe is not None:
+        index = gallery_index.GalleryIndex.build(embs, metric=metric, seed=seed)
+        neighbors, dists = index.search(embs, k, nprobe, batch_size)
+        sample = embs[np.random.RandomState(seed).choice(
+            num_items, min(num_items, 1024), replace=False)]
+        max_dists = np.concatenate([
+            np.max(metrics.cdist(embs[i:i + batch_size], sample, metric), axis=1)
+            for i in range(0, num_items, batch_size)])
+        return neighbors, np.maximum(max_dists, np.max(
+            np.where(neighbors >= 0, dists, 0), axis=1))
+
+    width = max(1, memory_limit // (4 * 4 * batch_size))
+    neighbors = np.empty((num_items, min(k, num_items)), dtype=np.int64)
+    max_dists = np.zeros(num_items, dtype=np.float32)
+    for start in range(0, num_items, batch_size):
+        batch = embs[start:start + batch_size]
+        top_dists = np.empty((len(batch), 0), dtype=np.float32)
+        top_idxs = np.empty((len(batch), 0), dtype=np.int64)
+        for lo in range(0, num_items, width):
+            dists = metrics.cdist(batch, embs[lo:lo + width], metric)
+            max_dists[start:start + batch_size] = np.maximum(
+                max_dists[start:start + batch_size], np.max(dists, axis=1))
+            top_dists, top_idxs = metrics.merge_top_k(
+                top_dists, top_idxs, dists,
+                np.arange(lo, min(lo + width, num_items)), k)
+        order = np.argsort(top_dists, axis=1, kind='mergesort')
+        neighbors[start:start + batch_size] = np.take_along_axis(
+            top_idxs, order, axis=1)
+    return neighbors, max_dists
+
+
+def _k_reciprocal(neighbors, k, batch_size):
+    """ The (N, k+1) k-reciprocal neighbors of each item, padded with -1.
+
+    That is those of the k+1 nearest neighbors of an item (including itself)
+    which have the item among their own k+1 nearest neighbors.
+    """
+    forward = neighbors[:, :k + 1]
+    result = np.full_like(forward, -1)
+    for start in range(0, len(forward), batch_size):
+        fw = forward[start:start + batch_size]
+        backward = forward[np.maximum(fw, 0)]
+        items = np.arange(start, start + len(fw))[:, None, None]
+        is_reciprocal = np.any(backward == items, axis=2) & (fw >= 0)
+        result[start:start + batch_size] = np.where(is_reciprocal, fw, -1)
+    return result
+
+
+def _expand(reciprocal, half):
+    """ Adds the half-size k-reciprocal neighbors of each k-reciprocal
+    neighbor, if they overlap by more than 2/3 with the item's own ones.
+
+    Args:
+        reciprocal (2D array): The (n, k1+1) k1-reciprocal neighbors of some
+            items, padded with -1.
+        half (2D array): The (N, k1/2+1) ones of all items.
+
+    Returns:
+        The (n, W) expanded sets without duplicates, padded with -1.
+    """
+    candidates = half[np.maximum(reciprocal, 0)]
+    valid = (candidates >= 0) & (reciprocal >= 0)[:, :, None]
+    shared = np.any(candidates[..., None] == reciprocal[:, None, None, :],
+                    axis=3) & valid
+    accept = np.sum(shared, axis=2) > 2 / 3 * np.sum(valid, axis=2)
+    candidates = np.where(accept[..., None] & valid, candidates, -1)
+
+    # Make each row a set by sorting it and blanking out repetitions.
+    merged = np.sort(np.concatenate(
+        [reciprocal, candidates.reshape(len(reciprocal), -1)], axis=1), axis=1)
+    merged[:, 1:][merged[:, 1:] == merged[:, :-1]] = -1
+    return merged
+
+
+def _pair_distances(embs, rows, cols, metric, batch_size=65536):
+    """ The distances of the item pairs (rows[i], cols[i]). """
+    dists = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), batch_size):
+        stop = start + batch_size
+        diff = embs[rows[start:stop]] - embs[cols[start:stop]]
+        if metric == 'cityblock':
+            dists[start:stop] = np.sum(np.abs(diff), axis=1)
+        else:
+            dists[start:stop] = np.sum(np.square(diff), axis=1)
+            if metric == 'euclidean':
+                dists[start:stop] = np.sqrt(dists[start:stop] + 1e-12)
+    return dists
+
+
+def _min_sums(query_encoding, gallery_encoding, batch_size):
+    """ The sparse (Q, G) sums of element-wise minima of two encodings'
+    rows, computed only where they overlap, through an inverted index. """
+    inverted = gallery_encoding.tocsc()
+    parts = []
+    for start in range(0, query_encoding.shape[0], batch_size):
+        batch = query_encoding[start:start + batch_size].tocoo()
+        # For every non-zero (query, column), all gallery items sharing it.
+        lo = inverted.indptr[batch.col]
+        counts = inverted.indptr[batch.col + 1] - lo
+        offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        idxs = np.repeat(lo, counts) + offsets
+        mins = np.minimum(np.repeat(batch.data, counts), inverted.data[idxs])
+        parts.append(scipy.sparse.csr_matrix(
+            (mins, (np.repeat(batch.row, counts), inverted.indices[idxs])),
+            shape=(batch.shape[0], inverted.shape[1])))
+    return scipy.sparse.vstack(parts).tocsr()
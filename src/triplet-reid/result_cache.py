@@ -0,0 +1,185 @@
+""" Caches the excluder-independent part of an evaluation.
+
+Evaluating without any exclusions, every gallery entry sharing the query's
+PID is a match, and for each of them, `metrics.evaluate_tiled` can report how
+many gallery entries are closer. That is all the AP and CMC need, even under
+any excluder: excluded entries are simply subtracted from these counts, which
+only needs the distances of the (few) excluded entries. Those of excluded
+matches are in the cache, the others, such as junk, are recomputed.
+
+The cache is a single `.npz` file, holding these per-match counts and the
+top-k closest gallery entries of each query, together with a key made of
+content hashes of the embedding files, the PIDs and the metric. Whenever
+any of them changes, the key doesn't match anymore and the cache is rebuilt.
+
+Note that the recomputed distances of excluded non-matches may differ from
+the cached ones in the last bit, which could only matter for exact ties.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+import metrics
+
+
+# The least number of closest gallery entries stored per query.
+MIN_TOP_K = 100
+
+
+def file_digest(path, chunk_size=2**24):
+    """ The SHA-1 hex digest of a file's content. """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(embedding_files, pids, description):
+    """ Combines hashes of the files, the PID arrays and a description of the
+    metric (including anything else influencing distances) into a key. """
+    digest = hashlib.sha1()
+    for path in embedding_files:
+        digest.update(file_digest(path).encode())
+    for p in pids:
+        digest.update('\n'.join(np.asarray(p, dtype=str)).encode())
+        digest.update(b'\0')
+    digest.update(description.encode())
+    return digest.hexdigest()
+
+
+def load(path, key, top_k=0):
+    """ Returns the cached `metrics.TiledResult`, or None if there is no
+    cache at `path`, it was made for another key, or holds fewer than
+    `top_k` closest entries per query. """
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as f:
+        if str(f['key']) != key or f['top_k_indices'].shape[1] < top_k:
+            return None
+        return metrics.TiledResult(
+            aps=f['aps'], ranks=f['ranks'],
+            top_k_indices=f['top_k_indices'],
+            top_k_distances=f['top_k_distances'],
+            matches=metrics.MatchDetails(
+                *[f['matches_' + field] for field in metrics.MatchDetails._fields]))
+
+
+def save(path, key, result):
+    """ Stores a result of `metrics.evaluate_tiled`, which must have been
+    computed without exclusions, with `top_k` and `match_details`. """
+    arrays = {'matches_' + field: value
+              for field, value in result.matches._asdict().items()}
+    # Write to a temporary file first, such that an interruption never leaves
+    # a half-written cache behind.
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, key=key, aps=result.aps, ranks=result.ranks,
+                 top_k_indices=result.top_k_indices,
+                 top_k_distances=result.top_k_distances, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def apply_exclusions(cached, query_embs, query_pids, gallery_embs, gallery_pids,
+                     metric, excluded=None, exclude_gallery=None, top_k=0,
+                     batch_size=256):
+    """ Turns a cached result into the one `metrics.evaluate_tiled` would give
+    with the same arguments, `batch_size` queries' junk distances at a time.
+
+    Returns:
+        A `metrics.TiledResult` without `matches`. The `top_k` closest entries
+        come from the cached ones, unless too many of those are excluded, in
+        which case they are recomputed for that query.
+    """
+    if callable(metric):
+        distance = metric
+    else:
+        distance = lambda a, b: metrics.cdist(a, b, metric)
+    num_queries, num_gallery = len(query_embs), len(gallery_embs)
+    if excluded is None:
+        excluded = (np.empty(0, np.int64), np.empty(0, np.int64))
+    if exclude_gallery is None:
+        exclude_gallery = np.zeros(num_gallery, dtype=bool)
+    ex_rows, ex_cols = (np.asarray(e, dtype=np.int64) for e in excluded)
+    ex_keys = np.sort(ex_rows * num_gallery + ex_cols)
+    junk = np.flatnonzero(exclude_gallery)
+    m = cached.matches
+
+    def is_excluded(rows, cols):
+        return exclude_gallery[cols] | _contains(ex_keys, rows * num_gallery + cols)
+
+    match_excluded = is_excluded(m.rows, m.cols)
+    match_bounds = np.searchsorted(m.rows, np.arange(num_queries + 1))
+    ex_order = np.argsort(ex_rows, kind='mergesort')
+    ex_bounds = np.searchsorted(ex_rows[ex_order], np.arange(num_queries + 1))
+
+    aps = np.full(num_queries, np.nan)
+    ranks = np.full(num_queries, -1, dtype=np.int64)
+    for q in range(num_queries):
+        # The distances of everything excluded: cached for matches,
+        # recomputed for all other excluded entries, the junk batch-wise.
+        if q % batch_size == 0:
+            junk_dists = distance(query_embs[q:q + batch_size], gallery_embs[junk])
+
+        lo, hi = match_bounds[q], match_bounds[q + 1]
+        dists = m.dists[lo:hi]
+        valid = np.logical_not(match_excluded[lo:hi])
+        if not np.any(valid):
+            continue
+
+        others = ex_cols[ex_order[ex_bounds[q]:ex_bounds[q + 1]]]
+        others = others[np.logical_not(exclude_gallery[others]) &
+                        (gallery_pids[others] != query_pids[q])]
+        ex_dists = [dists[np.logical_not(valid)],
+                    junk_dists[q % batch_size][gallery_pids[junk] != query_pids[q]]]
+        if len(others):
+            ex_dists.append(distance(
+                query_embs[q:q + 1], gallery_embs[np.unique(others)])[0])
+        ex_dists = np.sort(np.concatenate(ex_dists))
+
+        dists = dists[valid]
+        num_closer = m.num_closer[lo:hi][valid] - np.searchsorted(
+            ex_dists, dists, side='right')
+        num_strictly_closer = m.num_strictly_closer[lo:hi][valid] - np.searchsorted(
+            ex_dists, dists, side='left')
+        num_matches_closer = np.searchsorted(dists, dists, side='right')
+        aps[q] = np.mean(num_matches_closer / num_closer)
+        ranks[q] = num_strictly_closer[0]
+
+    top_k_indices = top_k_distances = None
+    if top_k > 0:
+        idxs, dists = cached.top_k_indices, cached.top_k_distances
+        rows = np.repeat(np.arange(num_queries), idxs.shape[1]).reshape(idxs.shape)
+        keep = (idxs >= 0) & np.logical_not(
+            is_excluded(rows, np.maximum(idxs, 0)))
+        # Stable-sort the kept ones to the front, preserving their order.
+        order = np.argsort(np.logical_not(keep), axis=1, kind='mergesort')[:, :top_k]
+        top_k_indices = np.where(np.take_along_axis(keep, order, axis=1),
+                                 np.take_along_axis(idxs, order, axis=1), -1)
+        top_k_distances = np.where(top_k_indices >= 0,
+                                   np.take_along_axis(dists, order, axis=1), np.inf)
+
+        # Queries which ran out of cached entries, although the gallery has
+        # more beyond them, need their top-k recomputed.
+        short = np.count_nonzero(keep, axis=1) < top_k
+        short &= np.all(idxs >= 0, axis=1) & (idxs.shape[1] < num_gallery)
+        short = np.flatnonzero(short)
+        for start in range(0, len(short), batch_size):
+            qs = short[start:start + batch_size]
+            all_dists = distance(query_embs[qs], gallery_embs)
+            all_dists[is_excluded(qs[:, None], np.arange(num_gallery))] = np.inf
+            order = np.argsort(all_dists, axis=1, kind='mergesort')[:, :top_k]
+            all_dists = np.take_along_axis(all_dists, order, axis=1)
+            top_k_indices[qs] = np.where(np.isinf(all_dists), -1, order)
+            top_k_distances[qs] = all_dists
+
+    return metrics.TiledResult(aps, ranks, top_k_indices, top_k_distances, None)
+
+
+def _contains(sorted_keys, keys):
+    """ Which of `keys` are in the sorted array `sorted_keys`. """
+    if len(sorted_keys) == 0:
+        return np.zeros(np.shape(keys), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[pos] == keys
@@ -0,0 +1,167 @@
+""" Packing the images of a dataset into a few large TFRecord shards.
+
+Reading tens of thousands of small image files one by one is slow on shared
+filesystems. `make_shards.py` instead packs the images of a dataset .csv file
+into a few large TFRecord files, the shards, dealing the rows out to them in
+turn, and writes an index next to them (`INDEX_SUFFIX`).
+
+Each record is a `tf.train.Example` of the `fid`, the `pid` and the encoded
+`image` file as it is. For each row of the .csv file, the index holds its FID
+and PID, the shard it went to, and the byte offset and length of its record
+within that.
+
+There are two ways of streaming the images back, both only reading the
+shards front to back, several of them in parallel:
+
+- `dataset` streams them in the order of the .csv file, as for `embed.py`.
+- `pk_dataset` streams them shuffled and grouped by PID, as for the PK-batches
+  of training.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+INDEX_SUFFIX = '.index.npz'
+
+# A TFRecord is framed by its length (8 bytes) and two CRCs (4 bytes each).
+RECORD_OVERHEAD = 16
+
+FEATURES = {
+    'fid': tf.FixedLenFeature([], tf.string),
+    'pid': tf.FixedLenFeature([], tf.string),
+    'image': tf.FixedLenFeature([], tf.string),
+}
+
+
+def shard_filenames(name, num_shards):
+    """ The file names of the `num_shards` shards of the dataset `name`. """
+    return ['{}-{:05d}-of-{:05d}.tfrecord'.format(name, i, num_shards)
+            for i in range(num_shards)]
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def write_shards(output_dir, name, pids, fids, image_root, num_shards,
+                 threads=16):
+    """ Packs the images `fids` within `image_root` into `num_shards` shards,
+    named after `name`, and writes their index.
+
+    The files are read by a pool of `threads` threads, a chunk of
+    `16 * threads` at a time, but written in order.
+
+    Returns:
+        The path of the index.
+    """
+    filenames = shard_filenames(name, num_shards)
+    shard = np.arange(len(fids)) % num_shards
+    offset = np.zeros(len(fids), dtype=np.int64)
+    length = np.zeros(len(fids), dtype=np.int64)
+    position = np.zeros(num_shards, dtype=np.int64)
+
+    def read(fid):
+        with open(os.path.join(image_root, fid), 'rb') as f:
+            return f.read()
+
+    writers = [tf.python_io.TFRecordWriter(os.path.join(output_dir, filename))
+               for filename in filenames]
+    try:
+        with ThreadPoolExecutor(threads) as pool:
+            chunks = (pool.map(read, fids[start:start + 16 * threads])
+                      for start in range(0, len(fids), 16 * threads))
+            for i, image in enumerate(chain.from_iterable(chunks)):
+                record = tf.train.Example(features=tf.train.Features(feature={
+                    'fid': _bytes_feature(fids[i].encode()),
+                    'pid': _bytes_feature(pids[i].encode()),
+                    'image': _bytes_feature(image),
+                })).SerializeToString()
+                writers[shard[i]].write(record)
+                offset[i], length[i] = position[shard[i]], len(record)
+                position[shard[i]] += len(record) + RECORD_OVERHEAD
+                if (i + 1) % 1000 == 0 or i + 1 == len(fids):
+                    print('\rPacked {}/{} images'.format(i + 1, len(fids)),
+                          flush=True, end='')
+        print()
+    finally:
+        for writer in writers:
+            writer.close()
+
+    index_file = os.path.join(output_dir, name + INDEX_SUFFIX)
+    np.savez(index_file, shards=np.array(filenames), fids=np.asarray(fids),
+             pids=np.asarray(pids), shard=shard, offset=offset, length=length)
+    return index_file
+
+
+def load_index(index_file):
+    """ Loads the index written by `write_shards` as a dict of arrays, with
+    the shards' paths made relative to the current directory. """
+    with np.load(index_file) as f:
+        index = {key: f[key] for key in f.files}
+    directory = os.path.dirname(index_file)
+    index['shards'] = np.array([os.path.join(directory, shard)
+                                for shard in index['shards']])
+    return index
+
+
+def parse(record):
+    """ Returns the encoded image, FID and PID of a serialized record. """
+    example = tf.parse_single_example(record, FEATURES)
+    return example['image'], example['fid'], example['pid']
+
+
+def dataset(index_file, loading_threads=8, buffer_size=2**24):
+    """ A `tf.data.Dataset` of the encoded images, FIDs and PIDs of all rows
+    of the sharded .csv file, in its order.
+
+    All shards are read at once, each one front to back with reads of
+    `buffer_size` bytes. Since the rows were dealt out to the shards in turn,
+    taking one record from each shard in turn restores their order.
+    """
+    shard_files = load_index(index_file)['shards']
+    records = tf.data.Dataset.from_tensor_slices(shard_files).apply(
+        tf.contrib.data.parallel_interleave(
+            lambda path: tf.data.TFRecordDataset(path, buffer_size=buffer_size),
+            cycle_length=len(shard_files), block_length=1, sloppy=False))
+    return records.map(parse, num_parallel_calls=loading_threads)
+
+
+def pk_dataset(index_file, batch_k, loading_threads=8, shuffle_buffer=4096,
+               buffer_size=2**24):
+    """ An endless `tf.data.Dataset` of the encoded images, FIDs and PIDs of
+    the shards, in groups of `batch_k` records of the same PID, for batching
+    `batch_p` groups at a time into PK-batches.
+
+    The shards are read in a new random order every epoch, up to
+    `loading_threads` of them at once, each one front to back with reads of
+    `buffer_size` bytes. Their records are mixed by a shuffle buffer of
+    `shuffle_buffer` records, then set aside by PID until `batch_k` of one PID
+    are together. The larger the buffer, the more random the PIDs of a batch,
+    since the rows of a .csv file are usually sorted by PID.
+
+    A PID with fewer than `batch_k` images waits for those of the next epoch,
+    so that its group repeats some of them, just as the PK-sampling of
+    `train.py` does.
+    """
+    shard_files = load_index(index_file)['shards']
+    records = tf.data.Dataset.from_tensor_slices(shard_files)
+    records = records.shuffle(len(shard_files)).repeat(None)
+    records = records.apply(tf.contrib.data.parallel_interleave(
+        lambda path: tf.data.TFRecordDataset(path, buffer_size=buffer_size),
+        cycle_length=min(len(shard_files), loading_threads), sloppy=True))
+    records = records.shuffle(shuffle_buffer)
+    records = records.map(parse, num_parallel_calls=loading_threads)
+
+    # Hashing the PID avoids a lookup table, which a one-shot iterator can't
+    # hold, and collisions among 2^62 buckets are not to be expected.
+    records = records.apply(tf.contrib.data.group_by_window(
+        key_func=lambda image, fid, pid: tf.string_to_hash_bucket_fast(
+            pid, 2**62),
+        reduce_func=lambda key, group: group.batch(batch_k),
+        window_size=batch_k))
+    return records.apply(tf.contrib.data.unbatch())
@@ -0,0 +1,181 @@
+""" Reusing embeddings of near-duplicate detections in consecutive frames.
+
+Detections are linked into chains across adjacent frames of the same camera
+by the overlap of their boxes. Only some of the detections along a chain, the
+key detections, are embedded: every Nth one, and any one whose box or
+appearance changed too much since the chain's last key detection. The
+embeddings of all others are filled in from the key detections before and
+after them in the chain.
+
+Detections are rows of [camera, frame, left, top, width, height, ...], as for
+`embed_detections.py`.
+"""
+
+import numpy as np
+
+
+def box_iou(a, b):
+    """ The intersection over union of the boxes in corresponding rows of the
+    (N, 4) arrays `a` and `b`, given as [left, top, width, height]. """
+    lo = np.maximum(a[:, :2], b[:, :2])
+    hi = np.minimum(a[:, :2] + a[:, 2:], b[:, :2] + b[:, 2:])
+    intersection = np.prod(np.maximum(hi - lo, 0), axis=1)
+    union = np.prod(a[:, 2:], axis=1) + np.prod(b[:, 2:], axis=1) - intersection
+    return intersection / np.maximum(union, 1e-12)
+
+
+def link(detections, min_iou=0.5):
+    """ Links each detection to one in the previous frame of its camera.
+
+    A pair of detections in adjacent frames is linked if their boxes overlap
+    by at least `min_iou` and each is the other's best match.
+
+    Returns:
+        An array holding, for each detection, the index of its predecessor,
+        or -1 for the first one of a chain.
+    """
+    cams = detections[:, 0].astype(np.int64)
+    frames = detections[:, 1].astype(np.int64)
+    boxes = detections[:, 2:6].astype(np.float64)
+
+    # Index the detections by (camera, frame) to find those of the next frame.
+    codes = cams * (frames.max() + 2) + frames
+    order = np.argsort(codes, kind='mergesort')
+    next_lo = np.searchsorted(codes[order], codes + 1, side='left')
+    next_hi = np.searchsorted(codes[order], codes + 1, side='right')
+
+    # All pairs of a detection and one in the next frame of its camera.
+    counts = next_hi - next_lo
+    src = np.repeat(np.arange(len(detections)), counts)
+    offsets = np.arange(len(src)) - np.repeat(np.cumsum(counts) - counts, counts)
+    dst = order[np.repeat(next_lo, counts) + offsets]
+    ious = box_iou(boxes[src], boxes[dst])
+
+    # Keep those pairs which are the best for both of their detections.
+    best_src = np.zeros(len(detections))
+    best_dst = np.zeros(len(detections))
+    np.maximum.at(best_src, src, ious)
+    np.maximum.at(best_dst, dst, ious)
+    mutual = (ious >= min_iou) & (ious == best_src[src]) & (ious == best_dst[dst])
+    src, dst = src[mutual], dst[mutual]
+
+    # With exact ties, only the first pair of each detection is kept.
+    _, first = np.unique(src, return_index=True)
+    src, dst = src[first], dst[first]
+    _, first = np.unique(dst, return_index=True)
+    src, dst = src[first], dst[first]
+
+    predecessor = np.full(len(detections), -1, dtype=np.int64)
+    predecessor[dst] = src
+    return predecessor
+
+
+def chains(predecessor):
+    """ Returns the chain index of each detection, i.e. the index of the
+    chain's first detection, and its position in the chain. """
+    chain = np.where(predecessor >= 0, predecessor, np.arange(len(predecessor)))
+    position = (predecessor >= 0).astype(np.int64)
+    # Follow the links back to the chains' first detections, doubling the
+    # distance covered each time.
+    while np.any(chain[chain] != chain):
+        position += position[chain]
+        chain = chain[chain]
+    return chain, position
+
+
+class KeySelector(object):
+    """ Decides, detection by detection, which ones need to be embedded.
+
+    A detection is a key detection if it starts a chain, is `every` steps
+    after the chain's last key detection, or its box overlaps that one's by
+    less than `min_iou`, or its image differs from that one's by more than
+    `max_change` on average (relative to 255). Detections are expected in
+    temporal order within each chain, any other order only causes more keys.
+
+    Args:
+        detections (2D array): All detections, see module docstring.
+        predecessor (1D array): The result of `link`.
+
+    Attributes:
+        is_key (1D array): Whether each detection was selected so far.
+        keys (list): The indices of the selected ones, in the order seen.
+    """
+    def __init__(self, detections, predecessor, every, min_iou=0.7,
+                 max_change=0.1):
+        self.boxes = detections[:, 2:6].astype(np.float64)
+        self.chain, _ = chains(predecessor)
+        # Chains are forgotten after their last detection.
+        self.is_last = np.ones(len(detections), dtype=bool)
+        self.is_last[predecessor[predecessor >= 0]] = False
+        self.every = every
+        self.min_iou = min_iou
+        self.max_change = max_change
+        self.last_key = {}
+        self.is_key = np.zeros(len(detections), dtype=bool)
+        self.keys = []
+
+    def __call__(self, index, image):
+        """ Whether detection `index`, whose snapshot is `image`, is a key. """
+        # Comparing a thumbnail is plenty for noticing changes.
+        image = np.asarray(image[::4, ::4], dtype=np.float32)
+        last = self.last_key.get(self.chain[index])
+        if last is None:
+            is_key = True
+        else:
+            last_index, last_image, steps = last
+            is_key = (
+                steps + 1 >= self.every or
+                box_iou(self.boxes[[index]], self.boxes[[last_index]])[0]
+                < self.min_iou or
+                np.mean(np.abs(image - last_image)) > self.max_change * 255)
+        if is_key:
+            self.last_key[self.chain[index]] = (index, image, 0)
+        else:
+            self.last_key[self.chain[index]] = (last_index, last_image, steps + 1)
+        if self.is_last[index]:
+            del self.last_key[self.chain[index]]
+        self.is_key[index] = is_key
+        if is_key:
+            self.keys.append(index)
+        return is_key
+
+
+def fill(embs, is_key, detections, predecessor, interpolate=True):
+    """ Fills the embeddings of non-key detections from their chain's key
+    detections, in place.
+
+    Each one gets those of the closest key detection before it, or, with
+    `interpolate`, the linear interpolation by frame between that and the
+    closest one after it, where there is one.
+
+    Args:
+        embs (array): The (N, ...) embeddings, only valid at key detections.
+        is_key (1D array): Whether each detection is a key detection.
+    """
+    chain, position = chains(predecessor)
+    frames = detections[:, 1].astype(np.float64)
+    order = np.lexsort((position, chain))
+    keys = is_key[order]
+
+    # For each detection, the position in `order` of the closest key before
+    # and after it within the same chain. Chains always start with a key.
+    idx = np.arange(len(order))
+    before = np.maximum.accumulate(np.where(keys, idx, 0))
+    after = np.minimum.accumulate(np.where(keys, idx, len(order))[::-1])[::-1]
+    same_chain = np.zeros(len(order), dtype=bool)
+    valid_after = after < len(order)
+    same_chain[valid_after] = (chain[order[after[valid_after]]] ==
+                               chain[order[valid_after]])
+    todo = np.logical_not(keys)
+
+    prev = order[before[todo]]
+    embs[order[todo]] = embs[prev]
+    if interpolate:
+        both = todo.copy()
+        both[todo] = same_chain[todo]
+        cur, prev = order[both], order[before[both]]
+        nxt = order[after[both]]
+        weight = (frames[cur] - frames[prev]) / (frames[nxt] - frames[prev])
+        weight = weight.reshape((-1,) + (1,) * (embs.ndim - 1))
+        embs[cur] = (1 - weight) * embs[prev] + weight * embs[nxt]
+    return embs
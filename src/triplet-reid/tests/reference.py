@@ -0,0 +1,38 @@
+""" Straightforward reference implementations the tests compare against. """
+
+import numpy as np
+from sklearn.metrics import average_precision_score
+
+
+def aps(distances, matches):
+    """ The AP of each row by scikit-learn, NaN for rows without a match.
+    Infinite distances are left out, as they stand for excluded entries. """
+    result = np.full(len(distances), np.nan)
+    for q, (dists, labels) in enumerate(zip(distances, matches)):
+        valid = np.isfinite(dists)
+        if np.any(labels[valid]):
+            result[q] = average_precision_score(labels[valid], -dists[valid])
+    return result
+
+
+def ranks(distances, matches):
+    """ The number of entries strictly closer than the closest match. """
+    result = np.full(len(distances), -1)
+    for q, (dists, labels) in enumerate(zip(distances, matches)):
+        if np.any(labels):
+            result[q] = np.sum(dists < np.min(dists[labels]))
+    return result
+
+
+def masked(distances, matches, excluded_mask):
+    """ Sets the excluded entries' distances to inf and unmarks them. """
+    distances, matches = distances.copy(), matches.copy()
+    distances[excluded_mask] = np.inf
+    matches[excluded_mask] = False
+    return distances, matches
+
+
+def integer_embeddings(rng, num, dim=4, high=3):
+    """ Embeddings on a small integer grid, such that there are many exactly
+    tied distances. """
+    return rng.randint(0, high, (num, dim)).astype(np.float64)
@@ -0,0 +1,49 @@
+import pytest
+
+import common
+
+
+class ListWriter(object):
+    """ Stands in for a `tf.summary.FileWriter`, failing on `'bad'`. """
+    def __init__(self):
+        self.summaries = []
+        self.closed = False
+
+    def add_summary(self, summary, global_step=None):
+        if summary == 'bad':
+            raise IOError('No space left on device')
+        self.summaries.append((summary, global_step))
+
+    def close(self):
+        self.closed = True
+
+
+def test_writes_all_in_order():
+    writer = ListWriter()
+    async_writer = common.AsyncSummaryWriter(writer)
+    for step in range(10):
+        async_writer.add_summary('s{}'.format(step), step)
+    async_writer.close()
+    assert writer.summaries == [('s{}'.format(i), i) for i in range(10)]
+    assert writer.closed
+
+
+def test_failure_is_raised_instead_of_blocking():
+    writer = ListWriter()
+    async_writer = common.AsyncSummaryWriter(writer, max_queue=2)
+    async_writer.add_summary('bad', 0)
+    # Way more than fit into the queue, the worker must keep draining it.
+    with pytest.raises(IOError):
+        for step in range(1, 100):
+            async_writer.add_summary('s', step)
+    async_writer.close()
+    assert writer.closed
+
+
+def test_failure_is_raised_on_close():
+    writer = ListWriter()
+    async_writer = common.AsyncSummaryWriter(writer)
+    async_writer.add_summary('bad', 0)
+    with pytest.raises(IOError):
+        async_writer.close()
+    assert writer.closed
@@ -0,0 +1,49 @@
+import numpy as np
+
+from detail_log import DetailLogReader, DetailLogWriter
+
+
+FIDS = ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']
+
+
+def log_iterations(writer, iterations, rng):
+    """ Appends random batches of two for `iterations`, returning them. """
+    logged = {}
+    for i in iterations:
+        fids = [FIDS[j] for j in rng.choice(len(FIDS), 2, replace=False)]
+        embs, losses = rng.randn(2, 3), rng.rand(2)
+        writer.append(i, embs, losses, [fid.encode() for fid in fids])
+        logged[i] = (embs, losses, fids)
+    return logged
+
+
+def test_read_ranges_across_chunks(tmpdir):
+    rng = np.random.RandomState(0)
+    with DetailLogWriter(str(tmpdir), FIDS, chunk_size=4) as writer:
+        logged = log_iterations(writer, range(10), rng)
+
+    reader = DetailLogReader(str(tmpdir))
+    assert reader.iteration_range() == (0, 9)
+    result = reader.read(3, 7)
+    np.testing.assert_array_equal(result['iterations'], [3, 4, 5, 6])
+    for row, i in enumerate(range(3, 7)):
+        embs, losses, fids = logged[i]
+        np.testing.assert_allclose(result['embeddings'][row], embs, rtol=1e-6)
+        np.testing.assert_allclose(result['losses'][row], losses, rtol=1e-6)
+        assert list(result['fids'][row]) == fids
+
+
+def test_flush_and_resume(tmpdir):
+    rng = np.random.RandomState(1)
+    writer = DetailLogWriter(str(tmpdir), FIDS, chunk_size=100)
+    log_iterations(writer, range(7), rng)
+    # As at a checkpoint, then killed before logging a full chunk.
+    writer.flush()
+    log_iterations(writer, range(7, 9), rng)
+    assert DetailLogReader(str(tmpdir)).iteration_range() == (0, 6)
+
+    # Resuming from iteration 5 drops everything logged from there on.
+    with DetailLogWriter(str(tmpdir), FIDS, start_iteration=5) as writer:
+        log_iterations(writer, range(5, 8), rng)
+    result = DetailLogReader(str(tmpdir)).read()
+    np.testing.assert_array_equal(result['iterations'], np.arange(8))
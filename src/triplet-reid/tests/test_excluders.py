@@ -0,0 +1,39 @@
+import numpy as np
+
+from excluders.market1501 import Excluder
+
+
+def market_fids(rng, num):
+    pids = rng.choice(['-1', '0002', '0007', '0011'], num)
+    cams = rng.randint(1, 4, num)
+    return np.array(['bounding_box_test/{}_c{}s1_{:06d}_00.jpg'.format(p, c, i)
+                     for i, (p, c) in enumerate(zip(pids, cams))])
+
+
+def key_and_junk(fid):
+    pid, rest = fid.split('/')[-1].split('_', 1)
+    return pid + '_' + rest[1], pid == '-1'
+
+
+def test_market1501_mask_and_pairs():
+    rng = np.random.RandomState(0)
+    gallery_fids = market_fids(rng, 50)
+    query_fids = market_fids(rng, 20)
+    # A query whose PID and camera never appear in the gallery.
+    query_fids[0] = 'query/0099_c9s1_000000_00.jpg'
+    excluder = Excluder(gallery_fids)
+
+    gallery = [key_and_junk(fid) for fid in gallery_fids]
+    expected = np.array([
+        [key == key_and_junk(query)[0] or junk for key, junk in gallery]
+        for query in query_fids])
+    np.testing.assert_array_equal(excluder(query_fids), expected)
+
+    codes = excluder.encode(query_fids)
+    assert codes[0] == -1
+    rows, cols = excluder.excluded_pairs(codes)
+    pairs = np.zeros_like(expected)
+    pairs[rows, cols] = True
+    np.testing.assert_array_equal(pairs | excluder.junk[None], expected)
+    # Each pair only once.
+    assert len(set(zip(rows, cols))) == len(rows)
@@ -0,0 +1,58 @@
+import h5py
+import numpy as np
+
+import feature_store
+
+
+def test_trajectory_means():
+    rng = np.random.RandomState(0)
+    trajectories = rng.choice([7, 3, 12], 50).astype(np.float64)
+    embs = rng.randn(50, 4)
+    ids, means = feature_store.trajectory_means(embs, trajectories)
+    np.testing.assert_array_equal(ids, [3, 7, 12])
+    assert ids.dtype == np.int64 and means.dtype == np.float32
+    for i, trajectory_id in enumerate(ids):
+        np.testing.assert_allclose(
+            means[i], np.mean(embs[trajectories == trajectory_id], axis=0),
+            rtol=1e-5)
+
+
+def write_store(path, frames, embs, chunk_frames):
+    """ Writes `embs` frame-indexed, the way `embed_detections.py` does. """
+    read_order = np.argsort(frames, kind='mergesort')
+    with h5py.File(path, 'w') as f:
+        chunks = feature_store.chunk_rows(frames, chunk_frames)
+        f.create_dataset('emb', data=embs[read_order].astype(np.float16),
+                         chunks=(chunks, embs.shape[1]))
+        feature_store.write_index(f, frames[read_order], read_order)
+
+
+def test_windows_hold_exactly_their_frames(tmpdir):
+    rng = np.random.RandomState(1)
+    # Frames with gaps, several detections per frame, in no particular order.
+    frames = rng.choice(np.r_[100:130, 160:200], 300)
+    embs = rng.randn(300, 4)
+    path = str(tmpdir.join('features.h5'))
+    write_store(path, frames, embs, chunk_frames=10)
+
+    store = feature_store.FeatureStore(path)
+    try:
+        for first, last in [(100, 100), (95, 110), (125, 170), (130, 159),
+                            (190, 250), (0, 50), (300, 400)]:
+            detections, window_embs = store.window(first, last)
+            expected = np.flatnonzero((first <= frames) & (frames <= last))
+            np.testing.assert_array_equal(np.sort(detections), expected)
+            np.testing.assert_allclose(window_embs, embs[detections],
+                                       rtol=1e-3, atol=1e-3)
+            assert window_embs.dtype == np.float32
+    finally:
+        store.close()
+
+
+def test_frame_offsets_and_chunks():
+    first_frame, offsets = feature_store.frame_offsets([5, 5, 7, 8, 8, 8])
+    assert first_frame == 5
+    np.testing.assert_array_equal(offsets, [0, 2, 2, 3, 6])
+    # 100 rows over 50 frames, so 10 frames are about 20 rows.
+    assert feature_store.chunk_rows(np.repeat(np.arange(50), 2), 10) == 20
+    assert feature_store.chunk_rows(np.arange(5), 1000) == 5
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import gallery_index
+
+
+def clustered(rng, num, dim=8, num_clusters=10):
+    centers = rng.randn(num_clusters, dim) * 5
+    return (centers[rng.randint(0, num_clusters, num)]
+            + rng.randn(num, dim)).astype(np.float32)
+
+
+def test_probing_all_lists_is_exact():
+    rng = np.random.RandomState(0)
+    gallery, queries = clustered(rng, 500), clustered(rng, 30)
+    index = gallery_index.GalleryIndex.build(gallery, num_lists=16, seed=0)
+    idxs, dists = index.search(queries, 10, nprobe=16)
+    true_idxs, true_dists = gallery_index.exact_search(queries, gallery, 10)
+    np.testing.assert_allclose(dists, true_dists, rtol=1e-5)
+    assert gallery_index.recall_at_k(idxs, true_idxs) == 1.0
+
+    # Fewer probes never find more.
+    few_idxs, _ = index.search(queries, 10, nprobe=2)
+    assert gallery_index.recall_at_k(few_idxs, true_idxs) <= 1.0
+
+
+def test_stale_index_is_rejected(tmpdir):
+    rng = np.random.RandomState(1)
+    gallery = clustered(rng, 200)
+    path = str(tmpdir.join('emb_ivf.npz'))
+    gallery_index.GalleryIndex.build(gallery, num_lists=8, seed=0).save(path)
+
+    index = gallery_index.GalleryIndex.load(path, gallery)
+    assert index.matches(gallery)
+    assert not index.matches(gallery, 'cityblock')
+
+    # Same size, but embedded again, e.g. by another checkpoint.
+    with pytest.raises(ValueError):
+        gallery_index.GalleryIndex.load(path, gallery + 1e-3)
+
+
+def test_default_path():
+    assert gallery_index.default_path('a/test.h5') == 'a/test_ivf.npz'
+    assert gallery_index.default_path('a/test.h5', 'model1') == (
+        'a/test_model1_ivf.npz')
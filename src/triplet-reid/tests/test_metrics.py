@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+import metrics
+import reference
+
+
+def random_problem(seed, num_queries=40, num_gallery=70, num_pids=12):
+    rng = np.random.RandomState(seed)
+    query_embs = reference.integer_embeddings(rng, num_queries)
+    gallery_embs = reference.integer_embeddings(rng, num_gallery)
+    query_pids = rng.randint(0, num_pids, num_queries)
+    gallery_pids = rng.randint(0, num_pids, num_gallery)
+    # Some queries without any match in the gallery.
+    query_pids[:3] = num_pids + np.arange(3)
+    return rng, query_embs, query_pids, gallery_embs, gallery_pids
+
+
+def test_average_precision_with_ties():
+    rng = np.random.RandomState(0)
+    distances = rng.randint(0, 4, (30, 25)).astype(np.float64)
+    matches = rng.rand(30, 25) < 0.2
+    matches[0] = False
+    np.testing.assert_allclose(
+        metrics.average_precision(distances, matches),
+        reference.aps(distances, matches))
+
+
+def test_first_match_rank_and_cmc():
+    rng = np.random.RandomState(1)
+    distances = rng.randint(0, 5, (30, 25)).astype(np.float64)
+    matches = rng.rand(30, 25) < 0.1
+    matches[0] = False
+    ranks = metrics.first_match_rank(distances, matches)
+    np.testing.assert_array_equal(ranks, reference.ranks(distances, matches))
+
+    cmc = metrics.cmc(ranks, 25)
+    for k in range(25):
+        assert cmc[k] == pytest.approx(np.mean((0 <= ranks) & (ranks <= k)))
+
+
+def test_evaluate_matches_sklearn():
+    _, query_embs, query_pids, gallery_embs, gallery_pids = random_problem(2)
+    mask = np.zeros((len(query_pids), len(gallery_pids)), dtype=bool)
+    mask[::2, ::3] = True
+    aps, ranks = metrics.evaluate(
+        query_embs, query_pids, gallery_embs, gallery_pids, 'euclidean', mask)
+
+    distances, matches = reference.masked(
+        metrics.cdist(query_embs, gallery_embs),
+        query_pids[:, None] == gallery_pids[None], mask)
+    np.testing.assert_allclose(aps, reference.aps(distances, matches))
+    np.testing.assert_array_equal(ranks, reference.ranks(distances, matches))
+
+
+@pytest.mark.parametrize('memory_limit', [2**30, 2**10])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_evaluate_tiled(memory_limit, workers):
+    rng, query_embs, query_pids, gallery_embs, gallery_pids = random_problem(3)
+    junk = rng.rand(len(gallery_pids)) < 0.1
+    excluded_mask = rng.rand(len(query_pids), len(gallery_pids)) < 0.2
+    excluded = np.nonzero(excluded_mask)
+
+    top_k = 10
+    result = metrics.evaluate_tiled(
+        query_embs, query_pids, gallery_embs, gallery_pids, 'euclidean',
+        excluded=excluded, exclude_gallery=junk, batch_size=7,
+        memory_limit=memory_limit, top_k=top_k, workers=workers)
+
+    distances, matches = reference.masked(
+        metrics.cdist(query_embs, gallery_embs),
+        query_pids[:, None] == gallery_pids[None], excluded_mask | junk)
+    np.testing.assert_allclose(result.aps, reference.aps(distances, matches))
+    np.testing.assert_array_equal(
+        result.ranks, reference.ranks(distances, matches))
+
+    # Ties may come in any order, but the distances must be the top-k ones.
+    expected = np.sort(distances, axis=1)[:, :top_k]
+    np.testing.assert_array_equal(result.top_k_distances, expected)
+    valid = result.top_k_indices >= 0
+    np.testing.assert_array_equal(valid, np.isfinite(expected))
+    rows = np.nonzero(valid)[0]
+    np.testing.assert_array_equal(
+        distances[rows, result.top_k_indices[valid]],
+        result.top_k_distances[valid])
+
+
+def test_evaluate_tiled_few_gallery_entries():
+    # Fewer non-excluded entries than `top_k`, which need padding.
+    rng, query_embs, query_pids, gallery_embs, gallery_pids = random_problem(
+        4, num_gallery=6, num_pids=3)
+    result = metrics.evaluate_tiled(
+        query_embs, query_pids, gallery_embs, gallery_pids, 'euclidean',
+        top_k=8)
+    assert np.all(result.top_k_indices[:, 6:] == -1)
+    assert np.all(np.isinf(result.top_k_distances[:, 6:]))
+    assert np.all(result.top_k_indices[:, :6] >= 0)
+
+
+def test_merge_top_k():
+    rng = np.random.RandomState(5)
+    dists = rng.rand(4, 30)
+    top_dists = np.empty((4, 0))
+    top_idxs = np.empty((4, 0), dtype=np.int64)
+    for lo in range(0, 30, 7):
+        cols = np.arange(lo, min(lo + 7, 30))
+        top_dists, top_idxs = metrics.merge_top_k(
+            top_dists, top_idxs, dists[:, cols], cols, 5)
+    order = np.argsort(top_dists, axis=1)
+    np.testing.assert_array_equal(np.take_along_axis(top_idxs, order, axis=1),
+                                  np.argsort(dists, axis=1)[:, :5])
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import metrics
+from product_quantization import ProductQuantizer
+
+
+@pytest.mark.parametrize('metric', metrics.cdist.supported_metrics)
+def test_adc_equals_distance_to_decoded(metric):
+    rng = np.random.RandomState(0)
+    embs = rng.randn(600, 16).astype(np.float32)
+    queries = rng.randn(20, 16).astype(np.float32)
+    quantizer = ProductQuantizer.train(embs, 4, iterations=5, seed=0)
+    codes = quantizer.encode(embs, batch_size=256)
+    assert codes.shape == (600, 4) and codes.dtype == np.uint8
+
+    expected = metrics.cdist(queries, quantizer.decode(codes), metric)
+    np.testing.assert_allclose(
+        quantizer.distance_function(metric)(queries, codes), expected,
+        rtol=1e-4, atol=1e-4)
+
+
+def test_few_points_are_encoded_exactly():
+    # With no more points than centroids, every point is its own centroid.
+    rng = np.random.RandomState(1)
+    embs = rng.randn(50, 8).astype(np.float32)
+    quantizer = ProductQuantizer.train(embs, 2, iterations=3, seed=0)
+    np.testing.assert_allclose(quantizer.decode(quantizer.encode(embs)), embs,
+                               rtol=1e-6)
+
+
+def test_code_size_must_divide_dimension():
+    with pytest.raises(ValueError):
+        ProductQuantizer.train(np.zeros((10, 10), np.float32), 3)
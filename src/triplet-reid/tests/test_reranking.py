@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import metrics
+import reranking
+
+
+def dense_re_ranking(query_embs, gallery_embs, metric, k1, k2, lambda_value):
+    """ The dense re-ranking as in the authors' reference implementation. """
+    embs = np.concatenate([query_embs, gallery_embs]).astype(np.float64)
+    num_queries, num_items = len(query_embs), len(embs)
+    original_dist = metrics.cdist(embs, embs, metric)
+    original_dist /= np.max(original_dist, axis=1, keepdims=True)
+    initial_rank = np.argsort(original_dist, axis=1, kind='mergesort')
+
+    def k_reciprocal(i, k):
+        forward = initial_rank[i, :k + 1]
+        backward = initial_rank[forward, :k + 1]
+        return forward[np.where(backward == i)[0]]
+
+    V = np.zeros_like(original_dist)
+    for i in range(num_items):
+        reciprocal = k_reciprocal(i, k1)
+        expansion = reciprocal
+        for candidate in reciprocal:
+            candidate_reciprocal = k_reciprocal(candidate, int(np.around(k1 / 2)))
+            if (len(np.intersect1d(candidate_reciprocal, reciprocal))
+                    > 2 / 3 * len(candidate_reciprocal)):
+                expansion = np.append(expansion, candidate_reciprocal)
+        expansion = np.unique(expansion)
+        weight = np.exp(-original_dist[i, expansion])
+        V[i, expansion] = weight / np.sum(weight)
+
+    if k2 != 1:
+        V = np.stack([np.mean(V[initial_rank[i, :k2]], axis=0)
+                      for i in range(num_items)])
+
+    jaccard = np.zeros((num_queries, num_items - num_queries))
+    for i in range(num_queries):
+        overlap = np.sum(np.minimum(V[i], V[num_queries:]), axis=1)
+        jaccard[i] = 1 - overlap / (2 - overlap)
+    return (jaccard * (1 - lambda_value)
+            + original_dist[:num_queries, num_queries:] * lambda_value)
+
+
+@pytest.mark.parametrize('metric,k2', [('euclidean', 3), ('sqeuclidean', 1)])
+def test_matches_dense_reference(metric, k2):
+    rng = np.random.RandomState(0)
+    centers = rng.randn(6, 8) * 3
+    query_embs = centers[rng.randint(0, 6, 15)] + rng.randn(15, 8)
+    gallery_embs = centers[rng.randint(0, 6, 45)] + rng.randn(45, 8)
+
+    reranker = reranking.KReciprocalReRanker(
+        query_embs, gallery_embs, metric, k1=6, k2=k2, lambda_value=0.3,
+        batch_size=7, memory_limit=2**12)
+    dists = reranker(reranker.query_keys, reranker.gallery_keys)
+    expected = dense_re_ranking(query_embs, gallery_embs, metric, 6, k2, 0.3)
+    np.testing.assert_allclose(dists, expected, rtol=1e-4, atol=1e-5)
+
+    # Any tile of keys gives the same distances, as used by `evaluate_tiled`.
+    np.testing.assert_allclose(
+        reranker(reranker.query_keys[3:9], reranker.gallery_keys[10:20]),
+        dists[3:9, 10:20], rtol=1e-6)
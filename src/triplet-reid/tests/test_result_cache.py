@@ -0,0 +1,44 @@
+import numpy as np
+
+import metrics
+import result_cache
+
+
+def test_apply_exclusions_equals_uncached(tmpdir):
+    rng = np.random.RandomState(0)
+    query_embs, gallery_embs = rng.randn(150, 8), rng.randn(200, 8)
+    query_pids = rng.randint(0, 30, 150).astype(str)
+    gallery_pids = rng.randint(0, 30, 200).astype(str)
+    # Queries without matches, also starting a batch.
+    query_pids[[0, 64]] = ['none1', 'none2']
+    junk = rng.rand(200) < 0.1
+    # Exclude most of the gallery for some, as for same-camera images.
+    cams_q, cams_g = rng.randint(0, 3, 150), rng.randint(0, 3, 200)
+    excluded_mask = (cams_q[:, None] == cams_g[None]) & (rng.rand(150, 200) < 0.9)
+    # All matches of another query starting a batch are excluded.
+    excluded_mask[32, gallery_pids == query_pids[32]] = True
+    excluded = np.nonzero(excluded_mask)
+
+    top_k = 30
+    expected = metrics.evaluate_tiled(
+        query_embs, query_pids, gallery_embs, gallery_pids, 'euclidean',
+        excluded=excluded, exclude_gallery=junk, top_k=top_k, batch_size=32)
+
+    # Going through the file, with few enough cached neighbors that some
+    # queries run out of them.
+    path = str(tmpdir.join('cache.npz'))
+    key = result_cache.cache_key([], [query_pids, gallery_pids], 'euclidean')
+    result_cache.save(path, key, metrics.evaluate_tiled(
+        query_embs, query_pids, gallery_embs, gallery_pids, 'euclidean',
+        top_k=40, match_details=True, batch_size=32))
+    assert result_cache.load(path, 'other key') is None
+    assert result_cache.load(path, key, top_k=50) is None
+    cached = result_cache.load(path, key, top_k)
+
+    result = result_cache.apply_exclusions(
+        cached, query_embs, query_pids, gallery_embs, gallery_pids,
+        'euclidean', excluded, junk, top_k, batch_size=32)
+    np.testing.assert_allclose(result.aps, expected.aps)
+    np.testing.assert_array_equal(result.ranks, expected.ranks)
+    np.testing.assert_allclose(result.top_k_distances, expected.top_k_distances)
+    np.testing.assert_array_equal(result.top_k_indices, expected.top_k_indices)
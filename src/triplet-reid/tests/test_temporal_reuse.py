@@ -0,0 +1,77 @@
+import numpy as np
+
+import temporal_reuse
+
+
+def two_tracks(rng):
+    """ Two people walking slowly through 10 frames of camera 1, and one
+    standing in camera 2, as rows of [camera, frame, left, top, w, h],
+    shuffled. Returns them and each one's track. """
+    rows, tracks = [], []
+    for frame in range(1, 11):
+        rows.append([1, frame, 100 + 2 * frame, 50, 40, 100])
+        rows.append([1, frame, 600 - 3 * frame, 80, 50, 120])
+        rows.append([2, frame, 300, 300, 40, 100])
+        tracks += [0, 1, 2]
+    order = rng.permutation(len(rows))
+    return np.array(rows, np.float64)[order], np.array(tracks)[order]
+
+
+def test_link_and_chains():
+    detections, tracks = two_tracks(np.random.RandomState(0))
+    predecessor = temporal_reuse.link(detections)
+    linked = predecessor >= 0
+    # Every detection but the first of each track is linked to the one of
+    # its track in the previous frame.
+    assert np.sum(~linked) == 3
+    assert np.all(detections[~linked, 1] == 1)
+    np.testing.assert_array_equal(tracks[predecessor[linked]], tracks[linked])
+    np.testing.assert_array_equal(detections[predecessor[linked], 1],
+                                  detections[linked, 1] - 1)
+
+    chain, position = temporal_reuse.chains(predecessor)
+    np.testing.assert_array_equal(position, detections[:, 1] - 1)
+    for track in range(3):
+        assert len(np.unique(chain[tracks == track])) == 1
+
+
+def test_select_and_fill():
+    detections, tracks = two_tracks(np.random.RandomState(1))
+    predecessor = temporal_reuse.link(detections)
+    selector = temporal_reuse.KeySelector(detections, predecessor, every=3)
+    image = np.zeros((16, 8, 3))
+    for i in np.argsort(detections[:, 1], kind='mergesort'):
+        selector(i, image)
+    # Same images and boxes barely moving: every 3rd frame is a key.
+    np.testing.assert_array_equal(
+        selector.is_key, (detections[:, 1] - 1) % 3 == 0)
+
+    # Embeddings linear in the frame are interpolated exactly...
+    truth = np.stack([detections[:, 1] * (tracks + 1), -detections[:, 1]], 1)
+    embs = np.where(selector.is_key[:, None], truth, np.nan)
+    temporal_reuse.fill(embs, selector.is_key, detections, predecessor)
+    np.testing.assert_allclose(embs, truth)
+
+    # ...or copied from the last key before them.
+    embs = np.where(selector.is_key[:, None], truth, np.nan)
+    temporal_reuse.fill(embs, selector.is_key, detections, predecessor,
+                        interpolate=False)
+    key_frames = detections[:, 1] - (detections[:, 1] - 1) % 3
+    np.testing.assert_allclose(
+        embs, np.stack([key_frames * (tracks + 1), -key_frames], 1))
+
+
+def test_changed_image_is_key():
+    detections, _ = two_tracks(np.random.RandomState(2))
+    predecessor = temporal_reuse.link(detections)
+    selector = temporal_reuse.KeySelector(detections, predecessor, every=100)
+    for i in np.argsort(detections[:, 1], kind='mergesort'):
+        changed = detections[i, 1] == 5 and detections[i, 0] == 2
+        selector(i, np.full((16, 8, 3), 255.0 if changed else 0.0))
+    # In camera 2, the change and the change back are keys. In camera 1, the
+    # boxes moved too far from the first one every few frames.
+    camera2 = detections[:, 0] == 2
+    np.testing.assert_array_equal(
+        selector.is_key[camera2], np.isin(detections[camera2, 1], [1, 5, 6]))
+    camera1_keys = np.sort(detections[selector.is_key & ~camera2, 1])
+    np.testing.assert_array_equal(camera1_keys, [1, 1, 4, 5, 7, 9, 10])
@@ -14,10 +14,15 @@ import tensorflow as tf
 from tensorflow.contrib import slim
 
 import common
+from detail_log import DetailLogWriter
 import lbtoolbox as lb
 import loss
+import profiling
+import shards
+from validation import Validator
 from nets import NET_CHOICES
 from heads import HEAD_CHOICES
+from excluders import EXCLUDER_CHOICES
 
 import imgaug as ia
 from imgaug import augmenters as iaa
@@ -27,6 +32,9 @@ import scipy.spatial.distance
 
 parser = ArgumentParser(description='Train a ReID network.')
 
+# The collection of the expensive summaries, evaluated every few iterations.
+HISTOGRAM_SUMMARIES = 'histogram_summaries'
+
 # Required.
 
 parser.add_argument(
@@ -41,6 +49,12 @@ parser.add_argument(
     '--image_root', type=common.readable_directory,
     help='Path that will be pre-pended to the filenames in the train_set csv.')
 
+parser.add_argument(
+    '--shards', default=None,
+    help='Index of TFRecord shards of the train_set written by '
+         '`make_shards.py`. If provided, the images are streamed from these, '
+         'several shards in parallel, instead of read from the `image_root`.')
+
 # Optional with sane defaults.
 
 parser.add_argument(
@@ -97,6 +111,12 @@ parser.add_argument(
     '--loading_threads', default=8, type=common.positive_int,
     help='Number of threads used for parallel loading.')
 
+parser.add_argument(
+    '--shuffle_buffer', default=4096, type=common.positive_int,
+    help='Number of records of the `shards` that are shuffled together before'
+         ' grouping them into PK-batches. The larger, the more random the PIDs'
+         ' of a batch, at the cost of holding as many encoded images in memory.')
+
 parser.add_argument(
     '--margin', default='soft', type=common.float_or_string,
     help='What margin to use: a float value for hard-margin, "soft" for '
@@ -145,10 +165,106 @@ parser.add_argument(
 parser.add_argument(
     '--detailed_logs', action='store_true', default=False,
     help='Store very detailed logs of the training in addition to TensorBoard'
-         ' summaries. These are mem-mapped numpy files containing the'
-         ' embeddings, losses and FIDs seen in each batch during training.'
+         ' summaries. These are compressed chunks in the `detailed_logs` folder'
+         ' containing the embeddings, losses and FIDs seen in each batch during'
+         ' training, see `detail_log.py` for reading them back.'
          ' Everything can be re-constructed and analyzed that way.')
 
+parser.add_argument(
+    '--detailed_logs_chunk', default=100, type=common.positive_int,
+    help='How many iterations of detailed logs are collected per chunk. A'
+         ' chunk is also written at every checkpoint, anything logged since the'
+         ' last one is lost when training is killed.')
+
+parser.add_argument(
+    '--detailed_logs_float16', action='store_true', default=False,
+    help='Store the embeddings in the detailed logs as float16, halving their'
+         ' size.')
+
+parser.add_argument(
+    '--distillation', default=None, choices=loss.DISTILLATION_CHOICES.keys(),
+    help='Additionally train the network to mimic a teacher network, either'
+         ' its `embedding` (requires the same `embedding_dim`), or only the'
+         ' pairwise `distance`s within a batch. The teacher is given either by'
+         ' `teacher_root` or by `teacher_embeddings`.')
+
+parser.add_argument(
+    '--distillation_weight', default=1.0, type=common.positive_float,
+    help='Weight of the distillation loss relative to the triplet loss.')
+
+parser.add_argument(
+    '--teacher_root', type=common.readable_directory,
+    help='Experiment root of the trained teacher network. It is run frozen'
+         ' alongside the network being trained, on the very same images.')
+
+parser.add_argument(
+    '--teacher_checkpoint', default=None,
+    help='Name of the checkpoint file of the teacher within `teacher_root`.'
+         ' Uses the last checkpoint if not provided.')
+
+parser.add_argument(
+    '--teacher_embeddings', default=None,
+    help='Path to the h5 file of the teacher embeddings of the `train_set`, as'
+         ' written by `embed.py`. When provided, these are used instead of'
+         ' running the teacher, which is much faster. Note that these are the'
+         ' embeddings of the non-augmented images though.')
+
+parser.add_argument(
+    '--validation_frequency', default=0, type=common.nonnegative_int,
+    help='Every how many iterations to compute mAP and CMC on the validation'
+         ' query/gallery sets. The results are written to TensorBoard and the'
+         ' best checkpoint so far is kept in the `best` folder. Set this to 0'
+         ' to disable validation (the default).')
+
+parser.add_argument(
+    '--validation_query_set',
+    help='Path to the validation query set csv file.')
+
+parser.add_argument(
+    '--validation_gallery_set',
+    help='Path to the validation gallery set csv file.')
+
+parser.add_argument(
+    '--validation_image_root', type=common.readable_directory,
+    help='Path that will be pre-pended to the filenames in the validation csv'
+         ' files. Defaults to `image_root`, so it is required when training'
+         ' from `shards` without one.')
+
+parser.add_argument(
+    '--validation_excluder', default='diagonal', choices=EXCLUDER_CHOICES,
+    help='Excluder used for validation, see `evaluate.py`.')
+
+parser.add_argument(
+    '--validation_batch_size', default=256, type=common.positive_int,
+    help='Batch size used for embedding the validation images. Note that all'
+         ' validation images are kept decoded in memory, at about 100kB per'
+         ' image at the default input size, so keep the sets small.')
+
+parser.add_argument(
+    '--histogram_frequency', default=100, type=common.nonnegative_int,
+    help='Every how many iterations the histogram summaries (distances,'
+         ' losses, embedding lengths) are computed and written. These are much'
+         ' more expensive than the scalar summaries, which are written every'
+         ' iteration. Set to 0 to disable them completely.')
+
+parser.add_argument(
+    '--profile_stages', action='store_true', default=False,
+    help='Time the input pipeline separately from the forward/backward pass by'
+         ' fetching each batch in its own `sess.run` and feeding it back in.'
+         ' This costs an extra copy of the batch, so only use it to hunt down'
+         ' stalls. All stage timings are written to TensorBoard as `timing/*`.')
+
+parser.add_argument(
+    '--trace_frequency', default=0, type=common.nonnegative_int,
+    help='Every how many iterations a full trace of the step is recorded into'
+         ' the `traces` folder of the experiment root, both as `RunMetadata`'
+         ' and as Chrome-trace timeline. Set to 0 to disable (the default).')
+
+parser.add_argument(
+    '--trace_slow_steps', default=None, type=common.positive_float,
+    help='If provided, the step following any step that took longer than this'
+         ' many seconds is traced, just like with `trace_frequency`.')
+
 parser.add_argument(
     '--hard_pool_size', default=0, type=common.nonnegative_int,
     help='Number of IDs in hard identity pool')
@@ -341,14 +457,42 @@ def main():
         parser.print_help()
         log.error("You did not specify the `train_set` argument!")
         sys.exit(1)
-    if not args.image_root:
+    if not args.image_root and not args.shards:
         parser.print_help()
         log.error("You did not specify the required `image_root` argument!")
         sys.exit(1)
+    if args.distillation is not None and not (
+            args.teacher_root or args.teacher_embeddings):
+        parser.print_help()
+        log.error("Distillation requires either the `teacher_root` or the"
+                  " `teacher_embeddings` argument!")
+        sys.exit(1)
+    if args.validation_frequency > 0 and not (
+            args.validation_query_set and args.validation_gallery_set):
+        parser.print_help()
+        log.error("Validation requires both the `validation_query_set` and the"
+                  " `validation_gallery_set` arguments!")
+        sys.exit(1)
+    if (args.validation_frequency > 0 and not args.image_root and
+            not args.validation_image_root):
+        parser.print_help()
+        log.error("Validation with `shards` but without `image_root` requires"
+                  " the `validation_image_root` argument!")
+        sys.exit(1)
+    if args.shards and args.hard_pool_size > 0:
+        parser.print_help()
+        log.error("The hard identity pool can't be sampled from `shards`!")
+        sys.exit(1)
 
-    # Load the data from the CSV file.
-    pids, fids = common.load_dataset(args.train_set, args.image_root)
-    max_fid_len = max(map(len, fids))  # We'll need this later for logfiles.
+    # Load the data from the CSV file, which the shards must hold, if any.
+    if args.shards:
+        pids, fids = common.load_dataset(args.train_set, None)
+        if not np.array_equal(shards.load_index(args.shards)['fids'], fids):
+            raise IOError('The shards of `{}` do not hold the train_set `{}`.'
+                          .format(args.shards, args.train_set))
+    else:
+        pids, fids = common.load_dataset(args.train_set, args.image_root)
+    dataset_fids = fids  # We'll need this later for logfiles.
 
     # Load feature embeddings
     if args.hard_pool_size > 0:
@@ -357,47 +501,54 @@ def main():
             f_dists = scipy.spatial.distance.cdist(train_embs,train_embs)
             hard_ids = get_hard_id_pool(pids, f_dists, args.hard_pool_size)
 
-    # Setup a tf.Dataset where one "epoch" loops over all PIDS.
-    # PIDS are shuffled after every epoch and continue indefinitely.
-    unique_pids = np.unique(pids)
-    dataset = tf.data.Dataset.from_tensor_slices(unique_pids)
-    dataset = dataset.shuffle(len(unique_pids))
-
-    # Constrain the dataset size to a multiple of the batch-size, so that
-    # we don't get overlap at the end of each epoch.
-    if args.hard_pool_size == 0:
-        dataset = dataset.take((len(unique_pids) // args.batch_p) * args.batch_p)
-        dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
+    if args.shards:
+        # Stream the shards, grouped by PID into K images each, instead.
+        dataset = shards.pk_dataset(
+            args.shards, args.batch_k, loading_threads=args.loading_threads,
+            shuffle_buffer=args.shuffle_buffer)
 
+        def load_image(image_encoded, fid, pid, image_size):
+            return common.decode_image(image_encoded, image_size), fid, pid
     else:
-        dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
-        dataset = dataset.map(lambda pid: sample_batch_ids_for_pid(
-            pid,  all_pids=pids, batch_p=args.batch_p, all_hard_pids=hard_ids))
-        # Unbatch the P PIDs
-        dataset = dataset.apply(tf.contrib.data.unbatch()) 
+        # Setup a tf.Dataset where one "epoch" loops over all PIDS.
+        # PIDS are shuffled after every epoch and continue indefinitely.
+        unique_pids = np.unique(pids)
+        dataset = tf.data.Dataset.from_tensor_slices(unique_pids)
+        dataset = dataset.shuffle(len(unique_pids))
+
+        # Constrain the dataset size to a multiple of the batch-size, so that
+        # we don't get overlap at the end of each epoch.
+        if args.hard_pool_size == 0:
+            dataset = dataset.take((len(unique_pids) // args.batch_p) * args.batch_p)
+            dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
+
+        else:
+            dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
+            dataset = dataset.map(lambda pid: sample_batch_ids_for_pid(
+                pid,  all_pids=pids, batch_p=args.batch_p, all_hard_pids=hard_ids))
+            # Unbatch the P PIDs
+            dataset = dataset.apply(tf.contrib.data.unbatch()) 
 
  
-    # For every PID, get K images.
-    dataset = dataset.map(lambda pid: sample_k_fids_for_pid(
-        pid, all_fids=fids, all_pids=pids, batch_k=args.batch_k))
+        # For every PID, get K images.
+        dataset = dataset.map(lambda pid: sample_k_fids_for_pid(
+            pid, all_fids=fids, all_pids=pids, batch_k=args.batch_k))
+
+        # Ungroup/flatten the batches for easy loading of the files.
+        dataset = dataset.apply(tf.contrib.data.unbatch())
 
-    # Ungroup/flatten the batches for easy loading of the files.
-    dataset = dataset.apply(tf.contrib.data.unbatch())
+        def load_image(fid, pid, image_size):
+            return common.fid_to_image(
+                fid, pid, image_root=args.image_root, image_size=image_size)
 
-    # Convert filenames to actual image tensors.
     net_input_size = (args.net_input_height, args.net_input_width)
     pre_crop_size = (args.pre_crop_height, args.pre_crop_width)
-    dataset = dataset.map(
-        lambda  fid, pid: common.fid_to_image(
-            fid, pid, image_root=args.image_root,
-            image_size=pre_crop_size if args.crop_augment else net_input_size),
-        num_parallel_calls=args.loading_threads)
 
     # Augment the data if specified by the arguments.
     if args.augment == False:
         dataset = dataset.map(
-            lambda im, fid, pid: common.fid_to_image(
-                fid, pid, image_root=args.image_root,
+            lambda *record: load_image(
+                *record,
                 image_size=pre_crop_size if args.crop_augment else net_input_size),   #Ergys
             num_parallel_calls=args.loading_threads)
 
@@ -409,9 +560,7 @@ def main():
                 lambda im, fid, pid: (tf.random_crop(im, net_input_size + (3,)), fid, pid))
     else:
         dataset = dataset.map(
-            lambda im, fid, pid: common.fid_to_image(
-                fid, pid, image_root=args.image_root,
-                image_size=net_input_size),
+            lambda *record: load_image(*record, image_size=net_input_size),
             num_parallel_calls=args.loading_threads)
         
         dataset = dataset.map(
@@ -433,12 +582,65 @@ def main():
     model = import_module('nets.' + args.model_name)
     head = import_module('heads.' + args.head_name)
 
+    # When validating, the very same network is used in inference mode, by
+    # feeding the validation images as input and switching `is_training` off.
+    if args.validation_frequency > 0:
+        is_training = tf.placeholder_with_default(True, shape=(), name='is_training')
+    else:
+        is_training = True
+
     # Feed the image through the model. The returned `body_prefix` will be used
     # further down to load the pre-trained weights for all variables with this
     # prefix.
-    endpoints, body_prefix = model.endpoints(images, is_training=True)
+    endpoints, body_prefix = model.endpoints(images, is_training=is_training)
     with tf.name_scope('head'):
-        endpoints = head.head(endpoints, args.embedding_dim, is_training=True)
+        endpoints = head.head(endpoints, args.embedding_dim, is_training=is_training)
+
+    if args.validation_frequency > 0:
+        validator = Validator(
+            args.validation_query_set, args.validation_gallery_set,
+            args.validation_image_root or args.image_root,
+            args.validation_excluder,
+            image_size=pre_crop_size if args.crop_augment else net_input_size,
+            crop_size=net_input_size if args.crop_augment else None,
+            metric=args.metric, batch_size=args.validation_batch_size,
+            loading_threads=args.loading_threads)
+
+    # Get the teacher's embeddings of the batch for distillation, either by
+    # running the frozen teacher on it, or by looking them up in the cache.
+    if args.distillation is not None and args.teacher_embeddings is not None:
+        with h5py.File(args.teacher_embeddings, 'r') as f_teacher:
+            cached_teacher_embs = np.array(f_teacher['emb'])
+        if len(cached_teacher_embs) != len(dataset_fids):
+            raise ValueError('The teacher embeddings ({}) need to contain exactly'
+                             ' one row per entry of the train_set ({}).'.format(
+                                 len(cached_teacher_embs), len(dataset_fids)))
+
+        # These live in a local variable, which is neither initialized from a
+        # constant nor saved, since that would blow up the stored meta-graph.
+        teacher_cache = tf.Variable(
+            tf.zeros(cached_teacher_embs.shape, tf.float32), trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES], name='teacher_cache')
+        teacher_cache_value = tf.placeholder(tf.float32, cached_teacher_embs.shape)
+        teacher_cache_init = teacher_cache.assign(teacher_cache_value)
+        fid_table = tf.contrib.lookup.index_table_from_tensor(dataset_fids)
+        teacher_embs = tf.gather(teacher_cache, fid_table.lookup(fids))
+    elif args.distillation is not None:
+        with open(os.path.join(args.teacher_root, 'args.json'), 'r') as f:
+            teacher_args = json.load(f)
+        teacher_model = import_module('nets.' + teacher_args['model_name'])
+        teacher_head = import_module('heads.' + teacher_args['head_name'])
+
+        # The teacher lives in its own scope, such that it may even be of the
+        # same architecture. It is always in inference mode.
+        with tf.variable_scope('teacher'):
+            teacher_endpoints, _ = teacher_model.endpoints(images, is_training=False)
+            with tf.name_scope('head'):
+                teacher_endpoints = teacher_head.head(
+                    teacher_endpoints, teacher_args['embedding_dim'],
+                    is_training=False)
+        teacher_embs = tf.stop_gradient(teacher_endpoints['emb'])
+        teacher_saver = common.scoped_saver('teacher')
 
     # Create the loss in two steps:
     # 1. Compute all pairwise distances according to the specified metric.
@@ -451,31 +653,29 @@ def main():
     num_active = tf.reduce_sum(tf.cast(tf.greater(losses, 1e-5), tf.float32))
     loss_mean = tf.reduce_mean(losses)
 
-    # Some logging for tensorboard.
-    tf.summary.histogram('loss_distribution', losses)
+    # Possibly add the distillation loss on top.
+    if args.distillation is not None:
+        distillation_mean = tf.reduce_mean(
+            loss.DISTILLATION_CHOICES[args.distillation](
+                endpoints['emb'], teacher_embs, args.metric))
+        tf.summary.scalar('distillation_loss', distillation_mean)
+        loss_mean = loss_mean + args.distillation_weight * distillation_mean
+
+    # Some logging for tensorboard. The scalars are cheap and evaluated every
+    # iteration, the histograms (especially the one over all BxB distances)
+    # are not, so they go into their own collection with their own cadence.
     tf.summary.scalar('loss', loss_mean)
     tf.summary.scalar('batch_top1', train_top1)
     tf.summary.scalar('batch_prec_at_{}'.format(args.batch_k-1), prec_at_k)
     tf.summary.scalar('active_count', num_active)
-    tf.summary.histogram('embedding_dists', dists)
-    tf.summary.histogram('embedding_pos_dists', pos_dists)
-    tf.summary.histogram('embedding_neg_dists', neg_dists)
+    histograms = [HISTOGRAM_SUMMARIES]
+    tf.summary.histogram('loss_distribution', losses, collections=histograms)
+    tf.summary.histogram('embedding_dists', dists, collections=histograms)
+    tf.summary.histogram('embedding_pos_dists', pos_dists, collections=histograms)
+    tf.summary.histogram('embedding_neg_dists', neg_dists, collections=histograms)
     tf.summary.histogram('embedding_lengths',
-                         tf.norm(endpoints['emb_raw'], axis=1))
-
-    # Create the mem-mapped arrays in which we'll log all training detail in
-    # addition to tensorboard, because tensorboard is annoying for detailed
-    # inspection and actually discards data in histogram summaries.
-    if args.detailed_logs:
-        log_embs = lb.create_or_resize_dat(
-            os.path.join(args.experiment_root, 'embeddings'),
-            dtype=np.float32, shape=(args.train_iterations, batch_size, args.embedding_dim))
-        log_loss = lb.create_or_resize_dat(
-            os.path.join(args.experiment_root, 'losses'),
-            dtype=np.float32, shape=(args.train_iterations, batch_size))
-        log_fids = lb.create_or_resize_dat(
-            os.path.join(args.experiment_root, 'fids'),
-            dtype='S' + str(max_fid_len), shape=(args.train_iterations, batch_size))
+                         tf.norm(endpoints['emb_raw'], axis=1),
+                         collections=histograms)
 
     # These are collected here before we add the optimizer, because depending
     # on the optimizer, it might add extra slots, which are also global
@@ -499,12 +699,28 @@ def main():
     # Feel free to try others!
     # optimizer = tf.train.AdadeltaOptimizer(learning_rate)
 
+    # A distillation teacher is neither trained nor stored in the checkpoints.
+    trained_variables = saved_variables = None
+    if args.distillation is not None:
+        def is_student(var):
+            return not var.op.name.startswith('teacher/')
+        trained_variables = list(filter(is_student, tf.trainable_variables()))
+
     # Update_ops are used to update batchnorm stats.
     with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
-        train_op = optimizer.minimize(loss_mean, global_step=global_step)
+        train_op = optimizer.minimize(
+            loss_mean, global_step=global_step, var_list=trained_variables)
+
+    if args.distillation is not None:
+        saved_variables = list(filter(is_student, tf.global_variables()))
 
     # Define a saver for the complete model.
-    checkpoint_saver = tf.train.Saver(max_to_keep=0)
+    checkpoint_saver = tf.train.Saver(saved_variables, max_to_keep=0)
+
+    # And one which only keeps the checkpoint with the best validation mAP.
+    if args.validation_frequency > 0:
+        best_root = os.path.join(args.experiment_root, 'best')
+        best_saver = tf.train.Saver(saved_variables, max_to_keep=1)
 
     with tf.Session() as sess:
         if args.resume:
@@ -526,66 +742,191 @@ def main():
             checkpoint_saver.save(sess, os.path.join(
                 args.experiment_root, 'checkpoint'), global_step=0)
 
+        # The teacher is loaded in any case, since it is not in our checkpoints.
+        if args.distillation is not None and args.teacher_embeddings is not None:
+            sess.run([teacher_cache_init, tf.tables_initializer()],
+                     feed_dict={teacher_cache_value: cached_teacher_embs})
+        elif args.distillation is not None:
+            if args.teacher_checkpoint is None:
+                teacher_checkpoint = tf.train.latest_checkpoint(args.teacher_root)
+            else:
+                teacher_checkpoint = os.path.join(
+                    args.teacher_root, args.teacher_checkpoint)
+            log.info('Restoring teacher from checkpoint: {}'.format(
+                teacher_checkpoint))
+            teacher_saver.restore(sess, teacher_checkpoint)
+
         merged_summary = tf.summary.merge_all()
-        summary_writer = tf.summary.FileWriter(args.experiment_root, sess.graph)
+        histogram_summary = tf.summary.merge_all(HISTOGRAM_SUMMARIES)
+        summary_writer = common.AsyncSummaryWriter(
+            tf.summary.FileWriter(args.experiment_root, sess.graph))
 
         start_step = sess.run(global_step)
         log.info('Starting training from iteration {}.'.format(start_step))
 
+        # Open the log in which we'll store all training detail in addition to
+        # tensorboard, because tensorboard is annoying for detailed inspection
+        # and actually discards data in histogram summaries.
+        if args.detailed_logs:
+            detail_log = DetailLogWriter(
+                os.path.join(args.experiment_root, 'detailed_logs'), dataset_fids,
+                start_iteration=start_step, chunk_size=args.detailed_logs_chunk,
+                float16=args.detailed_logs_float16)
+
+        # Decode all validation images once, and find out the best result
+        # so far in case we're resuming.
+        if args.validation_frequency > 0:
+            log.info('Loading the validation images...')
+            validator.load(sess)
+            log.info('Loaded {} validation images.'.format(len(validator.images)))
+
+            best_file = os.path.join(best_root, 'validation.json')
+            best_map = -1
+            if os.path.isfile(best_file):
+                with open(best_file, 'r') as f:
+                    best_map = json.load(f)['mAP']
+            elif not os.path.isdir(best_root):
+                os.makedirs(best_root)
+
+        # Keep track of where the time of each iteration goes, and possibly
+        # record full traces of some of them.
+        timer = profiling.StageTimer()
+        tracer = profiling.TraceSampler(
+            os.path.join(args.experiment_root, 'traces'),
+            args.trace_frequency, args.trace_slow_steps)
+
         # Finally, here comes the main-loop. This `Uninterrupt` is a handy
         # utility such that an iteration still finishes on Ctrl+C and we can
         # stop the training cleanly.
         with lb.Uninterrupt(sigs=[SIGINT, SIGTERM], verbose=True) as u:
             for i in range(start_step, args.train_iterations):
+                timer.reset()
+
+                # Possibly pull the batch out of the input pipeline on its own,
+                # such that waiting for data doesn't hide in the compute time.
+                feed_dict = None
+                if args.profile_stages:
+                    with timer('input_wait'):
+                        feed_dict = dict(zip(
+                            (images, fids, pids),
+                            sess.run([images, fids, pids])))
 
                 # Compute gradients, update weights, store logs!
-                start_time = time.time()
-                _, summary, step, b_prec_at_k, b_embs, b_loss, b_fids = \
-                    sess.run([train_op, merged_summary, global_step,
-                              prec_at_k, endpoints['emb'], losses, fids])
-                elapsed_time = time.time() - start_time
-
-                # Compute the iteration speed and add it to the summary.
-                # We did observe some weird spikes that we couldn't track down.
-                summary2 = tf.Summary()
-                summary2.value.add(tag='secs_per_iter', simple_value=elapsed_time)
-                summary_writer.add_summary(summary2, step)
-                summary_writer.add_summary(summary, step)
-
-                if args.detailed_logs:
-                    log_embs[i], log_loss[i], log_fids[i] = b_embs, b_loss, b_fids
-
-                # Do a huge print out of the current progress.
-                seconds_todo = (args.train_iterations - step) * elapsed_time
-                log.info('iter:{:6d}, loss min|avg|max: {:.3f}|{:.3f}|{:6.3f}, '
-                         'batch-p@{}: {:.2%}, ETA: {} ({:.2f}s/it)'.format(
-                             step,
-                             float(np.min(b_loss)),
-                             float(np.mean(b_loss)),
-                             float(np.max(b_loss)),
-                             args.batch_k-1, float(b_prec_at_k),
-                             timedelta(seconds=int(seconds_todo)),
-                             elapsed_time))
-                sys.stdout.flush()
-                sys.stderr.flush()
+                # The histograms are only fetched every so often, as part of
+                # the same run, since a separate one would consume a batch.
+                fetches = [train_op, merged_summary, global_step,
+                           prec_at_k, endpoints['emb'], losses, fids]
+                with_histograms = (args.histogram_frequency > 0 and
+                                   i % args.histogram_frequency == 0)
+                if with_histograms:
+                    fetches.append(histogram_summary)
+
+                run_options, run_metadata = tracer.run_args(i)
+                with timer('compute'):
+                    results = sess.run(fetches, feed_dict=feed_dict,
+                                       options=run_options,
+                                       run_metadata=run_metadata)
+                _, summary, step, b_prec_at_k, b_embs, b_loss, b_fids = results[:7]
+                elapsed_time = sum(timer.current.values())
+
+                if run_metadata is not None:
+                    with timer('trace'):
+                        tracer.write(step, run_metadata, summary_writer)
+                        log.info('Wrote a full trace of iteration {}.'.format(step))
+
+                with timer('summary'):
+                    summary_writer.add_summary(summary, step)
+                    if with_histograms:
+                        summary_writer.add_summary(results[7], step)
+
+                with timer('logging'):
+                    if args.detailed_logs:
+                        detail_log.append(i, b_embs, b_loss, b_fids)
+
+                    # Do a huge print out of the current progress.
+                    seconds_todo = (args.train_iterations - step) * elapsed_time
+                    log.info('iter:{:6d}, loss min|avg|max: {:.3f}|{:.3f}|{:6.3f}, '
+                             'batch-p@{}: {:.2%}, ETA: {} ({:.2f}s/it)'.format(
+                                 step,
+                                 float(np.min(b_loss)),
+                                 float(np.mean(b_loss)),
+                                 float(np.max(b_loss)),
+                                 args.batch_k-1, float(b_prec_at_k),
+                                 timedelta(seconds=int(seconds_todo)),
+                                 elapsed_time))
+                    sys.stdout.flush()
+                    sys.stderr.flush()
 
                 # Save a checkpoint of training every so often.
                 if (args.checkpoint_frequency > 0 and
                         step % args.checkpoint_frequency == 0):
-                    checkpoint_saver.save(sess, os.path.join(
-                        args.experiment_root, 'checkpoint'), global_step=step)
+                    with timer('checkpoint'):
+                        # Write out the partial chunk, such that the detailed
+                        # logs always cover everything up to the checkpoint.
+                        if args.detailed_logs:
+                            detail_log.flush()
+                        checkpoint_saver.save(sess, os.path.join(
+                            args.experiment_root, 'checkpoint'), global_step=step)
+
+                # Evaluate on the validation set every so often, keeping the
+                # best checkpoint around.
+                if (args.validation_frequency > 0 and
+                        step % args.validation_frequency == 0):
+                    with timer('validation'):
+                        results = validator(
+                            sess, images, endpoints['emb'], {is_training: False})
+                    validation_summary = tf.Summary()
+                    for key, value in results.items():
+                        validation_summary.value.add(
+                            tag='validation/' + key, simple_value=value)
+                    summary_writer.add_summary(validation_summary, step)
+                    log.info('Validation at iter {}: mAP: {:.2%} | top-1: {:.2%}'
+                             ' | top-5: {:.2%} | top-10: {:.2%}'.format(
+                                 step, results['mAP'], results['top-1'],
+                                 results['top-5'], results['top-10']))
+
+                    if results['mAP'] > best_map:
+                        best_map = results['mAP']
+                        best_saver.save(sess, os.path.join(
+                            best_root, 'checkpoint'), global_step=step)
+                        with open(best_file, 'w') as f:
+                            json.dump(dict(results, iteration=int(step)), f,
+                                      indent=2, sort_keys=True)
+                        log.info('New best validation mAP, saved checkpoint.')
+
+                # The stage timings of this step are only complete now. Also
+                # add the iteration speed to them, as we did observe some weird
+                # spikes that we couldn't track down.
+                timings = timer.summary()
+                timings.value.add(tag='secs_per_iter', simple_value=elapsed_time)
+                summary_writer.add_summary(timings, step)
+
+                # Only the step itself counts as slow, not the checkpoints,
+                # validations or traces done along with it. Traced steps are
+                # slowed down by the tracing, so they don't count either.
+                if run_metadata is None:
+                    tracer.observe(i, elapsed_time)
 
                 # Stop the main-loop at the end of the step, if requested.
                 if u.interrupted:
                     log.info("Interrupted on request!")
                     break
 
+        log.info('Mean seconds per stage: ' + ', '.join(
+            '{}: {:.4f}'.format(stage, seconds)
+            for stage, seconds in timer.means().items()))
+
         # Store one final checkpoint. This might be redundant, but it is crucial
         # in case intermediate storing was disabled and it saves a checkpoint
         # when the process was interrupted.
         checkpoint_saver.save(sess, os.path.join(
             args.experiment_root, 'checkpoint'), global_step=step)
 
+        # Make sure all pending summaries and logs end up on disk.
+        summary_writer.close()
+        if args.detailed_logs:
+            detail_log.close()
+
 
 if __name__ == '__main__':
     main()
@@ -16,6 +16,7 @@ from tensorflow.contrib import slim
 import common
 import lbtoolbox as lb
 import loss
+import shards
 from nets import NET_CHOICES
 from heads import HEAD_CHOICES
 
@@ -42,6 +43,12 @@ parser.add_argument(
 	'--image_root', type=common.readable_directory,
 	help='Path that will be pre-pended to the filenames in the train_set csv.')
 
+parser.add_argument(
+	'--shards', default=None,
+	help='Index of TFRecord shards of the train_set written by '
+	     '`make_shards.py`. If provided, the images are streamed from these, '
+	     'several shards in parallel, instead of read from the `image_root`.')
+
 # Optional with sane defaults.
 
 parser.add_argument(
@@ -98,6 +105,12 @@ parser.add_argument(
 	'--loading_threads', default=8, type=common.positive_int,
 	help='Number of threads used for parallel loading.')
 
+parser.add_argument(
+	'--shuffle_buffer', default=4096, type=common.positive_int,
+	help='Number of records of the `shards` that are shuffled together before'
+	     ' grouping them into PK-batches. The larger, the more random the PIDs'
+	     ' of a batch, at the cost of holding as many encoded images in memory.')
+
 parser.add_argument(
 	'--margin', default='soft', type=common.float_or_string,
 	help='What margin to use: a float value for hard-margin, "soft" for '
@@ -389,13 +402,23 @@ def main():
 		parser.print_help()
 		log.error("You did not specify the `train_set` argument!")
 		sys.exit(1)
-	if not args.image_root:
+	if not args.image_root and not args.shards:
 		parser.print_help()
 		log.error("You did not specify the required `image_root` argument!")
 		sys.exit(1)
+	if args.shards and args.hard_pool_size > 0:
+		parser.print_help()
+		log.error("The hard identity pool can't be sampled from `shards`!")
+		sys.exit(1)
 
-	# Load the data from the CSV file.
-	pids, fids = common.load_dataset(args.train_set, args.image_root)
+	# Load the data from the CSV file, which the shards must hold, if any.
+	if args.shards:
+		pids, fids = common.load_dataset(args.train_set, None)
+		if not np.array_equal(shards.load_index(args.shards)['fids'], fids):
+			raise IOError('The shards of `{}` do not hold the train_set `{}`.'
+			              .format(args.shards, args.train_set))
+	else:
+		pids, fids = common.load_dataset(args.train_set, args.image_root)
 	max_fid_len = max(map(len, fids))  # We'll need this later for logfiles.
 
 	# Load feature embeddings
@@ -405,46 +428,53 @@ def main():
 			f_dists = scipy.spatial.distance.cdist(train_embs, train_embs)
 			hard_ids = get_hard_id_pool(pids, f_dists, args.hard_pool_size)
 
-	# Setup a tf.Dataset where one "epoch" loops over all PIDS.
-	# PIDS are shuffled after every epoch and continue indefinitely.
-	unique_pids = np.unique(pids)
-	dataset = tf.data.Dataset.from_tensor_slices(unique_pids)
-	dataset = dataset.shuffle(len(unique_pids))
-
-	# Constrain the dataset size to a multiple of the batch-size, so that
-	# we don't get overlap at the end of each epoch.
-	if args.hard_pool_size == 0:
-		dataset = dataset.take((len(unique_pids) // args.batch_p) * args.batch_p)
-		dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
+	if args.shards:
+		# Stream the shards, grouped by PID into K images each, instead.
+		dataset = shards.pk_dataset(
+			args.shards, args.batch_k, loading_threads=args.loading_threads,
+			shuffle_buffer=args.shuffle_buffer)
 
+		def load_image(image_encoded, fid, pid, image_size):
+			return common.decode_image(image_encoded, image_size), fid, pid
 	else:
-		dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
-		dataset = dataset.map(lambda pid: sample_batch_ids_for_pid(
-			pid, all_pids=pids, batch_p=args.batch_p, all_hard_pids=hard_ids))
-		# Unbatch the P PIDs
-		dataset = dataset.apply(tf.contrib.data.unbatch())
+		# Setup a tf.Dataset where one "epoch" loops over all PIDS.
+		# PIDS are shuffled after every epoch and continue indefinitely.
+		unique_pids = np.unique(pids)
+		dataset = tf.data.Dataset.from_tensor_slices(unique_pids)
+		dataset = dataset.shuffle(len(unique_pids))
+
+		# Constrain the dataset size to a multiple of the batch-size, so that
+		# we don't get overlap at the end of each epoch.
+		if args.hard_pool_size == 0:
+			dataset = dataset.take((len(unique_pids) // args.batch_p) * args.batch_p)
+			dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
+
+		else:
+			dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
+			dataset = dataset.map(lambda pid: sample_batch_ids_for_pid(
+				pid, all_pids=pids, batch_p=args.batch_p, all_hard_pids=hard_ids))
+			# Unbatch the P PIDs
+			dataset = dataset.apply(tf.contrib.data.unbatch())
+
+		# For every PID, get K images.
+		dataset = dataset.map(lambda pid: sample_k_fids_for_pid(
+			pid, all_fids=fids, all_pids=pids, batch_k=args.batch_k))
 
-	# For every PID, get K images.
-	dataset = dataset.map(lambda pid: sample_k_fids_for_pid(
-		pid, all_fids=fids, all_pids=pids, batch_k=args.batch_k))
+		# Ungroup/flatten the batches for easy loading of the files.
+		dataset = dataset.apply(tf.contrib.data.unbatch())
 
-	# Ungroup/flatten the batches for easy loading of the files.
-	dataset = dataset.apply(tf.contrib.data.unbatch())
+		def load_image(fid, pid, image_size):
+			return common.fid_to_image(
+				fid, pid, image_root=args.image_root, image_size=image_size)
 
-	# Convert filenames to actual image tensors.
 	net_input_size = (args.net_input_height, args.net_input_width)
 	pre_crop_size = (args.pre_crop_height, args.pre_crop_width)
-	dataset = dataset.map(
-		lambda fid, pid: common.fid_to_image(
-			fid, pid, image_root=args.image_root,
-			image_size=pre_crop_size if args.crop_augment else net_input_size),
-		num_parallel_calls=args.loading_threads)
 
 	# Augment the data if specified by the arguments.
 	if args.augment == False:
 		dataset = dataset.map(
-			lambda im, fid, pid: common.fid_to_image(
-				fid, pid, image_root=args.image_root,
+			lambda *record: load_image(
+				*record,
 				image_size=pre_crop_size if args.crop_augment else net_input_size),  # Ergys
 			num_parallel_calls=args.loading_threads)
 
@@ -456,9 +486,7 @@ def main():
 				lambda im, fid, pid: (tf.random_crop(im, net_input_size + (3,)), fid, pid))
 	else:
 		dataset = dataset.map(
-			lambda im, fid, pid: common.fid_to_image(
-				fid, pid, image_root=args.image_root,
-				image_size=net_input_size),
+			lambda *record: load_image(*record, image_size=net_input_size),
 			num_parallel_calls=args.loading_threads)
 
 		dataset = dataset.map(
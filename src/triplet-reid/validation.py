@@ -0,0 +1,109 @@
+""" Periodic evaluation of the network on a query/gallery set during training. """
+
+from importlib import import_module
+
+import numpy as np
+import tensorflow as tf
+
+import common
+import metrics
+
+
+class Validator(object):
+    """ Computes mAP and CMC of the model being trained on a validation set.
+
+    All validation images are decoded once and kept in memory as uint8, such
+    that every validation only costs the forward passes. The embeddings are
+    computed by feeding these images into the training graph's own input
+    tensor with `is_training` set to False, so no second copy of the network
+    is needed.
+
+    Use as:
+    validator = Validator(...)  # While building the graph.
+    with tf.Session() as sess:
+        validator.load(sess)
+        results = validator(sess, images, endpoints['emb'], {is_training: False})
+
+    Args:
+        query_csv, gallery_csv (string): The dataset files of the query and
+            gallery sets.
+        image_root (string): The image root both dataset files are relative to.
+        excluder (string): Name of the module in `excluders` to use.
+        image_size (tuple): The (height, width) the images are resized to.
+        crop_size (tuple or None): If given, the central crop of this size is
+            taken from the resized image, like `embed.py --crop_augment center`.
+        metric (string): The metric used for computing distances.
+        batch_size (int): How many images to embed at once.
+        loading_threads (int): Number of threads used for decoding.
+    """
+    def __init__(self, query_csv, gallery_csv, image_root, excluder,
+                 image_size, crop_size, metric, batch_size, loading_threads):
+        self.query_pids, self.query_fids = common.load_dataset(
+            query_csv, image_root)
+        self.gallery_pids, self.gallery_fids = common.load_dataset(
+            gallery_csv, image_root)
+        self.mask = import_module('excluders.' + excluder).Excluder(
+            self.gallery_fids)(self.query_fids)
+        self.metric = metric
+        self.batch_size = batch_size
+        self.images = None
+
+        # The pipeline which decodes all of the images exactly once.
+        all_fids = np.concatenate([self.query_fids, self.gallery_fids])
+        dataset = tf.data.Dataset.from_tensor_slices(all_fids)
+        dataset = dataset.map(
+            lambda fid: common.fid_to_image(
+                fid, tf.constant('dummy'), image_root=image_root,
+                image_size=image_size),
+            num_parallel_calls=loading_threads)
+        if crop_size is not None:
+            dataset = dataset.map(lambda im, fid, pid: (
+                tf.image.resize_image_with_crop_or_pad(im, *crop_size), fid, pid))
+        dataset = dataset.map(lambda im, fid, pid: tf.saturate_cast(
+            tf.round(im), tf.uint8))
+        dataset = dataset.batch(batch_size).prefetch(1)
+        self._next_images = dataset.make_one_shot_iterator().get_next()
+        self._num_images = len(all_fids)
+
+    def load(self, sess):
+        """ Decodes all validation images into memory. """
+        batches = []
+        while True:
+            try:
+                batches.append(sess.run(self._next_images))
+            except tf.errors.OutOfRangeError:
+                break
+        self.images = np.concatenate(batches)
+        assert len(self.images) == self._num_images
+
+    def embed(self, sess, images, embeddings, feed_dict):
+        """ Embeds all cached images by feeding them into `images`. """
+        embs = []
+        for start in range(0, len(self.images), self.batch_size):
+            batch = self.images[start:start + self.batch_size]
+            feed_dict[images] = batch.astype(np.float32)
+            embs.append(sess.run(embeddings, feed_dict=feed_dict))
+        return np.concatenate(embs)
+
+    def __call__(self, sess, images, embeddings, feed_dict):
+        """ Runs a full validation and returns a dict of the results.
+
+        Args:
+            sess (tf.Session): The session holding the trained weights.
+            images (tensor): The network input to feed the images into.
+            embeddings (tensor): The resulting embeddings.
+            feed_dict (dict): Anything else to feed, such as switching the
+                network to inference mode.
+        """
+        embs = self.embed(sess, images, embeddings, dict(feed_dict))
+        num_query = len(self.query_fids)
+        aps, ranks = metrics.evaluate(
+            embs[:num_query], self.query_pids, embs[num_query:],
+            self.gallery_pids, self.metric, self.mask)
+        cmc = metrics.cmc(ranks, 10)
+        return {
+            'mAP': float(np.nanmean(aps)),
+            'top-1': float(cmc[0]),
+            'top-5': float(cmc[4]),
+            'top-10': float(cmc[9]),
+        }